@@ -0,0 +1,89 @@
+# ======================
+# Client-side metadata cache for Earth Engine objects
+# getInfo results are memoized in memory and, optionally, in a persistent on-disk cache keyed by the serialized
+# expression (with an optional maximum age, since the expression does not change when the server data does),
+# and collection metadata (ids, system:index, dates, size) is fetched in one batched call per collection
+# ======================
+
+import os
+import json
+import time
+import hashlib
+import ee
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'vol_veg_landsat', 'ee')
+
+_memory_cache = {}
+
+def cached_getInfo(ee_object, cache_dir=None, max_age=None):
+    '''
+    getInfo() with memoization. The same expression is only computed on the server once;
+    later calls are answered from the cache (also in later sessions, with cache_dir).
+    The key is the expression, not the server data it reads: results of collections that change on the server
+    (new scenes, reprocessing) should only be cached in memory, or with a max_age
+
+    Args:
+        ee_object (ee.ComputedObject): any Earth Engine object (ee.Number, ee.List, ee.Dictionary, ee.Image, ...)
+        cache_dir (string): folder of the on-disk cache (e.g., DEFAULT_CACHE_DIR); None to only cache in memory
+        max_age (float): seconds after which a cached result is fetched again; None for no expiry
+
+    Returns:
+        value: result of ee_object.getInfo()
+    '''
+    key = hashlib.sha1(ee_object.serialize().encode()).hexdigest()
+    now = time.time()
+    if key in _memory_cache:
+        value, fetched = _memory_cache[key]
+        if max_age is None or now - fetched <= max_age:
+            return value
+
+    cache_path = os.path.join(cache_dir, key + '.json') if cache_dir is not None else None
+    if cache_path is not None and os.path.exists(cache_path) and (max_age is None or now - os.path.getmtime(cache_path) <= max_age):
+        with open(cache_path) as f:
+            value = json.load(f)
+        fetched = os.path.getmtime(cache_path)
+    else:
+        fetched = now
+        value = ee_object.getInfo()
+        if cache_path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = cache_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(value, f)
+            os.replace(tmp_path, cache_path)
+    _memory_cache[key] = (value, fetched)
+    return value
+
+def get_collection_metadata(imgCol, cache_dir=None, max_age=None):
+    '''
+    Fetches the metadata of every image of a collection in one batched server call.
+    Only cached in memory by default, since the collection may change on the server
+
+    Args:
+        imgCol (ee.ImageCollection): image collection
+        cache_dir (string): folder of the on-disk cache; None to only cache in memory
+        max_age (float): seconds after which the metadata is fetched again; None for no expiry
+
+    Returns:
+        metadata (dict): 'size' (int), and lists 'ids' (system:id), 'system_index' (system:index)
+                        and 'dates' (system:time_start, milliseconds) in collection order
+    '''
+    metadata = ee.Dictionary({
+        'size': imgCol.size(),
+        'ids': imgCol.aggregate_array('system:id'),
+        'system_index': imgCol.aggregate_array('system:index'),
+        'dates': imgCol.aggregate_array('system:time_start'),
+    })
+    return cached_getInfo(metadata, cache_dir, max_age)
+
+def clear_cache(cache_dir=DEFAULT_CACHE_DIR):
+    '''
+    Empties the memory cache and removes every cached result from cache_dir
+    (e.g., after the Landsat collections on the server have been updated)
+    '''
+    _memory_cache.clear()
+    if cache_dir is None or not os.path.exists(cache_dir):
+        return
+    for file in os.listdir(cache_dir):
+        if file.endswith('.json'):
+            os.remove(os.path.join(cache_dir, file))
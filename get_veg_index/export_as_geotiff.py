@@ -5,7 +5,10 @@
 # adapted from: https://colab.research.google.com/github/csaybar/EEwPython/blob/dev/index.ipynb
 # ======================
 import time 
+import json
+from collections import deque
 import ee
+import ee_cache
 
 # test image
 # img = ee.Image((vegIndices_NDVI.toList(vegIndices_NDVI.size())).get(0))
@@ -29,7 +32,7 @@ def exportSingleImage(img, description, folder, region):
         'description': description,
         'folder': folder,
         'scale': 30,
-        'region': region.getInfo()['coordinates']
+        'region': ee_cache.cached_getInfo(region)['coordinates']
     })
     task.start()
 
@@ -39,7 +42,21 @@ def exportSingleImage(img, description, folder, region):
         time.sleep(5)
     print('Finished export')
 
-def exportImageCol(imgCol, description, folder, region): 
+def getImage(imgCol, system_index): 
+    '''
+    Image of a collection by its system:index. Only builds the (lazy) expression; nothing is computed 
+    until the image is exported, so it is called when the export task is submitted
+
+    Args: 
+        imgCol (ee.ImageCollection): image collection
+        system_index (string): system:index of the image
+
+    Returns: 
+        img (ee.Image): the image
+    '''
+    return ee.Image(imgCol.filter(ee.Filter.eq('system:index', system_index)).first())
+
+def exportImageCol(imgCol, description, folder, region, cache_dir=ee_cache.DEFAULT_CACHE_DIR): 
     """ 
     Function to export imageCollection as geotiffs to google drive
     
@@ -48,19 +65,24 @@ def exportImageCol(imgCol, description, folder, region):
         description (string): string to append to filename. Options: (NDVI, NBR, SAVI)
         folder (string): path to GOOGLE DRIVE folder
         region (ee.Geometry.Polygon): area of interest
+        cache_dir (string): folder of the on-disk getInfo cache of the region (see ee_cache); None to only cache in memory. 
+                            The collection metadata is only cached in memory, so it is read fresh in every session
     
     Returns: 
         Doesn't return 
      """
-    imgCol_size = imgCol.size().getInfo()
+    # collection metadata and region are fetched once, not once per image. 
+    # File names, count and images all come from the same metadata snapshot (images are looked up by system:index)
+    metadata = ee_cache.get_collection_metadata(imgCol)
+    imgCol_size = len(metadata['system_index'])
+    coordinates = ee_cache.cached_getInfo(region, cache_dir)['coordinates']
     for num in range(imgCol_size): # replace integer in range() with imgCol_size when not testing
-        img = ee.Image((imgCol.toList(imgCol.size())).get(num))
         task = ee.batch.Export.image.toDrive(**{
-        'image': img,
-        'description': img.getInfo()['properties']['system:index'] + '_' + description,
+        'image': getImage(imgCol, metadata['system_index'][num]),
+        'description': metadata['system_index'][num] + '_' + description,
         'folder': folder, 
         'scale': 30, 
-        'region': region.getInfo()['coordinates']
+        'region': coordinates
         })
         task.start()
         
@@ -71,4 +93,119 @@ def exportImageCol(imgCol, description, folder, region):
         print('Finished exporting ' + str(num+1) + ' image')
     print('Finished exporting entire collection')
 
+# ======================
+# Concurrent export scheduler: keeps a bounded number of export tasks in flight, polls all task states 
+# in one call, retries failed tasks with exponential backoff and writes a manifest of the outputs
+# ======================
+FINISHED_STATES = ['COMPLETED', 'FAILED', 'CANCELLED']
+
+def exportImageColConcurrent(imgCol, description, folder, region, max_tasks=4, poll_interval=15, 
+                             max_retries=3, backoff=30, manifest_path=None, batch=None, cache_dir=ee_cache.DEFAULT_CACHE_DIR): 
+    """ 
+    Function to export imageCollection as geotiffs to google drive with several export tasks running at once
+    
+    Args: 
+        imgCol (ee.ImageCollection): imageCollection to save as geotiff to gdrive
+        description (string): string to append to filename. Options: (NDVI, NBR, SAVI)
+        folder (string): path to GOOGLE DRIVE folder
+        region (ee.Geometry.Polygon): area of interest
+        max_tasks (int): maximum number of export tasks running at the same time
+        poll_interval (float): seconds between two polls of the task states
+        max_retries (int): number of times a failed export is restarted before giving up
+        backoff (float): seconds to wait before the first retry; doubled for every further retry
+        manifest_path (string): optional path of a json file to write the manifest to (rewritten as tasks finish)
+        batch (module): ee.batch or a stand-in with the same Export.image.toDrive and Task.list interface (for testing)
+        cache_dir (string): folder of the on-disk getInfo cache of the region (see ee_cache); None to only cache in memory. 
+                            The collection metadata is only cached in memory, so it is read fresh in every session
+    
+    Returns: 
+        manifest (list): one dict per image with 'index', 'description', 'task_id', 'state', 'attempts' and 'error_message'
+     """
+    if max_tasks < 1: 
+        raise ValueError("Inappropriate number of concurrent export tasks chosen!")
+    if batch is None: 
+        batch = ee.batch
+
+    # fetch everything needed to start the exports once, instead of once per image. 
+    # File names, count and images all come from the same metadata snapshot (images are looked up by system:index)
+    metadata = ee_cache.get_collection_metadata(imgCol)
+    imgCol_size = len(metadata['system_index'])
+    system_indices = metadata['system_index']
+    coordinates = ee_cache.cached_getInfo(region, cache_dir)['coordinates']
+
+    manifest = [{'index': num, 
+                 'description': system_indices[num] + '_' + description, 
+                 'task_id': None, 
+                 'state': 'PENDING', 
+                 'attempts': 0, 
+                 'error_message': None} for num in range(imgCol_size)]
+    pending = deque((num, 0) for num in range(imgCol_size)) # (image number, time when it may start)
+    running = {} # task id -> (image number, task)
+
+    while pending or running: 
+        # start new tasks while there is room
+        now = time.time()
+        for _ in range(len(pending)): 
+            if len(running) >= max_tasks: 
+                break
+            num, start_time = pending.popleft()
+            if start_time > now: 
+                pending.append((num, start_time))
+                continue
+            task = batch.Export.image.toDrive(**{
+                # the image is only built when its task is submitted
+                'image': getImage(imgCol, system_indices[num]),
+                'description': manifest[num]['description'],
+                'folder': folder, 
+                'scale': 30, 
+                'region': coordinates
+                })
+            task.start()
+            manifest[num]['task_id'] = task.id
+            manifest[num]['state'] = 'RUNNING'
+            manifest[num]['attempts'] += 1
+            running[task.id] = (num, task)
+
+        if not running: 
+            # only retries waiting for their backoff: sleep until the first one may start
+            time.sleep(max(0, min(start_time for num, start_time in pending) - time.time()))
+            continue
+        time.sleep(poll_interval)
+
+        # poll the states of all tasks in one call
+        states = {}
+        for listed_task in batch.Task.list(): 
+            states[listed_task.id] = listed_task
+        print('Polling ' + str(len(running)) + ' running tasks, ' + str(len(pending)) + ' waiting.')
+        for task_id in list(running.keys()): 
+            if task_id not in states or states[task_id].state not in FINISHED_STATES: 
+                continue
+            num, task = running.pop(task_id)
+            state = states[task_id].state
+            manifest[num]['state'] = state
+            manifest[num]['error_message'] = None
+            if state != 'COMPLETED': 
+                # the error message is only reported by the task's status
+                manifest[num]['error_message'] = task.status().get('error_message')
+                if manifest[num]['attempts'] <= max_retries: 
+                    wait = backoff * 2 ** (manifest[num]['attempts'] - 1)
+                    print('Export of ' + manifest[num]['description'] + ' ' + state + '; retrying in ' + str(wait) + ' s')
+                    manifest[num]['state'] = 'RETRYING'
+                    pending.append((num, time.time() + wait))
+                    continue
+            print('Finished exporting ' + manifest[num]['description'] + ': ' + state)
+            if manifest_path is not None: 
+                _writeManifest(manifest, manifest_path)
+
+    if manifest_path is not None: 
+        _writeManifest(manifest, manifest_path)
+    num_completed = len([entry for entry in manifest if entry['state'] == 'COMPLETED'])
+    print('Finished exporting entire collection: ' + str(num_completed) + ' of ' + str(imgCol_size) + ' completed')
+    return manifest
+
+def _writeManifest(manifest, manifest_path): 
+    """Writes the export manifest as json"""
+    with open(manifest_path, 'w') as f: 
+        json.dump(manifest, f, indent=1)
+
 # exportImageCol(vegIndices_SAVI, 'SAVI')
\ No newline at end of file
@@ -4,6 +4,7 @@
 # ====================== 
 
 import ee
+import ee_cache
 
 def filter_collection(imgCollection, filterpoint, harmonizefunc, landsat_sat, cloudcover=80, img_qual=7, rmse=10):
     '''
@@ -44,7 +45,8 @@ def filter_collection(imgCollection, filterpoint, harmonizefunc, landsat_sat, cl
             .filterMetadata('IMAGE_QUALITY_OLI', 'greater_than', img_qual) \
             .map(harmonizefunc)
     
-    print('Number of images in collection: ', filtered_collection.size().getInfo())
+    # size is memoized (see ee_cache), so reruns do not go back to the server
+    print('Number of images in collection: ', ee_cache.cached_getInfo(filtered_collection.size()))
     
     return filtered_collection
 
@@ -0,0 +1,308 @@
+# ======================
+# Local NumPy backend: same processing as harmonize.py / get_VIs.py, but applied to Landsat Collection 1
+# surface reflectance scenes on disk instead of server-side Earth Engine images
+# 1. Rename bands (renameEtm / renameOli)
+# 2. Cloud masking with CFmask bits of pixel_qa (fmask)
+# 3. Harmonize TM/ETM+ to OLI with the Roy et al., 2016 coefficients (etmToOli)
+# 4. NDVI, NBR, SAVI, BSI (getNDVI, getNBR, getSAVI, getBSI)
+# Scenes are processed block by block, with the band files of a block read concurrently by a thread pool
+# ======================
+
+import os
+import re
+import logging
+import warnings
+from glob import glob
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import rasterio
+from rasterio.vrt import WarpedVRT
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+
+# progress messages (e.g., logging.basicConfig(level=logging.INFO) to print them)
+logger = logging.getLogger(__name__)
+
+BAND_NAMES = ['Blue', 'Green', 'Red', 'NIR', 'SWIR1', 'SWIR2']
+
+# SR band numbers for each band name (see harmonize.renameEtm / harmonize.renameOli)
+ETM_BANDS = {'Blue': 1, 'Green': 2, 'Red': 3, 'NIR': 4, 'SWIR1': 5, 'SWIR2': 7}
+OLI_BANDS = {'Blue': 2, 'Green': 3, 'Red': 4, 'NIR': 5, 'SWIR1': 6, 'SWIR2': 7}
+
+# Roy et al., 2016 coefficients to transform TM/ETM+ SR to OLI SR (same as harmonize.coefficients), in BAND_NAMES order
+ITCPS = np.array([0.0003, 0.0088, 0.0061, 0.0412, 0.0254, 0.0172]) * 10000
+SLOPES = np.array([0.8474, 0.8483, 0.9047, 0.8462, 0.8937, 0.9071])
+
+GOOD_INDICES = ['NDVI', 'NBR', 'SAVI', 'BSI']
+
+# ======================
+# Scene discovery
+# ======================
+def parse_scene_id(scene_id):
+    '''
+    Gets the sensor and acquisition date from a Landsat product id (e.g., LT05_L1TP_112037_19850601_20161004_01_T1)
+
+    Returns:
+        sensor (string): 'LS5', 'LS7' or 'LS8'
+        date (string): acquisition date as YYYYMMDD
+    '''
+    match = re.match(r'L[CTE]0([578])_\w{4}_\d{6}_(\d{8})', scene_id)
+    if match is None:
+        raise ValueError("Not a Landsat product id: " + scene_id)
+    return 'LS' + match.group(1), match.group(2)
+
+def find_scene_bands(scene_dir):
+    '''
+    Finds the surface reflectance band files and pixel_qa file of a scene folder
+
+    Args:
+        scene_dir (string): folder of an extracted Landsat Collection 1 SR scene (*_sr_band<n>.tif, *_pixel_qa.tif)
+
+    Returns:
+        scene (dict): 'id', 'sensor', 'date', and 'files' (band name -> file path, including 'pixel_qa')
+    '''
+    qa_files = glob(os.path.join(scene_dir, '*_pixel_qa.tif'))
+    if len(qa_files) != 1:
+        raise ValueError("No (unique) pixel_qa file in " + scene_dir)
+    scene_id = os.path.basename(qa_files[0])[:-len('_pixel_qa.tif')]
+    sensor, date = parse_scene_id(scene_id)
+
+    band_numbers = OLI_BANDS if sensor == 'LS8' else ETM_BANDS
+    files = {'pixel_qa': qa_files[0]}
+    for name in BAND_NAMES:
+        files[name] = os.path.join(scene_dir, scene_id + '_sr_band' + str(band_numbers[name]) + '.tif')
+    return {'id': scene_id, 'sensor': sensor, 'date': date, 'files': files}
+
+# ======================
+# Array versions of the Earth Engine functions
+# ======================
+def fmask(bands, qa):
+    '''
+    Cloud masking using CFmask bits (Zhu et al., 2015): pixels flagged as cloud shadow (bit 3) or cloud (bit 5) are set to np.nan
+
+    Args:
+        bands (numpy array): float array (bands, rows, cols) of surface reflectance
+        qa (numpy array): integer array (rows, cols) of pixel_qa
+    '''
+    cloudShadowBitMask = 1 << 3
+    cloudsBitMask = 1 << 5
+    mask = ((qa & cloudShadowBitMask) == 0) & ((qa & cloudsBitMask) == 0)
+    bands[:, ~mask] = np.nan
+    return bands
+
+def etm_to_oli(bands):
+    '''
+    Applies the transformation from TM/ETM+ to OLI (slope, intercept), then rounds and clamps like round().toShort()
+    on Earth Engine (harmonize.etmToOli): halves away from zero, and to the int16 range; np.nan stays np.nan
+    '''
+    values = bands * SLOPES[:, np.newaxis, np.newaxis] + ITCPS[:, np.newaxis, np.newaxis]
+    return np.clip(np.sign(values) * np.floor(np.abs(values) + 0.5), -32768, 32767)
+
+def get_index(bands, veg_index):
+    '''
+    Computes one vegetation index from harmonized bands (bands in BAND_NAMES order)
+
+    Args:
+        bands (numpy array): float array (bands, rows, cols) of harmonized surface reflectance
+        veg_index (string): 'NDVI', 'NBR', 'SAVI' or 'BSI'
+
+    Returns:
+        index (numpy array): float32 array (rows, cols)
+    '''
+    blue, green, red, nir, swir1, swir2 = bands
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if veg_index == 'NDVI':
+            index = (nir - red) / (nir + red)
+        elif veg_index == 'NBR':
+            index = (nir - swir2) / (nir + swir2)
+        elif veg_index == 'SAVI':
+            nir, red = nir * 0.0001, red * 0.0001
+            index = ((nir - red) / (nir + red + 0.5)) * 1.5
+        elif veg_index == 'BSI':
+            blue, red, nir, swir1 = blue * 0.0001, red * 0.0001, nir * 0.0001, swir1 * 0.0001
+            index = ((swir1 + red) - (nir + blue)) / ((swir1 + red) + (nir + blue))
+        else:
+            raise ValueError("Inappropriate vegetation index chosen!")
+    return index.astype('float32')
+
+# ======================
+# Block-wise scene processing
+# ======================
+def _open_band(file, grid):
+    '''
+    Opens a band file, warped on the fly to the target grid if one is given
+    '''
+    src = rasterio.open(file)
+    if grid is None:
+        return src
+    return WarpedVRT(src, crs=grid['crs'], transform=grid['transform'], width=grid['width'], height=grid['height'],
+                     resampling=Resampling.nearest)
+
+def _read_block(dataset, window):
+    '''
+    Reads one window of a band as float, with nodata set to np.nan
+    '''
+    block = dataset.read(1, window=window, masked=True)
+    return block.astype(float).filled(np.nan)
+
+def process_scene_block(datasets, window, sensor, indices, executor):
+    '''
+    Runs fmask -> harmonization -> vegetation indices on one window of a scene
+
+    Returns:
+        block_indices (dict): float32 array (window rows, window cols) per vegetation index
+    '''
+    names = BAND_NAMES + ['pixel_qa']
+    blocks = list(executor.map(lambda name: _read_block(datasets[name], window), names))
+    bands = np.stack(blocks[:-1])
+    qa = np.nan_to_num(blocks[-1], nan=0).astype(np.uint16)
+    bands[:, np.isnan(blocks[-1])] = np.nan
+
+    bands = fmask(bands, qa)
+    if sensor != 'LS8':
+        bands = etm_to_oli(bands)
+    return {veg_index: get_index(bands, veg_index) for veg_index in indices}
+
+def process_scene(scene, indices=('NDVI', 'NBR', 'SAVI'), grid=None, block_size=1024, n_threads=4):
+    '''
+    Generator that processes a scene block by block
+
+    Args:
+        scene (dict): scene from find_scene_bands
+        indices (tuple): vegetation indices to compute
+        grid (dict): optional target grid ('crs', 'transform', 'width', 'height'), e.g. the area of interest;
+                    every scene is warped to it so that scenes line up for compositing. None keeps the scene grid
+        block_size (int): block height and width in pixels
+        n_threads (int): number of threads reading band files concurrently
+
+    Yields:
+        window (rasterio Window): window of the block
+        block_indices (dict): float32 array per vegetation index
+    '''
+    for veg_index in indices:
+        if veg_index not in GOOD_INDICES:
+            raise ValueError("Inappropriate vegetation index chosen!")
+
+    datasets = {name: _open_band(file, grid) for name, file in scene['files'].items()}
+    try:
+        height, width = datasets['pixel_qa'].height, datasets['pixel_qa'].width
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            for row_off in range(0, height, block_size):
+                for col_off in range(0, width, block_size):
+                    window = Window(col_off, row_off, min(block_size, width - col_off), min(block_size, height - row_off))
+                    yield window, process_scene_block(datasets, window, scene['sensor'], indices, executor)
+    finally:
+        for dataset in datasets.values():
+            dataset.close()
+
+def get_scene_profile(scene, grid=None):
+    '''
+    Rasterio profile of a float32 index raster on the scene grid (or on the target grid)
+    '''
+    with rasterio.open(scene['files']['pixel_qa']) as f:
+        profile = dict(f.profile)
+    if grid is not None:
+        profile.update(crs=grid['crs'], transform=grid['transform'], width=grid['width'], height=grid['height'])
+    profile.update(driver='GTiff', count=1, dtype='float32', nodata=np.nan, tiled=True, blockxsize=256, blockysize=256, compress='deflate')
+    return profile
+
+def get_scene_grid(scene):
+    '''
+    Grid ('crs', 'transform', 'width', 'height') of a scene, to use as the target grid of other scenes
+    '''
+    with rasterio.open(scene['files']['pixel_qa']) as f:
+        return {'crs': f.crs, 'transform': f.transform, 'width': f.width, 'height': f.height}
+
+def write_scene_indices(scene, out_dir, indices=('NDVI', 'NBR', 'SAVI'), grid=None, block_size=1024, n_threads=4):
+    '''
+    Processes a scene block by block and writes one geotiff per vegetation index (<scene id>_<index>.tif)
+
+    Args:
+        see process_scene; out_dir (string) is the folder to write the geotiffs to
+
+    Returns:
+        out_files (dict): file path per vegetation index
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    profile = get_scene_profile(scene, grid)
+    out_files = {veg_index: os.path.join(out_dir, scene['id'] + '_' + veg_index + '.tif') for veg_index in indices}
+    datasets = {veg_index: rasterio.open(file, 'w', **profile) for veg_index, file in out_files.items()}
+    try:
+        for window, block_indices in process_scene(scene, indices, grid, block_size, n_threads):
+            for veg_index, values in block_indices.items():
+                datasets[veg_index].write(values, 1, window=window)
+    finally:
+        for dataset in datasets.values():
+            dataset.close()
+    logger.info('Finished processing scene ' + scene['id'])
+    return out_files
+
+# ======================
+# Annual index geotiffs in the format read by post_processing (ingest_and_clean.create_image_stack)
+# ======================
+def group_scenes_by_year(scene_dirs, months=(6, 9)):
+    '''
+    Groups local scenes by acquisition year, keeping only the scenes of the growing season
+
+    Args:
+        scene_dirs (list): folders of extracted Landsat SR scenes
+        months (tuple): first and last month of the growing season
+
+    Returns:
+        scenes_by_year (dict): year -> list of scenes (see find_scene_bands)
+    '''
+    scenes_by_year = {}
+    for scene_dir in scene_dirs:
+        scene = find_scene_bands(scene_dir)
+        if months[0] <= int(scene['date'][4:6]) <= months[1]:
+            scenes_by_year.setdefault(int(scene['date'][:4]), []).append(scene)
+    return scenes_by_year
+
+def annual_index_filename(out_dir, year, veg_index):
+    '''
+    File name of an annual composite; composites are dated June 1st like composite.median_composite, e.g. 19850601_NBR.tif
+    '''
+    return os.path.join(out_dir, str(year) + '0601_' + veg_index + '.tif')
+
+def write_annual_indices(scene_dirs, out_dir, indices=('NDVI', 'NBR', 'SAVI'), grid=None, months=(6, 9), block_size=1024, n_threads=4):
+    '''
+    Processes local scenes and writes yearly median composites of the vegetation indices during the growing season
+    (same selection as wrappers.wrapper_VI). All scenes of a year are held in memory while compositing;
+    use local_composite for out-of-core compositing of large scene stacks
+
+    Args:
+        scene_dirs (list): folders of extracted Landsat SR scenes
+        out_dir (string): folder to write the annual geotiffs to
+        indices (tuple): vegetation indices to compute
+        grid (dict): target grid ('crs', 'transform', 'width', 'height'); required if scenes are not on the same grid
+        months (tuple): first and last month of the growing season
+        block_size (int): block height and width in pixels
+        n_threads (int): number of threads reading band files concurrently
+
+    Returns:
+        out_files (list): annual geotiff paths
+    '''
+    scenes_by_year = group_scenes_by_year(scene_dirs, months)
+    os.makedirs(out_dir, exist_ok=True)
+    out_files = []
+    for year in sorted(scenes_by_year):
+        profile = get_scene_profile(scenes_by_year[year][0], grid)
+        year_stack = {veg_index: [] for veg_index in indices}
+        for scene in scenes_by_year[year]:
+            scene_indices = {veg_index: np.full([profile['height'], profile['width']], np.nan, dtype='float32') for veg_index in indices}
+            for window, block_indices in process_scene(scene, indices, grid, block_size, n_threads):
+                for veg_index, values in block_indices.items():
+                    scene_indices[veg_index][window.toslices()] = values
+            for veg_index in indices:
+                year_stack[veg_index].append(scene_indices[veg_index])
+        for veg_index in indices:
+            with warnings.catch_warnings():
+                # pixels masked in every scene of the year stay np.nan
+                warnings.simplefilter('ignore', RuntimeWarning)
+                composite = np.nanmedian(np.stack(year_stack[veg_index]), axis=0).astype('float32')
+            out_file = annual_index_filename(out_dir, year, veg_index)
+            with rasterio.open(out_file, 'w', **profile) as f:
+                f.write(composite, 1)
+            out_files.append(out_file)
+        logger.info('Finished annual composite for ' + str(year) + ' (' + str(len(scenes_by_year[year])) + ' scenes)')
+    return out_files
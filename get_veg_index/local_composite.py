@@ -0,0 +1,169 @@
+# ======================
+# Out-of-core annual median compositing of local Landsat scenes (local equivalent of composite.median_composite)
+# 1. Every growing-season scene is processed block by block (see local_backend) into one memory-mapped
+#    .npy file per vegetation index, on a common grid
+# 2. For each year, the per-pixel median of the masked scenes is computed one block of rows at a time
+#    over the memory maps, so only one block of every scene of the year is in memory at once
+# 3. One composite geotiff per year and vegetation index (YYYY0601_<VI>.tif)
+# ======================
+
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import rasterio
+from numpy.lib.format import open_memmap
+import local_backend as lb
+
+def stage_scene(scene, work_dir, indices=('NDVI', 'NBR', 'SAVI'), grid=None, block_size=1024, n_threads=4):
+    '''
+    Processes a scene block by block into memory-mapped float32 arrays (<scene id>_<index>.npy), one per vegetation index
+
+    Args:
+        scene (dict): scene from local_backend.find_scene_bands
+        work_dir (string): folder for the memory-mapped arrays
+        indices (tuple): vegetation indices to compute
+        grid (dict): target grid ('crs', 'transform', 'width', 'height') shared by every scene
+        block_size (int): block height and width in pixels
+        n_threads (int): number of threads reading band files concurrently
+
+    Returns:
+        staged (dict): .npy file path per vegetation index
+    '''
+    profile = lb.get_scene_profile(scene, grid)
+    staged = {}
+    arrays = {}
+    for veg_index in indices:
+        staged[veg_index] = os.path.join(work_dir, scene['id'] + '_' + veg_index + '.npy')
+        arrays[veg_index] = open_memmap(staged[veg_index], mode='w+', dtype='float32', shape=(profile['height'], profile['width']))
+    for window, block_indices in lb.process_scene(scene, indices, grid, block_size, n_threads):
+        for veg_index, values in block_indices.items():
+            arrays[veg_index][window.toslices()] = values
+    for array in arrays.values():
+        array.flush()
+    return staged
+
+def _stage_scene_dir(scene_dir, work_dir, indices, grid, block_size, n_threads):
+    '''
+    Worker function: stages one scene folder
+    '''
+    return stage_scene(lb.find_scene_bands(scene_dir), work_dir, indices, grid, block_size, n_threads)
+
+def median_block(files, row_start, row_stop):
+    '''
+    Per-pixel median of one block of rows over the memory-mapped scenes of a year; masked (np.nan) values are ignored
+
+    Args:
+        files (list): .npy file paths of the same vegetation index for every scene of the year
+        row_start (int): first row of the block
+        row_stop (int): last row (excluded) of the block
+
+    Returns:
+        row_start (int): first row of the block
+        composite (numpy array): float32 array (rows, cols) of the block
+    '''
+    blocks = [np.load(file, mmap_mode='r')[row_start:row_stop] for file in files]
+    if any(block.shape != blocks[0].shape for block in blocks):
+        raise ValueError("Staged scenes are not on the same grid!")
+    block = np.stack(blocks)
+    with warnings.catch_warnings():
+        # pixels masked in every scene of the year stay np.nan
+        warnings.simplefilter('ignore', RuntimeWarning)
+        composite = np.nanmedian(block, axis=0).astype('float32')
+    return row_start, composite
+
+def get_row_blocks(height, width, num_scenes, max_memory_mb=256):
+    '''
+    Splits the rows into blocks so that the stacked scenes of a block (plus a copy for the median) fit in max_memory_mb
+
+    Returns:
+        row_blocks (list): (row_start, row_stop) of each block
+    '''
+    block_rows = int(max_memory_mb * 1024**2 // (2 * num_scenes * width * 4))
+    block_rows = max(1, min(height, block_rows))
+    return [(row_start, min(row_start + block_rows, height)) for row_start in range(0, height, block_rows)]
+
+def write_composite(files, out_file, profile, executor=None, max_memory_mb=256):
+    '''
+    Writes the median composite of memory-mapped scenes to a geotiff, block of rows by block of rows
+
+    Args:
+        files (list): .npy file paths of the same vegetation index for every scene of the year
+        out_file (string): path of the composite geotiff
+        profile (dict): rasterio profile of the composite
+        executor (Executor): worker pool computing the block medians; None computes them in this process
+        max_memory_mb (int): memory budget of one block in megabytes (per worker)
+    '''
+    row_blocks = get_row_blocks(profile['height'], profile['width'], len(files), max_memory_mb)
+    with rasterio.open(out_file, 'w', **profile) as f:
+        if executor is None:
+            results = (median_block(files, row_start, row_stop) for row_start, row_stop in row_blocks)
+        else:
+            results = executor.map(median_block, *zip(*[(files, row_start, row_stop) for row_start, row_stop in row_blocks]))
+        for row_start, composite in results:
+            window = rasterio.windows.Window(0, row_start, profile['width'], composite.shape[0])
+            f.write(composite, 1, window=window)
+
+def composite_scenes(scene_dirs, out_dir, work_dir, indices=('NDVI', 'NBR', 'SAVI'), grid=None, months=(6, 9),
+                     n_workers=None, max_memory_mb=256, block_size=1024, n_threads=4, keep_staged=False):
+    '''
+    Yearly median composites of the growing-season scenes (same selection as wrappers.wrapper_VI),
+    without holding all scenes of a year in memory
+
+    Args:
+        scene_dirs (list): folders of extracted Landsat SR scenes
+        out_dir (string): folder to write the annual geotiffs to
+        work_dir (string): folder for the memory-mapped scene arrays (needs room for every scene of a year)
+        indices (tuple): vegetation indices to compute
+        grid (dict): target grid ('crs', 'transform', 'width', 'height') of every composite;
+                     None uses the grid of the first scene for the whole run (other scenes are warped to it)
+        months (tuple): first and last month of the growing season
+        n_workers (int): number of worker processes staging scenes and computing block medians
+                        (None uses every CPU, 1 runs serially)
+        max_memory_mb (int): memory budget of one median block in megabytes (per worker)
+        block_size (int): block height and width in pixels for processing the scenes
+        n_threads (int): number of threads reading band files concurrently per scene
+        keep_staged (bool): if True, keep the memory-mapped scene arrays after compositing
+
+    Returns:
+        out_files (list): annual geotiff paths
+    '''
+    for veg_index in indices:
+        if veg_index not in lb.GOOD_INDICES:
+            raise ValueError("Inappropriate vegetation index chosen!")
+
+    scenes_by_year = lb.group_scenes_by_year(scene_dirs, months)
+    if grid is None and scenes_by_year:
+        # scenes of different footprints (paths/rows, reprocessing) would not stack; one grid for every year
+        grid = lb.get_scene_grid(scenes_by_year[min(scenes_by_year)][0])
+    os.makedirs(out_dir, exist_ok=True)
+    os.makedirs(work_dir, exist_ok=True)
+
+    executor = ProcessPoolExecutor(max_workers=n_workers) if n_workers != 1 else None
+    out_files = []
+    try:
+        for year in sorted(scenes_by_year):
+            scenes = scenes_by_year[year]
+            scene_dirs_year = [os.path.dirname(scene['files']['pixel_qa']) for scene in scenes]
+            stage_args = (scene_dirs_year, [work_dir] * len(scenes), [indices] * len(scenes), [grid] * len(scenes),
+                          [block_size] * len(scenes), [n_threads] * len(scenes))
+            if executor is None:
+                staged = list(map(_stage_scene_dir, *stage_args))
+            else:
+                staged = list(executor.map(_stage_scene_dir, *stage_args))
+
+            profile = lb.get_scene_profile(scenes[0], grid)
+            for veg_index in indices:
+                out_file = lb.annual_index_filename(out_dir, year, veg_index)
+                write_composite([files[veg_index] for files in staged], out_file, profile, executor, max_memory_mb)
+                out_files.append(out_file)
+
+            if not keep_staged:
+                for files in staged:
+                    for file in files.values():
+                        os.remove(file)
+            lb.logger.info('Finished annual composite for ' + str(year) + ' (' + str(len(scenes)) + ' scenes)')
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return out_files
@@ -1,4 +1,3 @@
-from os import times_result
 import composite as cp
 import filter
 import get_VIs as vi
@@ -76,5 +75,23 @@ def wrapper_VI(prepped_LS5, prepped_LS7, prepped_LS8):
 
     # print(growing_LS.size().getInfo())
 
+def get_site_geometries(site):
+    '''
+    Earth Engine geometries of a site of the post-processing site catalog (see post_processing/site_catalog.py)
+
+    Args:
+        site (dict): catalog entry with 'aoi' (polygon rings of lon/lat coordinates) and 'filter_point' ([lon, lat])
+
+    Returns:
+        aoi (ee.Geometry.Polygon): region of interest, e.g. the export region
+        filterpoint (ee.Geometry.Point): point used to filter the Landsat collections (FILTER_POINT of wrapper_prep)
+    '''
+    aoi = ee.Geometry.Polygon(site['aoi'])
+    if site.get('filter_point') is None:
+        filterpoint = aoi.centroid()
+    else:
+        filterpoint = ee.Geometry.Point(site['filter_point'])
+    return aoi, filterpoint
+
 def test(a, b): 
     print("TESTING: ", a*b)
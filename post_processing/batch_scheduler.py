@@ -0,0 +1,249 @@
+# ======================
+# Multi-site batch scheduler
+# Runs ingest -> fit -> metrics for every (site, vegetation index) of a site catalog on one shared process pool.
+# Every job is split into row blocks of its AOI; blocks of all jobs are submitted round-robin so that sites
+# progress together, within each site's limits (blocks in flight, memory of one block) and a global memory
+# budget over all blocks in flight. Finished blocks are written straight into the metric geotiffs of their site
+# (no full AOI raster is kept in memory), and one consolidated summary (pixel counts and metric distributions
+# per site and index) is written for the batch
+# ======================
+
+import os
+import csv
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+import rasterio.windows
+import ingest_and_clean as ic
+import pipeline as pl
+import export_metrics as em
+import site_catalog as sc
+import instrumentation as instr
+
+SUMMARY_FILE = 'summary.csv'
+
+def _run_site_block(file_list, year_list, window, site):
+    '''
+    Worker function: runs clean -> mask -> fit -> metrics on one block of a site, with the site's event years
+    and parameters (module level so it can be pickled)
+
+    Returns:
+        block_metrics (dict): 2D numpy array (window height, window width) per metric
+    '''
+    image_block = ic.read_image_block(file_list, window)
+    valid_stack = ic.fused_clean_ingest(image_block, year_list, site['valid_num'], site['disturbance_factor'],
+                                        site['pre_years'], site['erup_year'])
+    stack = valid_stack.compact(valid_stack.valid)
+    metrics = pl.run_metrics_chain(stack, site['recovery_percents'], site['num_years'], site['pre_years'], site['erup_year'])
+    return pl.scatter_metrics(metrics, stack, window.height, window.width)
+
+def plan_job(site, veg_index):
+    '''
+    Prepares one (site, vegetation index) job: input files, AOI window and mask, and the row blocks of the AOI
+
+    Args:
+        site (dict): complete catalog entry (see site_catalog.validate_site)
+        veg_index (string): either 'NDVI', 'SAVI', 'NBR'
+
+    Returns:
+        job (dict): job state for run_batch
+    '''
+    file_list, year_list = ic.sort_by_year(sc.get_site_files(site, veg_index), veg_index)
+    if site['pre_years'][0] < year_list[0] or site['erup_year'] > year_list[-1]:
+        raise ValueError("Geotiffs of site " + site['name'] + " do not cover its pre-event and event years!")
+    year_list, meta, bounds = ic.get_stack_info(file_list, veg_index)
+    aoi_window, aoi_mask = sc.get_aoi_window(site['aoi'], meta)
+
+    # row blocks of the AOI within the site's memory budget, in raster coordinates
+    blocks = [Window(aoi_window.col_off, aoi_window.row_off + window.row_off, window.width, window.height)
+              for window in ic.get_block_windows(aoi_window.height, aoi_window.width, year_list, site['max_memory_mb'])]
+    full_depth = year_list[-1] - year_list[0] + 1
+    out_meta = dict(meta)
+    out_meta.update(height=aoi_window.height, width=aoi_window.width,
+                    transform=rasterio.windows.transform(aoi_window, meta['transform']))
+    return {'site': site,
+            'veg_index': veg_index,
+            'file_list': file_list,
+            'year_list': year_list,
+            'meta': out_meta,
+            'window': aoi_window,
+            'aoi_mask': aoi_mask,
+            'blocks': blocks,
+            # same block memory estimate as ingest_and_clean.get_block_windows
+            'block_mb': [window.width * window.height * full_depth * 8 * 10 / 1024**2 for window in blocks],
+            'next_block': 0,
+            'running': 0,
+            'writer': None,
+            'start': None,
+            'error': None}
+
+def summarize_metrics(out_files, aoi_mask):
+    '''
+    Pixel counts and metric distributions of one finished job, from its metric geotiffs
+    (read one metric at a time, so only one AOI raster is in memory)
+
+    Args:
+        out_files (dict): metric geotiff path per metric (see export_metrics.MetricRasterWriter)
+        aoi_mask (numpy array): 2D bool array of the AOI polygon
+
+    Returns:
+        summary (dict): 'pixels' (in the AOI), 'active' (valid and disturbed), 'qa_pass' (trend passing QA),
+                        and '<metric>_mean' / '<metric>_median' for every metric
+    '''
+    summary = {'pixels': int(aoi_mask.sum()), 'active': 0, 'qa_pass': 0}
+    for name, out_file in out_files.items():
+        with rasterio.open(out_file) as f:
+            values = f.read(1).astype(float)
+        if name == 'dVI':
+            summary['active'] = int(np.isfinite(values).sum())
+        if name == 'qa':
+            summary['qa_pass'] = int((values == 1).sum())
+            continue
+        finite = values[np.isfinite(values)]
+        summary[name + '_mean'] = float(np.mean(finite)) if finite.shape[0] else np.nan
+        summary[name + '_median'] = float(np.median(finite)) if finite.shape[0] else np.nan
+    return summary
+
+def write_summary(rows, out_file):
+    '''
+    Writes the consolidated summary of a batch to a csv file, one row per (site, vegetation index)
+    '''
+    fields = []
+    for row in rows:
+        fields += [field for field in row if field not in fields]
+    with open(out_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields, restval='')
+        writer.writeheader()
+        writer.writerows(rows)
+
+def run_batch(sites, out_dir, n_workers=None, max_memory_mb=4096, cog=True):
+    '''
+    Runs every (site, vegetation index) of a catalog on a shared process pool and writes, per site,
+    the metric geotiffs of its AOI (out_dir/<site>/<index>_<metric>.tif) and the consolidated summary
+    (out_dir/summary.csv). A failing site is reported in the summary and does not stop the other sites
+
+    Args:
+        sites (list): complete catalog entries (see site_catalog.load_catalog)
+        out_dir (string): folder to write the outputs to
+        n_workers (int): number of worker processes shared by all sites; defaults to the number of cores.
+                         1 runs serially in this process
+        max_memory_mb (int): memory budget of all blocks in flight together, in megabytes
+                             (one block is always allowed, whatever its size)
+        cog (bool): if True, write Cloud-Optimized GeoTIFFs with overviews
+
+    Returns:
+        summary (list): one dict per (site, vegetation index): 'site', 'veg_index', 'status' ('ok' or the error),
+                        'seconds' and the pixel counts and metric distributions (see summarize_metrics)
+    '''
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    os.makedirs(out_dir, exist_ok=True)
+    summary = []
+    jobs = []
+    for site in sites:
+        for veg_index in site['veg_indices']:
+            # a site that cannot be planned (missing files, AOI outside the rasters, ...) is reported, not raised
+            try:
+                jobs.append(plan_job(site, veg_index))
+            except Exception as error:
+                summary.append({'site': site['name'], 'veg_index': veg_index, 'status': repr(error), 'seconds': 0.})
+    instr.log('Batch jobs: ', len(jobs), ', workers: ', n_workers)
+
+    def add_block(job, window, block_metrics):
+        # written straight into the job's geotiffs, in AOI coordinates, with the pixels outside the AOI polygon masked
+        row_start = window.row_off - job['window'].row_off
+        outside = ~job['aoi_mask'][row_start:row_start + window.height]
+        if job['writer'] is None:
+            job['writer'] = em.MetricRasterWriter(job['meta'], os.path.join(out_dir, job['site']['name']), job['veg_index'], cog=cog)
+        for values in block_metrics.values():
+            values[outside] = np.nan
+        job['writer'].write(Window(0, row_start, window.width, window.height), block_metrics)
+
+    def finish(job):
+        site, veg_index = job['site'], job['veg_index']
+        row = {'site': site['name'], 'veg_index': veg_index, 'status': 'ok'}
+        if job['error'] is None:
+            try:
+                row.update(summarize_metrics(job['writer'].close(), job['aoi_mask']))
+            except Exception as error:
+                job['error'] = error
+        if job['error'] is not None:
+            row['status'] = repr(job['error'])
+            if job['writer'] is not None:
+                job['writer'].abort()
+        row['seconds'] = time.perf_counter() - job['start'] if job['start'] is not None else 0.
+        job['writer'] = None
+        summary.append(row)
+        instr.log('Finished site ', site['name'], ' ', veg_index, ': ', row['status'])
+
+    with instr.stage('batch'):
+        if n_workers == 1:
+            for job in jobs:
+                job['start'] = time.perf_counter()
+                try:
+                    for window in job['blocks']:
+                        add_block(job, window, _run_site_block(job['file_list'], job['year_list'], window, job['site']))
+                except Exception as error:
+                    job['error'] = error
+                finish(job)
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                running = {}
+                memory_used = 0.
+                while True:
+                    # round-robin over the jobs, one block per job per pass, within the limits
+                    submitted = True
+                    while submitted and len(running) < n_workers:
+                        submitted = False
+                        for job in jobs:
+                            if len(running) >= n_workers:
+                                break
+                            if job['error'] is not None or job['next_block'] == len(job['blocks']):
+                                continue
+                            block_mb = job['block_mb'][job['next_block']]
+                            if job['running'] >= job['site']['max_workers'] or (running and memory_used + block_mb > max_memory_mb):
+                                continue
+                            window = job['blocks'][job['next_block']]
+                            future = executor.submit(_run_site_block, job['file_list'], job['year_list'], window, job['site'])
+                            running[future] = (job, window, block_mb)
+                            if job['start'] is None:
+                                job['start'] = time.perf_counter()
+                            job['next_block'] += 1
+                            job['running'] += 1
+                            memory_used += block_mb
+                            submitted = True
+                    if not running:
+                        break
+
+                    done = wait(running, return_when=FIRST_COMPLETED)[0]
+                    for future in done:
+                        job, window, block_mb = running.pop(future)
+                        job['running'] -= 1
+                        memory_used -= block_mb
+                        try:
+                            add_block(job, window, future.result())
+                        except Exception as error:
+                            # the remaining blocks of a failed job are not submitted
+                            job['error'] = error
+                        if job['running'] == 0 and (job['error'] is not None or job['next_block'] == len(job['blocks'])):
+                            finish(job)
+
+    # catalog order, whatever order the jobs finished in
+    order = [(site['name'], veg_index) for site in sites for veg_index in site['veg_indices']]
+    summary.sort(key=lambda row: order.index((row['site'], row['veg_index'])))
+    write_summary(summary, os.path.join(out_dir, SUMMARY_FILE))
+    return summary
+
+def run_catalog(catalog_file, out_dir, site_names=None, n_workers=None, max_memory_mb=4096, cog=True):
+    '''
+    Runs the sites of a json catalog (all of them, or only site_names) through run_batch
+
+    Example:
+        summary = run_catalog('volcanoes.json', 'out', site_names=['Unzen', 'Merapi'], n_workers=8)
+    '''
+    sites = sc.load_catalog(catalog_file)
+    if site_names is not None:
+        sites = [sc.get_site(name, sites) for name in site_names]
+    return run_batch(sites, out_dir, n_workers, max_memory_mb, cog)
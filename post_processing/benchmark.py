@@ -0,0 +1,215 @@
+# ======================
+# Benchmark suite for the post-processing chain
+# 1. Synthetic yearly vegetation index geotiffs (same naming as the Google Drive exports read by create_image_stack),
+#    with configurable size, missing years, nan fraction and eruption signal
+# 2. Wall time and peak memory (tracemalloc) of every stage of the original chain
+# 3. Scaling curves against pixel count and series length
+# 4. Baselines saved as json and compared against later runs
+# ======================
+
+import os
+import json
+import time
+import platform
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+import matplotlib.pyplot as plt
+import ingest_and_clean as ic
+import trend_fitting as tf
+import recovery_metrics as rm
+import preliminary_values as pv
+import instrumentation as instr
+from pixel_stack import ERUPTION_YEAR
+
+# ======================
+# Synthetic Landsat stack generator
+# ======================
+def make_synthetic_stack(out_dir, height=100, width=100, first_year=1984, last_year=2021, missing_years=(1990, 2003),
+                         veg_index='NBR', nan_fraction=0.2, disturbed_fraction=0.7, severity=0.8, recovery_rate=0.15,
+                         noise=0.03, erup_year=ERUPTION_YEAR, seed=0):
+    '''
+    Writes one geotiff per year (e.g., LS_19850601_NBR.tif) with a synthetic eruption signal:
+    stable pre-eruption values, a drop of severity * VIpre at the eruption year for the disturbed pixels,
+    then linear-log recovery (VIpre * (1 - severity) + recovery_rate * log10(years since eruption))
+
+    Args:
+        out_dir (string): folder to write the geotiffs to
+        height (int): raster height
+        width (int): raster width
+        first_year (int): first year of the series
+        last_year (int): last year of the series
+        missing_years (tuple): years without a geotiff (gaps in the series)
+        veg_index (string): either 'NDVI', 'SAVI', 'NBR'
+        nan_fraction (float): fraction of pixels set to np.nan in every year (clouds, gaps)
+        disturbed_fraction (float): fraction of pixels disturbed by the eruption
+        severity (float): relative drop of the vegetation index at the eruption year
+        recovery_rate (float): slope of the linear-log recovery
+        noise (float): standard deviation of the gaussian noise
+        erup_year (int): eruption year
+        seed (int): random seed
+
+    Returns:
+        file_list (list): geotiff paths in year order
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    veg_pre = rng.uniform(0.3, 0.7, (height, width))
+    disturbed = rng.random((height, width)) < disturbed_fraction
+    profile = {'driver': 'GTiff', 'height': height, 'width': width, 'count': 1, 'dtype': 'float32',
+               'crs': 'EPSG:32652', 'transform': from_origin(600000, 3630000, 30, 30), 'nodata': np.nan}
+
+    file_list = []
+    for year in range(first_year, last_year + 1):
+        if year in missing_years:
+            continue
+        values = veg_pre + rng.normal(0, noise, (height, width))
+        if year >= erup_year:
+            recovery = veg_pre * (1 - severity) + recovery_rate * np.log10(max(year - erup_year, 1))
+            values = np.where(disturbed, recovery + rng.normal(0, noise, (height, width)), values)
+        values[rng.random((height, width)) < nan_fraction] = np.nan
+        file = os.path.join(out_dir, 'LS_' + str(year) + '0601_' + veg_index + '.tif')
+        with rasterio.open(file, 'w', **profile) as f:
+            f.write(values.astype('float32'), 1)
+        file_list.append(file)
+    return file_list
+
+# ======================
+# Stage timing
+# ======================
+def time_stage(results, name, func, *args, **kwargs):
+    '''
+    Runs func(*args, **kwargs) once, recording wall time (s) and peak traced memory (MB) under results[name]
+
+    Returns:
+        output: output of func
+    '''
+    # does not stop the tracing of an enabled instrumentation run
+    with instr.trace_peak() as traced:
+        start = time.perf_counter()
+        output = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+    results[name] = {'seconds': seconds, 'peak_mb': traced['peak_mb']}
+    return output
+
+def benchmark_chain(file_list, veg_index='NBR', recovery_percents=(0.2, 0.8), num_years=5):
+    '''
+    Times every stage of the original chain (as run in main_jupyter.ipynb) on one stack of geotiffs
+
+    Args:
+        file_list (list): list of file paths to geotiffs of vegetation indices
+        veg_index (string): either 'NDVI', 'SAVI', 'NBR'
+        recovery_percents (tuple): recovery percentages to time numyears_from_trend for
+        num_years (int): number of years post-disturbance regrowth for abs_regrowth
+
+    Returns:
+        results (dict): {'seconds', 'peak_mb'} per stage, plus 'pixels' and 'years' of the stack
+    '''
+    results = {}
+    image_stack, year_list, stack_depth, meta, bounds = time_stage(results, 'create_image_stack', ic.create_image_stack, file_list, veg_index)
+    full_image_stack = time_stage(results, 'add_missing_years', ic.add_missing_years, image_stack, year_list)
+    val_pix_reshaped = time_stage(results, 'clean_data', ic.clean_data, full_image_stack)
+    veg_withyears = time_stage(results, 'reshape_image_stack', ic.reshape_image_stack, full_image_stack, year_list)
+    disturbed_veg_arr, only_years, only_veg_ind = time_stage(results, 'get_disturbed_pixel_array', ic.get_disturbed_pixel_array,
+                                                             veg_withyears, year_list)
+    valid_veg_arr = time_stage(results, 'get_valid_pixel_filter', ic.get_valid_pixel_filter, val_pix_reshaped, disturbed_veg_arr)
+    valid_veg_withyears = time_stage(results, 'get_valid_image_stack', ic.get_valid_image_stack, valid_veg_arr, only_years, only_veg_ind)
+
+    fit_result = time_stage(results, 'trend_fit', tf.trend_fit, valid_veg_withyears)
+    dVI = time_stage(results, 'get_dVI', pv.get_dVI, valid_veg_withyears)
+    time_stage(results, 'get_slope', rm.get_slope, fit_result)
+    abs_regrowth = time_stage(results, 'abs_regrowth', rm.abs_regrowth, fit_result, num_years)
+    time_stage(results, 'rel_regrowth', rm.rel_regrowth, fit_result, abs_regrowth, dVI)
+    for recovery_percent in recovery_percents:
+        time_stage(results, 'numyears_from_trend_' + str(int(round(recovery_percent * 100))), rm.numyears_from_trend,
+                   valid_veg_withyears, fit_result, recovery_percent)
+
+    results['pixels'] = int(meta['height'] * meta['width'])
+    results['years'] = int(full_image_stack.shape[2])
+    return results
+
+# ======================
+# Scaling curves
+# ======================
+def run_scaling(work_dir, sizes=(50, 100, 200), series_lengths=(20, 30, 38), veg_index='NBR', seed=0):
+    '''
+    Benchmarks the chain on synthetic stacks of growing pixel count (square rasters of each size, full series)
+    and of growing series length (largest size, series ending at each length)
+
+    Args:
+        work_dir (string): folder to write the synthetic geotiffs to
+        sizes (tuple): raster heights/widths
+        series_lengths (tuple): number of years in the series, starting in 1984 (must include the pre-eruption
+                                and eruption years, i.e. at least 12)
+        veg_index (string): either 'NDVI', 'SAVI', 'NBR'
+        seed (int): random seed
+
+    Returns:
+        scaling (dict): 'pixels' and 'years' lists of benchmark_chain results
+    '''
+    scaling = {'pixels': [], 'years': []}
+    for size in sizes:
+        file_list = make_synthetic_stack(os.path.join(work_dir, 'size_' + str(size)), size, size, veg_index=veg_index, seed=seed)
+        scaling['pixels'].append(benchmark_chain(file_list, veg_index))
+    for series_length in series_lengths:
+        file_list = make_synthetic_stack(os.path.join(work_dir, 'years_' + str(series_length)), sizes[-1], sizes[-1],
+                                         last_year=1984 + series_length - 1, veg_index=veg_index, seed=seed)
+        scaling['years'].append(benchmark_chain(file_list, veg_index))
+    return scaling
+
+def plot_scaling(scaling, out_file=None):
+    '''
+    Plots the wall time of every stage against pixel count and against series length
+    '''
+    fig, axes = plt.subplots(1, 2, figsize=(12, 5))
+    for ax, axis in zip(axes, ['pixels', 'years']):
+        runs = scaling[axis]
+        stages = [name for name in runs[0] if isinstance(runs[0][name], dict)]
+        for stage in stages:
+            ax.plot([run[axis] for run in runs], [run[stage]['seconds'] for run in runs], marker='o', label=stage)
+        ax.set_xlabel(axis)
+        ax.set_ylabel('seconds')
+        ax.set_yscale('log')
+    axes[1].legend(fontsize='small')
+    if out_file is not None:
+        fig.savefig(out_file)
+    return fig
+
+# ======================
+# Baselines for regression comparison
+# ======================
+def save_baseline(scaling, path):
+    '''
+    Saves the results of run_scaling (with the machine they ran on) as json
+    '''
+    baseline = {'machine': platform.platform(), 'python': platform.python_version(), 'numpy': np.__version__,
+                'scaling': scaling}
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=1)
+
+def compare_to_baseline(scaling, path, tolerance=0.2):
+    '''
+    Compares the results of run_scaling with a saved baseline, run by run and stage by stage
+
+    Args:
+        scaling (dict): results of run_scaling (same sizes and series lengths as the baseline)
+        path (string): baseline json file
+        tolerance (float): relative slowdown / memory increase reported as a regression
+
+    Returns:
+        regressions (list): (axis, run size, stage, metric, baseline value, new value) of every regression
+    '''
+    with open(path) as f:
+        baseline = json.load(f)['scaling']
+    regressions = []
+    for axis in ['pixels', 'years']:
+        for old_run, new_run in zip(baseline[axis], scaling[axis]):
+            for stage, old_values in old_run.items():
+                if not isinstance(old_values, dict) or stage not in new_run:
+                    continue
+                for metric in ['seconds', 'peak_mb']:
+                    if new_run[stage][metric] > old_values[metric] * (1 + tolerance):
+                        regressions.append((axis, old_run[axis], stage, metric, old_values[metric], new_run[stage][metric]))
+    for regression in regressions:
+        print('regression: ', regression)
+    return regressions
@@ -0,0 +1,131 @@
+# ======================
+# Persistent on-disk cache of the annual vegetation index cube
+# The gap-filled (height, width, years) stack is stored as a memory-mapped .npy file with a json manifest
+# holding the year index, raster meta/bounds and a fingerprint (path, mtime, size) of the input geotiffs.
+# The cache is rebuilt automatically whenever the input files change.
+# ======================
+
+import os
+import json
+import hashlib
+import numpy as np
+from affine import Affine
+from rasterio.crs import CRS
+from rasterio.coords import BoundingBox
+import ingest_and_clean as ic
+import instrumentation as instr
+
+CUBE_FILE = 'cube.npy'
+MANIFEST_FILE = 'manifest.json'
+
+def get_fingerprint(files):
+    '''
+    Fingerprint of the input geotiffs used to invalidate the cache
+
+    Args:
+        files (list): list of file paths
+
+    Returns:
+        fingerprint (list): [absolute path, mtime (ns), size (bytes)] for each file, sorted by path
+    '''
+    fingerprint = []
+    for file in files:
+        stat = os.stat(file)
+        fingerprint.append([os.path.abspath(file), stat.st_mtime_ns, stat.st_size])
+    return sorted(fingerprint)
+
+def get_cache_path(files, extension, cache_dir):
+    '''
+    Folder holding the cached cube of a set of input files (keyed by vegetation index and file paths)
+    '''
+    key = json.dumps([extension] + sorted(os.path.abspath(file) for file in files))
+    return os.path.join(cache_dir, extension + '_' + hashlib.sha1(key.encode()).hexdigest()[:16])
+
+def open_cached_stack(files, extension, cache_dir, max_memory_mb=512):
+    """
+    Opens the gap-filled image stack from the cache, building (or rebuilding) the cache first
+    if it does not exist or the input files changed
+
+    Args:
+        files (list): list of file paths
+        extension (string): 'NDVI', 'NBR', 'SAVI'
+        cache_dir (string): folder to keep cached cubes in
+        max_memory_mb (int): memory budget in megabytes for the blocks read while building the cache
+
+    Returns:
+        full_image_stack (numpy memmap): read-only (height, width, years) stack without any missing years
+        yearly_years (list): full list of years in the stack
+        meta (dict): meta data for raster file
+        bounds: bounds for raster file
+    """
+    cache_path = get_cache_path(files, extension, cache_dir)
+    manifest = _read_manifest(cache_path)
+    if manifest is None or manifest['fingerprint'] != get_fingerprint(files):
+        instr.log('Building image stack cache in ' + cache_path + '...')
+        manifest = _build_cache(files, extension, cache_path, max_memory_mb)
+
+    full_image_stack = np.load(os.path.join(cache_path, CUBE_FILE), mmap_mode='r')
+    meta = decode_meta(manifest['meta'])
+    bounds = BoundingBox(*manifest['bounds'])
+    return full_image_stack, manifest['yearly_years'], meta, bounds
+
+def encode_meta(meta):
+    '''
+    JSON-serializable copy of raster meta data (crs as WKT, transform as a list of 6 coefficients)
+    '''
+    meta = dict(meta)
+    meta['crs'] = meta['crs'].to_wkt() if meta['crs'] else None
+    meta['transform'] = list(meta['transform'])[:6]
+    return meta
+
+def decode_meta(meta):
+    '''
+    Raster meta data from its JSON-serializable copy (see encode_meta)
+    '''
+    meta = dict(meta)
+    meta['crs'] = CRS.from_wkt(meta['crs']) if meta['crs'] else None
+    meta['transform'] = Affine(*meta['transform'])
+    return meta
+
+def _read_manifest(cache_path):
+    '''
+    Returns the cache manifest, or None if the cache is missing or incomplete
+    '''
+    manifest_path = os.path.join(cache_path, MANIFEST_FILE)
+    if not os.path.exists(manifest_path) or not os.path.exists(os.path.join(cache_path, CUBE_FILE)):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+def _build_cache(files, extension, cache_path, max_memory_mb):
+    '''
+    Writes the gap-filled image stack to the cache block by block, then the manifest.
+    The manifest is written last so that an interrupted build is never read as a valid cache.
+    '''
+    os.makedirs(cache_path, exist_ok=True)
+    manifest_path = os.path.join(cache_path, MANIFEST_FILE)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+    fingerprint = get_fingerprint(files)
+    year_list, meta, bounds = ic.get_stack_info(files, extension)
+    yearly_years = [year for year in range(year_list[0], year_list[-1] + 1)]
+
+    tmp_path = os.path.join(cache_path, CUBE_FILE + '.tmp')
+    cube = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float64,
+                                    shape=(meta['height'], meta['width'], len(yearly_years)))
+    for window in ic.get_block_windows(meta['height'], meta['width'], year_list, max_memory_mb, copies=2):
+        image_block = ic.read_image_block(files, window)
+        cube[window.toslices()] = ic.add_missing_years(image_block, year_list)
+    cube.flush()
+    del cube
+    os.replace(tmp_path, os.path.join(cache_path, CUBE_FILE))
+
+    manifest = {'fingerprint': fingerprint,
+                'year_list': year_list,
+                'yearly_years': yearly_years,
+                'meta': encode_meta(meta),
+                'bounds': list(bounds)}
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+    return manifest
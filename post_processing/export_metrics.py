@@ -0,0 +1,157 @@
+# ======================
+# Streaming writer of recovery-metric rasters as tiled, compressed Cloud-Optimized GeoTIFFs (COGs)
+# Metric blocks are written to disk as they are produced (see pipeline.iter_windowed / tiled_executor.iter_tiled),
+# so the full-size metric rasters are never assembled in memory
+# ======================
+
+import os
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+import ingest_and_clean as ic
+import tiled_executor as te
+import instrumentation as instr
+
+def get_metric_profile(meta, blocksize=256, compress='deflate'):
+    '''
+    Rasterio profile of a single-band, tiled, compressed float32 metric raster with the georeferencing of meta
+
+    Args:
+        meta (dict): meta data for the vegetation index raster files
+        blocksize (int): tile size of the geotiff (multiple of 16)
+        compress (string): compression of the geotiff
+
+    Returns:
+        profile (dict): rasterio profile
+    '''
+    profile = dict(meta)
+    profile.update(driver='GTiff', count=1, dtype='float32', nodata=np.nan, tiled=True,
+                   blockxsize=blocksize, blockysize=blocksize, compress=compress, BIGTIFF='IF_SAFER')
+    return profile
+
+def write_metric_rasters(block_iter, meta, out_dir, prefix, blocksize=256, compress='deflate', cog=True):
+    '''
+    Writes each metric of a stream of (window, block_metrics) pairs to its own georeferenced geotiff, block by block.
+    Once every block is written, overviews are added and the geotiffs are rewritten with the COG layout
+
+    Args:
+        block_iter (iterable): (window, block_metrics) pairs, as yielded by pipeline.iter_windowed or tiled_executor.iter_tiled
+        meta (dict): meta data for the vegetation index raster files
+        out_dir (string): folder to write the geotiffs to
+        prefix (string): prefix of the file names, e.g. 'NBR' -> NBR_slope.tif
+        blocksize (int): tile size of the geotiff (multiple of 16)
+        compress (string): compression of the geotiff
+        cog (bool): if True, build overviews and rewrite as Cloud-Optimized GeoTIFFs
+
+    Returns:
+        out_files (dict): file path per metric
+    '''
+    writer = MetricRasterWriter(meta, out_dir, prefix, blocksize, compress, cog)
+    try:
+        for window, block_metrics in block_iter:
+            writer.write(window, block_metrics)
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.close()
+
+class MetricRasterWriter:
+    '''
+    Open metric geotiffs that blocks are written to as they arrive, in any order (see write_metric_rasters)
+
+    Args:
+        see write_metric_rasters
+    '''
+    def __init__(self, meta, out_dir, prefix, blocksize=256, compress='deflate', cog=True):
+        os.makedirs(out_dir, exist_ok=True)
+        self.profile = get_metric_profile(meta, blocksize, compress)
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.blocksize = blocksize
+        self.compress = compress
+        self.cog = cog
+        self.datasets = {}
+        self.out_files = {}
+
+    def write(self, window, block_metrics):
+        '''
+        Writes one block of every metric to its window of the geotiffs
+        '''
+        for name, values in block_metrics.items():
+            if name not in self.datasets:
+                self.out_files[name] = os.path.join(self.out_dir, self.prefix + '_' + name + '.tif')
+                path = self.out_files[name] + '.tmp.tif' if self.cog else self.out_files[name]
+                self.datasets[name] = rasterio.open(path, 'w', **self.profile)
+            self.datasets[name].write(values.astype('float32'), 1, window=window)
+
+    def _close_datasets(self):
+        for dataset in self.datasets.values():
+            dataset.close()
+        self.datasets = {}
+
+    def close(self):
+        '''
+        Closes the geotiffs (rewritten as COGs with overviews if cog)
+
+        Returns:
+            out_files (dict): file path per metric
+        '''
+        self._close_datasets()
+        if self.cog:
+            for name, out_file in self.out_files.items():
+                _to_cog(out_file + '.tmp.tif', out_file, self.blocksize, self.compress)
+        instr.log('Finished writing ' + str(len(self.out_files)) + ' metric rasters to ' + self.out_dir)
+        return self.out_files
+
+    def abort(self):
+        '''
+        Closes and removes the partially written geotiffs
+        '''
+        self._close_datasets()
+        for out_file in self.out_files.values():
+            for path in (out_file + '.tmp.tif', out_file):
+                if os.path.exists(path):
+                    os.remove(path)
+        self.out_files = {}
+
+def _to_cog(tmp_file, out_file, blocksize, compress):
+    '''
+    Adds overviews to a tiled geotiff, then copies it with the overviews in front (COG layout)
+    '''
+    with rasterio.open(tmp_file, 'r+') as dataset:
+        factors = []
+        factor = 2
+        while max(dataset.height, dataset.width) / factor >= blocksize:
+            factors.append(factor)
+            factor *= 2
+        if factors:
+            dataset.build_overviews(factors, Resampling.average)
+    rasterio.shutil.copy(tmp_file, out_file, driver='GTiff', tiled=True, blockxsize=blocksize, blockysize=blocksize,
+                         compress=compress, copy_src_overviews=True, BIGTIFF='IF_SAFER')
+    os.remove(tmp_file)
+
+def export_metrics(file_list, veg_index, out_dir, n_workers=1, tile_size=512, recovery_percents=(0.2, 0.8), num_years=5, cog=True,
+                   blocksize=256, compress='deflate'):
+    '''
+    Runs the full chain tile by tile (see tiled_executor) and streams the metric tiles into geotiffs
+    (slope, abs/rel regrowth, years to recovery, dVI and fit QA)
+
+    Args:
+        file_list (list): list of file paths to geotiffs of vegetation indices
+        veg_index (string): either 'NDVI', 'SAVI', 'NBR'
+        out_dir (string): folder to write the geotiffs to
+        n_workers (int): number of worker processes (1 runs serially)
+        tile_size (int): tile height and width in pixels; a multiple of 256 lines tiles up with the geotiff blocks
+        recovery_percents (tuple): recovery percentages (0 to 1) to get the number of years to recovery for
+        num_years (int): number of years post-disturbance regrowth for the regrowth metrics
+        cog (bool): if True, write Cloud-Optimized GeoTIFFs with overviews
+        blocksize (int): tile size of the geotiff (multiple of 16)
+        compress (string): compression of the geotiff
+
+    Returns:
+        out_files (dict): file path per metric
+    '''
+    year_list, meta, bounds = ic.get_stack_info(file_list, veg_index)
+    tile_iter = te.iter_tiled(file_list, veg_index, n_workers, tile_size, recovery_percents, num_years)
+    return write_metric_rasters(tile_iter, meta, out_dir, veg_index, blocksize, compress, cog)
@@ -4,21 +4,33 @@
 # ======================
 
 # import modules 
+import numpy as np
 import ingest_and_clean as ic
+import cube_cache
+import instrumentation as instr
 import matplotlib.pyplot as plt
 
 # ======================
 # Wrapper function for data ingesting and cleaning 
 # ======================
-def wrapper_clean_ingest(file_list, veg_index): 
+def wrapper_clean_ingest(file_list, veg_index, cache_dir=None, return_stack=False, sparse=False, fused=False): 
     '''
     Args: 
         file_list (list): list of file paths to geotiffs of vegetation indices
         veg_index (string): either 'NDVI', 'SAVI', 'NBR'
+        cache_dir (string): optional folder for the on-disk image stack cache (see cube_cache). 
+                            If given, the stack is read from the cache instead of the geotiffs when the files are unchanged, 
+                            chunk by chunk through the fused kernel. This saves the geotiff decode, but this path is 
+                            not out-of-core: the cleaned output still holds every pixel in memory. 
+                            Use wrapper_clean_ingest_windowed(cache_dir=...) to stay within a memory budget
+        return_stack (bool): if True, return a PixelStack (values with one shared year axis and the raster meta/bounds) 
+                            instead of the years-plus-values array
+        sparse (bool): if True, return a compacted PixelStack holding only the valid, disturbed pixels (see PixelStack.compact)
+        fused (bool): if True, clean with the single-pass kernel ingest_and_clean.fused_clean_ingest (same outputs, less memory)
 
     Returns: 
         valid_veg_withyears (numpy array): 3D numpy array where [:, :, 0] is the flattened yearly vegetation index values, and 
-        [:, :, 1] is the years repeated along axis1
+        [:, :, 1] is the years repeated along axis1 (or a PixelStack if return_stack is True)
     '''
     # Check for valid vegetation index
     
@@ -27,7 +39,39 @@ def wrapper_clean_ingest(file_list, veg_index):
         raise ValueError("Inappropriate vegetation index chosen!")
 
     # create numpy image stack
-    image_stack, year_list, stack_depth, meta, bounds = ic.create_image_stack(file_list, veg_index)
+    if cache_dir is not None: 
+        image_stack, year_list, meta, bounds = cube_cache.open_cached_stack(file_list, veg_index, cache_dir)
+        # the fused kernel reads the memmap chunk by chunk instead of copying the whole cube 
+        # (add_missing_years and reshape_image_stack would each load a full copy)
+        fused = True
+    else: 
+        image_stack, year_list, stack_depth, meta, bounds = ic.create_image_stack(file_list, veg_index)
+
+    return clean_ingest_stack(image_stack, year_list, meta, bounds, return_stack, sparse, fused)
+
+def clean_ingest_stack(image_stack, year_list, meta=None, bounds=None, return_stack=False, sparse=False, fused=False): 
+    '''
+    Runs the cleaning chain on an image stack that has already been read (either the full raster or one block of it)
+
+    Args: 
+        image_stack (numpy array): ndarray stack of yearly vegetation indices
+        year_list (list): list of years in image stack (potentially missing some years)
+        meta (dict): meta data for raster file (only kept on the PixelStack)
+        bounds: bounds for raster file (only kept on the PixelStack)
+        return_stack (bool): if True, return a PixelStack instead of the years-plus-values array
+        sparse (bool): if True, return a compacted PixelStack of only the valid, disturbed pixels
+        fused (bool): if True, clean with the single-pass kernel ingest_and_clean.fused_clean_ingest
+
+    Returns: 
+        valid_veg_withyears (numpy array or PixelStack): cleaned stack (see wrapper_clean_ingest)
+    '''
+    if fused: 
+        valid_stack = ic.fused_clean_ingest(image_stack, year_list, meta=meta, bounds=bounds)
+        if sparse: 
+            return valid_stack.compact(valid_stack.valid)
+        if return_stack: 
+            return valid_stack
+        return valid_stack.to_withyears()
 
     # Add missing years of np.nan arrays to original image stack
     full_image_stack = ic.add_missing_years(image_stack, year_list)
@@ -36,6 +80,16 @@ def wrapper_clean_ingest(file_list, veg_index):
     # 
     val_pix_reshaped = ic.clean_data(full_image_stack)
 
+    if return_stack or sparse: 
+        # flatten without repeating the years, then mask by disturbed and valid pixels
+        stack = ic.build_pixel_stack(full_image_stack, year_list, meta, bounds)
+        disturbed_veg_arr, only_years, only_veg_ind = ic.get_disturbed_pixel_array(stack, year_list)
+        valid_veg_arr = ic.get_valid_pixel_filter(val_pix_reshaped, disturbed_veg_arr)
+        if sparse: 
+            # gather only the active pixels into a dense stack
+            return stack.compact(valid_veg_arr)
+        return ic.get_valid_image_stack(valid_veg_arr, stack)
+
     # Reshape data set to apply regression
     valid_veg_index_withyears = ic.reshape_image_stack(full_image_stack, year_list)
 
@@ -51,4 +105,65 @@ def wrapper_clean_ingest(file_list, veg_index):
     # get complete cleaned dataset
     valid_veg_withyears = ic.get_valid_image_stack(valid_veg_arr, only_years, only_veg_ind)
 
-    return valid_veg_withyears
\ No newline at end of file
+    return valid_veg_withyears
+
+# ======================
+# Windowed wrapper function for memory-bounded data ingesting and cleaning
+# ======================
+def wrapper_clean_ingest_windowed(file_list, veg_index, max_memory_mb=512, sparse=False, cache_dir=None): 
+    '''
+    Same as wrapper_clean_ingest, but reads and cleans the geotiffs one spatial block at a time 
+    so that only one block of the image stack is held in memory
+
+    Args: 
+        file_list (list): list of file paths to geotiffs of vegetation indices
+        veg_index (string): either 'NDVI', 'SAVI', 'NBR'
+        max_memory_mb (int): memory budget for one block in megabytes
+        sparse (bool): if True, yield compacted PixelStacks of only the valid, disturbed pixels
+        cache_dir (string): optional folder for the on-disk image stack cache (see cube_cache); 
+                            if given, the blocks are sliced from the cached memmap instead of read from the geotiffs
+
+    Yields: 
+        window (rasterio Window): window of the block in the raster
+        valid_veg_withyears (numpy array): cleaned stack of the block's pixels (flattened row by row)
+    '''
+    good_veg_index = ['NBR', 'NDVI', 'SAVI']
+    if veg_index not in good_veg_index: 
+        raise ValueError("Inappropriate vegetation index chosen!")
+
+    if cache_dir is not None: 
+        cube, year_list, meta, bounds = cube_cache.open_cached_stack(file_list, veg_index, cache_dir)
+    else: 
+        year_list, meta, bounds = ic.get_stack_info(file_list, veg_index)
+    for window in ic.get_block_windows(meta['height'], meta['width'], year_list, max_memory_mb): 
+        if cache_dir is not None: 
+            # only this block of the memmap is loaded (already gap-filled, so year_list is the full list of years)
+            image_block = np.asarray(cube[window.toslices()])
+        else: 
+            image_block = ic.read_image_block(file_list, window)
+        yield window, clean_ingest_stack(image_block, year_list, sparse=sparse, fused=True)
+
+# ======================
+# Peak memory of the original cleaning chain vs the fused kernel
+# ======================
+def compare_ingest_memory(image_stack, year_list): 
+    '''
+    Runs the original (six pass) cleaning chain and the fused kernel on the same image stack with tracemalloc, 
+    and reports the peak memory allocated by each
+
+    Args: 
+        image_stack (numpy array): ndarray stack of yearly vegetation indices
+        year_list (list): list of years in image stack (potentially missing some years)
+
+    Returns: 
+        peak_memory (dict): peak allocated megabytes for 'original' and 'fused'
+    '''
+    peak_memory = {}
+    for name, fused in [('original', False), ('fused', True)]: 
+        # does not stop the tracing of an enabled instrumentation run
+        with instr.trace_peak() as traced: 
+            valid_veg = clean_ingest_stack(image_stack, year_list, return_stack=fused, fused=fused)
+        peak_memory[name] = traced['peak_mb']
+        del valid_veg
+    print('peak memory (MB) original: ', peak_memory['original'], ' fused: ', peak_memory['fused'])
+    return peak_memory
@@ -0,0 +1,186 @@
+# ======================
+# Incremental trend fitting: adds one new year of imagery without rerunning the whole chain
+# The per-pixel regression sufficient statistics (n, sum x, sum x^2, sum y, sum y^2, sum xy over the log-year axis)
+# are persisted with the nan count, pre-eruption value and dVI of every valid, disturbed pixel.
+# Appending a year only reads the new geotiff and updates the sums, fits and recovery metrics in O(pixels)
+# ======================
+
+import os
+import json
+import numpy as np
+from rasterio.coords import BoundingBox
+import rasterio
+import ingest_and_clean as ic
+import trend_fitting as tf
+import recovery_metrics as rm
+import preliminary_values as pv
+import pipeline
+import cube_cache
+import instrumentation as instr
+from pixel_stack import pre_eruption_average, PRE_ERUPTION_YEARS, ERUPTION_YEAR
+
+STATE_FILE = 'state.npz'
+MANIFEST_FILE = 'manifest.json'
+SUM_NAMES = ['n', 'sx', 'sxx', 'sy', 'syy', 'sxy']
+
+def init_state(file_list, veg_index, state_dir, valid_num=20, disturbance_factor=0.2, pre_years=PRE_ERUPTION_YEARS,
+               erup_year=ERUPTION_YEAR, recovery_percents=(0.2, 0.8), num_years=5, max_memory_mb=512):
+    '''
+    Runs the full chain once, block by block, and persists the per-pixel state needed to append later years
+
+    Args:
+        file_list (list): list of file paths to geotiffs of vegetation indices
+        veg_index (string): either 'NDVI', 'SAVI', 'NBR'
+        state_dir (string): folder to keep the state in
+        valid_num (int): pixels with valid_num or more nans are invalid (see ingest_and_clean.clean_data)
+        disturbance_factor (float): disturbance threshold (see ingest_and_clean.get_disturbed_pixel_array)
+        pre_years (tuple): the two pre-eruption years
+        erup_year (int): eruption year
+        recovery_percents (tuple): recovery percentages (0 to 1) to get the number of years to recovery for
+        num_years (int): number of years post-disturbance regrowth for the regrowth metrics
+        max_memory_mb (int): memory budget for one block in megabytes
+
+    Returns:
+        metrics (dict): 2D numpy array (height, width) per metric (see pipeline.run_metrics_chain)
+    '''
+    good_veg_index = ['NBR', 'NDVI', 'SAVI']
+    if veg_index not in good_veg_index:
+        raise ValueError("Inappropriate vegetation index chosen!")
+
+    year_list, meta, bounds = ic.get_stack_info(file_list, veg_index)
+    blocks = []
+    for window in ic.get_block_windows(meta['height'], meta['width'], year_list, max_memory_mb):
+        image_block = ic.read_image_block(file_list, window)
+        valid_stack = ic.fused_clean_ingest(image_block, year_list, valid_num, disturbance_factor, pre_years, erup_year)
+        stack = valid_stack.compact(valid_stack.valid)
+
+        # flat index of the block's active pixels in the full raster
+        rows, cols = np.divmod(stack.index, window.width)
+        index = (rows + window.row_off) * meta['width'] + cols + window.col_off
+
+        post_erup_stack = stack.since(erup_year)
+        sums = tf._regression_sums(post_erup_stack, tf.log_year_axis(post_erup_stack.shape[1]))
+        block = {'index': index,
+                 'nan_count': np.count_nonzero(np.isnan(stack.values), axis=1),
+                 'veg_pre': pre_eruption_average(stack, pre_years),
+                 'dVI': pv.get_dVI(stack, pre_years, erup_year)}
+        block.update(zip(SUM_NAMES, sums))
+        blocks.append(block)
+
+    state = {name: np.concatenate([block[name] for block in blocks]) for name in blocks[0]}
+    manifest = {'veg_index': veg_index,
+                'last_year': int(year_list[-1]),
+                'files': [os.path.abspath(file) for file in file_list],
+                'valid_num': valid_num,
+                'pre_years': list(pre_years),
+                'erup_year': erup_year,
+                'recovery_percents': list(recovery_percents),
+                'num_years': num_years,
+                'meta': cube_cache.encode_meta(meta),
+                'bounds': list(bounds)}
+    save_state(state_dir, state, manifest)
+    return state_metrics(state, manifest)
+
+def append_year(state_dir, new_file, year=None):
+    '''
+    Adds one new year of imagery to a persisted state: updates the sufficient statistics, nan counts,
+    fits and recovery metrics of the active pixels, reading only the new geotiff
+
+    Args:
+        state_dir (string): folder of the state (see init_state)
+        new_file (string): file path to the geotiff of the new year
+        year (int): year of the new geotiff; parsed from the file name if None
+
+    Returns:
+        metrics (dict): 2D numpy array (height, width) per metric (see pipeline.run_metrics_chain)
+    '''
+    state, manifest = load_state(state_dir)
+    if year is None:
+        year = ic.parse_year(new_file, manifest['veg_index'])
+    if year <= manifest['last_year']:
+        raise ValueError("Year " + str(year) + " is already in the state!")
+
+    with rasterio.open(new_file) as f:
+        # the state's flat pixel indices only apply to a raster of the same size
+        if (f.height, f.width) != (manifest['meta']['height'], manifest['meta']['width']):
+            raise ValueError("Size of " + new_file + " does not match the rasters of the state!")
+        y = f.read(1).reshape(-1)[state['index']].astype(float)
+
+    # x of the new year on the log-year axis (see trend_fitting.log_year_axis); skipped years are all nan
+    x = np.log10(year - manifest['erup_year'])
+    valid = np.isfinite(y)
+    y0 = np.where(valid, y, 0.)
+    x_valid = np.where(valid, x, 0.)
+    state['n'] += valid
+    state['sx'] += x_valid
+    state['sxx'] += x_valid * x_valid
+    state['sy'] += y0
+    state['syy'] += y0 * y0
+    state['sxy'] += x_valid * y0
+    state['nan_count'] += (year - manifest['last_year'] - 1) + ~valid
+
+    # pixels with too many nans are no longer valid (nan counts only grow, so no pixel becomes valid)
+    keep = state['nan_count'] < manifest['valid_num']
+    state = {name: values[keep] for name, values in state.items()}
+
+    manifest['last_year'] = int(year)
+    manifest['files'].append(os.path.abspath(new_file))
+    save_state(state_dir, state, manifest)
+    instr.log('Appended ' + str(year) + ', active pixels: ', keep.sum())
+    return state_metrics(state, manifest)
+
+def state_metrics(state, manifest, max_pval=0.05, min_r2=0.7, max_years=30):
+    '''
+    Fits and recovery metrics from the sufficient statistics of a state, scattered back to the raster shape
+
+    Returns:
+        metrics (dict): 2D numpy array (height, width) per metric
+    '''
+    fit_result = tf._ols_from_sums(*[state[name] for name in SUM_NAMES])
+    metric_records = rm.metrics_from_fit(fit_result, state['veg_pre'], state['dVI'], manifest['recovery_percents'],
+                                         manifest['num_years'], max_pval, min_r2, max_years)
+    height, width = manifest['meta']['height'], manifest['meta']['width']
+    metrics = {}
+    for name, values in pipeline.metrics_to_dict(metric_records, fit_result).items():
+        full_values = np.full(height * width, np.nan)
+        full_values[state['index']] = values
+        metrics[name] = full_values.reshape(height, width)
+    return metrics
+
+def save_state(state_dir, state, manifest):
+    '''
+    Writes the state arrays, then the manifest (written last so that an interrupted write is never read as a valid state)
+    '''
+    os.makedirs(state_dir, exist_ok=True)
+    manifest_path = os.path.join(state_dir, MANIFEST_FILE)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    tmp_path = os.path.join(state_dir, 'state.tmp.npz')
+    np.savez(tmp_path, **state)
+    os.replace(tmp_path, os.path.join(state_dir, STATE_FILE))
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+
+def load_state(state_dir):
+    '''
+    Reads a persisted state
+
+    Returns:
+        state (dict): 1D numpy array per active pixel quantity ('index', 'nan_count', 'veg_pre', 'dVI' and the sums)
+        manifest (dict): years, cleaning and metric parameters, raster meta (json-encoded) and bounds
+    '''
+    manifest_path = os.path.join(state_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        raise ValueError("No incremental state in " + state_dir + "!")
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    with np.load(os.path.join(state_dir, STATE_FILE)) as f:
+        state = {name: f[name] for name in f.files}
+    return state, manifest
+
+def get_state_meta(state_dir):
+    '''
+    Raster meta data and bounds of a persisted state, e.g. to write the metrics with export_metrics
+    '''
+    manifest = load_state(state_dir)[1]
+    return cube_cache.decode_meta(manifest['meta']), BoundingBox(*manifest['bounds'])
@@ -3,58 +3,251 @@
 # ======================
 
 # import libraries 
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import rasterio 
+from rasterio.windows import Window
+from pixel_stack import PixelStack, as_pixel_stack, pre_eruption_average, PRE_ERUPTION_YEARS, ERUPTION_YEAR
+import instrumentation as instr
 
 # ======================
 # Function to read in vegetation index images and create np image stack
 # ======================
-def create_image_stack(files, extension): 
+@instr.instrumented('create_image_stack', pixels=('output', 2))
+def create_image_stack(files, extension, n_threads=8): 
     """
     This function creates an image stack from the geotiff files given, 
-    and adds a year element 
+    and adds a year element. Files are sorted by year and read concurrently
     
     Args: 
         files (list): list of file paths
         extension (string): 'NDVI', 'NBR', 'SAVI'
+        n_threads (int): number of files read at the same time
     
     Returns: 
-        image_stack (numpy array): numpy ndarray 
-        year_list (list): list of years in image stack
+        image_stack (numpy array): numpy ndarray (height, width, depth); a view of a contiguous (depth, height, width) buffer
+        year_list (list): sorted list of years in image stack
         stack_depth (int): depth of image stack
         meta (dict): meta data for raster file
         bounds: bounds for raster file
     """
     # get year list
-    if extension == 'NBR':
-        year_list = [int(i[-16:-12]) for i in files]
-    elif extension == 'NDVI' or extension == 'SAVI':
-        year_list = [int(i[-17:-13]) for i in files]
+    files, year_list = sort_by_year(files, extension)
     stack_depth = len(year_list)
 
     # get image shape
     with rasterio.open(files[0]) as f:
         meta = f.meta
         bounds = f.bounds
-        image_get_shape = f.read(1)
-    height, width = image_get_shape.shape
     
-    # create empty np array for image stack
-    image_stack = np.empty([height, width, stack_depth])
-    print('empty image stack shape: ', image_stack.shape)
-     
-    # create image stack
-    for i, file in enumerate(files): 
-        with rasterio.open(file) as f: 
-            image = f.read(1)
-            image_stack[:, :, i] = image
-    print('Finished reading and creating raw image stack...')
+    # read every year into its own contiguous slab of the image stack
+    image_stack = read_stack(files, None, n_threads)
+    instr.log('image stack shape: ', image_stack.shape)
+    instr.log('Finished reading and creating raw image stack...')
     return image_stack, year_list, stack_depth, meta, bounds
 
+# ======================
+# Windowed (block by block) reading of the image stack for memory-bounded processing
+# ======================
+def get_stack_info(files, extension): 
+    """
+    Reads only the metadata needed to process the image stack window by window
+
+    Args: 
+        files (list): list of file paths
+        extension (string): 'NDVI', 'NBR', 'SAVI'
+
+    Returns: 
+        year_list (list): sorted list of years in image stack
+        meta (dict): meta data for raster file
+        bounds: bounds for raster file
+    """
+    # get year list
+    files, year_list = sort_by_year(files, extension)
+
+    with rasterio.open(files[0]) as f:
+        meta = f.meta
+        bounds = f.bounds
+    return year_list, meta, bounds
+
+def get_block_windows(height, width, year_list, max_memory_mb=512, copies=10): 
+    """
+    Splits the raster into full-width row strips small enough that one strip can go through the 
+    whole clean -> mask -> fit -> metrics chain within the memory budget
+
+    Args: 
+        height (int): raster height
+        width (int): raster width
+        year_list (list): list of years in image stack (potentially missing some years)
+        max_memory_mb (int): memory budget for one block in megabytes
+        copies (int): number of float64 copies of the full-year block that are alive at peak in the chain
+
+    Returns: 
+        windows (list): list of rasterio Windows covering the raster
+    """
+    full_depth = year_list[-1] - year_list[0] + 1
+    bytes_per_row = width * full_depth * 8 * copies
+    block_rows = max(1, int(max_memory_mb * 1024**2 // bytes_per_row))
+    windows = []
+    for row_off in range(0, height, block_rows): 
+        windows.append(Window(0, row_off, width, min(block_rows, height - row_off)))
+    return windows
+
+@instr.instrumented('read_image_block', pixels=('output', 2))
+def read_image_block(files, window, n_threads=8): 
+    """
+    Reads one window of every geotiff into an image stack of shape (window height, window width, depth)
+
+    Args: 
+        files (list): list of file paths (sorted by year, like get_stack_info)
+        window (rasterio Window): window to read
+        n_threads (int): number of files read at the same time
+
+    Returns: 
+        image_block (numpy array): image stack of the window
+    """
+    files = sort_by_year(files)[0]
+    return read_stack(files, window, n_threads)
+
+# ======================
+# Year parsing and concurrent reading of the yearly geotiffs
+# ======================
+def parse_year(file, extension=None): 
+    """
+    Gets the year from a vegetation index file name ending in <YYYYMMDD>_<extension>.tif (e.g., LS_19850601_NBR.tif)
+
+    Args: 
+        file (string): file path
+        extension (string): 'NDVI', 'NBR', 'SAVI'; None accepts any vegetation index
+
+    Returns: 
+        year (int): year of the file
+    """
+    pattern = r'(\d{4})\d{4}_' + (re.escape(extension) if extension is not None else r'[A-Za-z0-9]+') + r'\.tif$'
+    match = re.search(pattern, os.path.basename(file))
+    if match is None: 
+        raise ValueError("No year found in file name " + file + "!")
+    return int(match.group(1))
+
+def sort_by_year(files, extension=None): 
+    """
+    Sorts files by year (file lists from glob are in no particular order)
+
+    Returns: 
+        files (list): file paths sorted by year
+        year_list (list): sorted list of years
+    """
+    years = [parse_year(file, extension) for file in files]
+    if len(set(years)) != len(years): 
+        raise ValueError("More than one file for the same year!")
+    order = np.argsort(years, kind='stable')
+    return [files[i] for i in order], [years[i] for i in order]
+
+def read_stack(files, window=None, n_threads=8): 
+    """
+    Reads band 1 of every file (or one window of it) concurrently from a thread pool (GDAL releases the GIL while reading). 
+    Each file is decoded directly into its own contiguous slab of a preallocated (depth, height, width) buffer
+
+    Args: 
+        files (list): list of file paths, in stack order
+        window (rasterio Window): window to read; None reads the full raster
+        n_threads (int): number of files read at the same time
+
+    Returns: 
+        image_stack (numpy array): (height, width, depth) view of the buffer
+    """
+    if window is None: 
+        with rasterio.open(files[0]) as f: 
+            height, width = f.height, f.width
+    else: 
+        height, width = window.height, window.width
+    buffer = np.empty([len(files), height, width])
+
+    def read_file(i): 
+        with rasterio.open(files[i]) as f: 
+            f.read(1, window=window, out=buffer[i])
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor: 
+        # list() re-raises any read error
+        list(executor.map(read_file, range(len(files))))
+    return np.moveaxis(buffer, 0, 2)
+
+def get_pixel_reads(rows, cols, block_shape, width, sparse_factor=1024): 
+    """
+    Windowed reads of scattered pixels of a geotiff: the pixels are grouped by the internal block (tile or strip) 
+    holding them, and every block with pixels is read once, limited to the bounding box of its pixels. 
+    Blocks with few pixels spread over a large box (e.g. a few pixels of a full-width strip) are read pixel by pixel
+
+    Args: 
+        rows (numpy array): row of each pixel
+        cols (numpy array): column of each pixel
+        block_shape (tuple): internal block height and width of the geotiff
+        width (int): raster width
+        sparse_factor (int): a block is read pixel by pixel if the bounding box of its pixels holds more than 
+                            sparse_factor pixels per pixel read (a read call costs about as much as copying 
+                            a thousand pixels)
+
+    Returns: 
+        reads (list): (pixels, window, window rows, window cols) of each read: the indices of the pixels read, 
+                        and their rows and columns in the window
+    """
+    block_height, block_width = block_shape
+    # pixels sorted by block once (stable, so the pixels of a block keep their order)
+    block_ids = (rows // block_height) * -(-width // block_width) + cols // block_width
+    order = np.argsort(block_ids, kind='stable')
+    starts = np.flatnonzero(np.diff(block_ids[order], prepend=-1))
+    reads = []
+    for members in np.split(order, starts[1:]): 
+        block_rows, block_cols = rows[members], cols[members]
+        row_off, col_off = block_rows.min(), block_cols.min()
+        height, width_read = block_rows.max() - row_off + 1, block_cols.max() - col_off + 1
+        if height * width_read > sparse_factor * members.shape[0]: 
+            zero = np.zeros(1, dtype=int)
+            reads += [(members[[j]], Window(block_cols[j], block_rows[j], 1, 1), zero, zero) for j in range(members.shape[0])]
+        else: 
+            reads.append((members, Window(col_off, row_off, width_read, height), block_rows - row_off, block_cols - col_off))
+    return reads
+
+def read_pixels(files, rows, cols, n_threads=8, sparse_factor=1024): 
+    """
+    Reads the yearly values of scattered pixels only, block by block of the geotiffs (see get_pixel_reads), 
+    from a thread pool
+
+    Args: 
+        files (list): list of file paths (sorted by year, like get_stack_info)
+        rows (numpy array): row of each pixel
+        cols (numpy array): column of each pixel
+        n_threads (int): number of files read at the same time
+        sparse_factor (int): see get_pixel_reads
+
+    Returns: 
+        pixel_values (numpy array): (pixels, depth) array of the pixels' values
+    """
+    files = sort_by_year(files)[0]
+    rows, cols = np.asarray(rows), np.asarray(cols)
+    pixel_values = np.empty([rows.shape[0], len(files)])
+    # the reads only depend on the block layout, which is usually the same for every file
+    plans = {}
+
+    def read_file(i): 
+        with rasterio.open(files[i]) as f: 
+            layout = (f.block_shapes[0], f.width)
+            if layout not in plans: 
+                plans[layout] = get_pixel_reads(rows, cols, f.block_shapes[0], f.width, sparse_factor)
+            for members, window, window_rows, window_cols in plans[layout]: 
+                pixel_values[members, i] = f.read(1, window=window)[window_rows, window_cols]
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor: 
+        list(executor.map(read_file, range(len(files))))
+    return pixel_values
+
 # ======================
 # Function to add missing years of np.nan arrays to original image stack
 # ======================
 
+@instr.instrumented('add_missing_years', pixels=(0, 2))
 def add_missing_years(image_stack, year_list):
     """
     This function adds missing years as np.nan arrays to the original images stack 
@@ -80,7 +273,7 @@ def add_missing_years(image_stack, year_list):
         if yearly_years[i] in year_list: 
             actual_arr[:, :, i] = image_stack[:, :, img_stack_index]
             img_stack_index += 1
-    print("Added missing years to image stack...")
+    instr.log("Added missing years to image stack...")
     return actual_arr
 
 # ======================
@@ -89,6 +282,7 @@ def add_missing_years(image_stack, year_list):
 # ======================
 # count number of nans for each pixel over the years
 
+@instr.instrumented('clean_data', pixels=(0, 2))
 def clean_data(full_pix_arr, valid_num=20): 
     """
     This function creates a mask to label is a pixel is considered "valid" or not.
@@ -113,13 +307,14 @@ def clean_data(full_pix_arr, valid_num=20):
     # reshape pixel array to concatenate with reshaped base array
     shp = val_pix.shape
     val_pix_reshaped = val_pix.reshape(shp[0]*shp[1], 1)
-    print('reshaped shape of valid pixel mask: ', val_pix_reshaped.shape)
-    print('Created mask of valid pixels...')
+    instr.log('reshaped shape of valid pixel mask: ', val_pix_reshaped.shape)
+    instr.log('Created mask of valid pixels...')
     return val_pix_reshaped
 
 # ======================
 # Function to reshape image stack to apply regression
 # ======================
+@instr.instrumented('reshape_image_stack', pixels=(0, 2))
 def reshape_image_stack(image_stack, year_list): 
     """
     Function to reshape image stack into 2D array, then concatenate with year array
@@ -136,11 +331,11 @@ def reshape_image_stack(image_stack, year_list):
     yearly_years = [year for year in range(year_list[0], year_list[-1] + 1)]
 
     # create empty base array
-    print('START: reshaping data...')
+    instr.log('START: reshaping data...')
     row, col, stack_depth = image_stack.shape
-    print('row, col: ',row, col)
+    instr.log('row, col: ',row, col)
     base_array = np.empty([row*col, stack_depth])
-    print('base array shape: ', base_array.shape)
+    instr.log('base array shape: ', base_array.shape)
     
     for i in range(stack_depth): 
         img = image_stack[:, :, i]
@@ -160,9 +355,126 @@ def reshape_image_stack(image_stack, year_list):
     base_array = np.concatenate((base_years_array, base_array), axis=2)
     
     # print('max and min veg: ', max_veg, min_veg)
-    print('FINISHED: shape of reshaped array that is returned: ', base_array.shape)
+    instr.log('FINISHED: shape of reshaped array that is returned: ', base_array.shape)
     return base_array
 
+# ======================
+# Function to flatten image stack into a PixelStack (shared year axis instead of repeated years)
+# ======================
+def build_pixel_stack(image_stack, year_list, meta=None, bounds=None): 
+    """
+    Flattens the full image stack into a PixelStack. Unlike reshape_image_stack, the years are kept 
+    once as a 1D axis instead of being repeated for every pixel, and the values are a view of image_stack 
+    whenever possible (no copy)
+
+    Args:
+        image_stack (ndarray): full VI image stack without missing years
+        year_list (list): list of years from original data set
+        meta (dict): meta data for raster file
+        bounds: bounds for raster file
+
+    Returns:
+        stack (PixelStack): flattened image stack
+    """
+    # full list of years with no missing values
+    yearly_years = np.arange(year_list[0], year_list[-1] + 1)
+    row, col, stack_depth = image_stack.shape
+    values = image_stack.reshape(row*col, stack_depth)
+    return PixelStack(values, yearly_years, height=row, width=col, meta=meta, bounds=bounds)
+
+# ======================
+# Fused ingest kernel: gap insertion, nan count, disturbance test and valid mask in one pass
+# ======================
+@instr.instrumented('fused_clean_ingest', pixels=(0, 2))
+def fused_clean_ingest(image_stack, year_list, valid_num=20, disturbance_factor=0.2, pre_years=PRE_ERUPTION_YEARS, 
+                        erup_year=ERUPTION_YEAR, meta=None, bounds=None, chunk_size=65536): 
+    """
+    Single-pass equivalent of add_missing_years -> clean_data -> reshape_image_stack -> get_disturbed_pixel_array 
+    -> get_valid_pixel_filter -> get_valid_image_stack. 
+    The only full-size allocation is the output (pixels, years) array: each chunk of pixels is copied into its 
+    gap-filled columns, then its nan count, disturbance test and valid mask are computed while the chunk is in cache
+
+    Args: 
+        image_stack (numpy array): ndarray stack of yearly vegetation indices (height, width, depth)
+        year_list (list): list of years in image stack (potentially missing some years)
+        valid_num (int): pixels with valid_num or more nans are invalid (see clean_data)
+        disturbance_factor (float): pixels are disturbed if VIpre - VIerup > disturbance_factor * VIpre (see get_disturbed_pixel_array)
+        pre_years (tuple): the two pre-eruption years
+        erup_year (int): eruption year
+        meta (dict): meta data for raster file
+        bounds: bounds for raster file
+        chunk_size (int): number of pixels processed at a time
+
+    Returns: 
+        valid_stack (PixelStack): complete clean and valid image stack; invalid pixels are np.nan
+    """
+    # full list of years with no missing values, and the column of each year of the image stack
+    yearly_years = np.arange(year_list[0], year_list[-1] + 1)
+    year_cols = np.asarray(year_list) - year_list[0]
+    num_missing = yearly_years.shape[0] - year_cols.shape[0]
+
+    row, col, stack_depth = image_stack.shape
+    num_pix = row*col
+    flat_stack = image_stack.reshape(num_pix, stack_depth) # view for a contiguous stack
+    values = np.full([num_pix, yearly_years.shape[0]], np.nan)
+    valid = np.empty(num_pix, dtype=bool)
+    instr.log('fused ingest output size (MB): ', values.nbytes / 1024**2)
+
+    pre_first, pre_second, erup = get_year_columns(year_list, [pre_years[0], pre_years[1], erup_year])
+    for start in range(0, num_pix, chunk_size): 
+        chunk = values[start:start + chunk_size]
+        chunk[:, year_cols] = flat_stack[start:start + chunk_size]
+
+        # nan count (missing years are all nan)
+        nan_per_pixel = np.count_nonzero(np.isnan(flat_stack[start:start + chunk_size]), axis=1) + num_missing
+
+        chunk_valid = get_chunk_valid(chunk, nan_per_pixel, pre_first, pre_second, erup, valid_num, disturbance_factor)
+        chunk[~chunk_valid] = np.nan
+        valid[start:start + chunk_size] = chunk_valid
+    instr.log('Finished fused ingest...')
+    return PixelStack(values, yearly_years, valid, row, col, meta, bounds)
+
+def get_year_columns(year_list, years): 
+    """
+    Columns of years in the gap-filled stack of year_list (same columns as PixelStack.year_index)
+
+    Args: 
+        year_list (list): list of years in image stack (potentially missing some years)
+        years (list): years to look up, e.g. the pre-eruption years and the eruption year
+
+    Returns: 
+        columns (list): column index of each year
+    """
+    columns = []
+    for year in years: 
+        # years outside the stack would wrap around (negative columns) or be out of range
+        if not year_list[0] <= year <= year_list[-1]: 
+            raise ValueError("Year " + str(year) + " is not in the image stack!")
+        columns.append(int(year - year_list[0]))
+    return columns
+
+def get_chunk_valid(chunk, nan_per_pixel, pre_first, pre_second, erup, valid_num=20, disturbance_factor=0.2): 
+    """
+    Valid and disturbed test of a chunk of gap-filled (pixels, years) values (the per-chunk step of fused_clean_ingest)
+
+    Args: 
+        chunk (numpy array): 2D array (pixels, years) without missing years
+        nan_per_pixel (numpy array): number of nans of each pixel over the years
+        pre_first (int): column of the first pre-eruption year
+        pre_second (int): column of the second pre-eruption year
+        erup (int): column of the eruption year
+        valid_num (int): pixels with valid_num or more nans are invalid
+        disturbance_factor (float): pixels are disturbed if VIpre - VIerup > disturbance_factor * VIpre
+
+    Returns: 
+        chunk_valid (numpy array): 1D bool array; True if the pixel is valid and disturbed
+    """
+    # disturbance test
+    veg_pre = (chunk[:, pre_first] + chunk[:, pre_second]) / 2
+    veg_pre = np.where(np.isnan(veg_pre), chunk[:, pre_first], veg_pre)
+    disturbed_pix = (veg_pre - chunk[:, erup]) > veg_pre * disturbance_factor
+    return (nan_per_pixel < valid_num) & disturbed_pix
+
 # ======================
 # function1: classify whether pixel is disturbed or not. Log reg fitted only to disturbed pixels
 # function2: combine disturbed and nan filters
@@ -174,14 +486,19 @@ def reshape_image_stack(image_stack, year_list):
 # disturbed pixel array: disturbed_pixels (array of bools)
 # ======================
 
-def get_disturbed_pixel_array(reshaped_image_stack, year_list):
+@instr.instrumented('get_disturbed_pixel_array', pixels=(0, 1))
+def get_disturbed_pixel_array(reshaped_image_stack, year_list, pre_years=PRE_ERUPTION_YEARS, erup_year=ERUPTION_YEAR, 
+                              disturbance_factor=0.2):
     """
     This functions classifies pixels as disturbed (affected by eruption) or not. Pixels are considered "disturbed" 
     if VImax_pre - VIerup > 0.20 (adapted from DeSchutter et al., 2015)
     
     Args: 
-        reshaped_image_stack (numpy array): reshaped vegetation index image stack
+        reshaped_image_stack (numpy array or PixelStack): reshaped vegetation index image stack
         year_list (list): incomplete list of years
+        pre_years (tuple): the two pre-eruption years
+        erup_year (int): eruption year (immediately post eruption)
+        disturbance_factor (float): pixels are disturbed if VIpre - VIerup > disturbance_factor * VIpre
     
     Returns: 
         disturbed_pix_reshaped (numpy array): retrieved disturbed pixels array
@@ -189,23 +506,21 @@ def get_disturbed_pixel_array(reshaped_image_stack, year_list):
         only_veg_ind (numpy array): only the vegetation indices of the original array
     """
 
-    # full list of years with no missing values
-    yearly_years = [year for year in range(year_list[0], year_list[-1] + 1)]
+    # for a PixelStack, only_years is the shared 1D year axis
+    if isinstance(reshaped_image_stack, PixelStack): 
+        only_years = reshaped_image_stack.years
+        only_veg_ind = reshaped_image_stack.values
+    else: 
+        only_years = reshaped_image_stack[:, :, 0]
+        only_veg_ind = reshaped_image_stack[:, :, 1]
+    stack = as_pixel_stack(reshaped_image_stack)
 
-    only_years = reshaped_image_stack[:, :, 0]
-    only_veg_ind = reshaped_image_stack[:, :, 1]
-    
-    year_ind_dict = {} # dictionary to get year index
-    for ind, year in enumerate(yearly_years):
-          if year not in year_ind_dict: 
-                year_ind_dict[year] = ind
-    veg1985 = only_veg_ind[:, year_ind_dict[1985]]
-    veg1986 = only_veg_ind[:, year_ind_dict[1986]]
-    veg_erup = only_veg_ind[:, year_ind_dict[1995]] # veg index value for year 1995 (immediately post eruption)
-    veg_max_pre = np.where(np.isnan((veg1985 + veg1986)/2), veg1985, (veg1985 + veg1986)/2) # average of veg ind values for two pre-eruption years; 1985, 1986
+    # years are looked up by value
+    veg_erup = stack.column(erup_year) # veg index value for eruption year (immediately post eruption)
+    veg_max_pre = pre_eruption_average(stack, pre_years) # average of veg ind values for two pre-eruption years; 1985, 1986
 
     # check if nbr_max_pre - nbr_erup > 0.20 (or determine own value) # change this to percentage 
-    pre_020 = veg_max_pre * 0.2
+    pre_020 = veg_max_pre * disturbance_factor
     pix_diff = veg_max_pre - veg_erup
     disturbed_pix = pix_diff > pre_020
     
@@ -215,9 +530,10 @@ def get_disturbed_pixel_array(reshaped_image_stack, year_list):
     
     # reshape to concatenate with base array
     disturbed_pix_reshaped = disturbed_pix.reshape(disturbed_pix.shape[0], 1)
-    print('disturbed_pix_reshaped shape: ', disturbed_pix_reshaped.shape)
+    instr.log('disturbed_pix_reshaped shape: ', disturbed_pix_reshaped.shape)
     return disturbed_pix_reshaped, only_years, only_veg_ind
 
+@instr.instrumented('get_valid_pixel_filter', pixels=(0, 1))
 def get_valid_pixel_filter(val_pix_reshaped, disturbed_pix_reshaped): 
     '''
     Applies valid pixel mask to disturbed pixel array mask
@@ -226,16 +542,23 @@ def get_valid_pixel_filter(val_pix_reshaped, disturbed_pix_reshaped):
     concat_val_disturbed = np.concatenate([val_pix_reshaped, disturbed_pix_reshaped], axis=1)
     pix_to_filter = concat_val_disturbed.all(axis=1)
     pix_to_filter_reshaped = pix_to_filter.reshape(pix_to_filter.shape[0], 1)
-    print('valid pixel array shape: ', pix_to_filter_reshaped.shape)
+    instr.log('valid pixel array shape: ', pix_to_filter_reshaped.shape)
     return pix_to_filter_reshaped
 
-def get_valid_image_stack(pix_to_filter_reshaped, only_years, only_veg_index): 
+@instr.instrumented('get_valid_image_stack', pixels=(0, 1))
+def get_valid_image_stack(pix_to_filter_reshaped, only_years, only_veg_index=None): 
     '''
-    Applies combined mask to image stack
+    Applies combined mask to image stack. 
+    only_years can also be a PixelStack (only_veg_index is then not needed), in which case a masked PixelStack is returned
 
     Returns: 
         Complete clean and valid image stack
     '''
+    if isinstance(only_years, PixelStack): 
+        valid_stack = only_years.apply_mask(pix_to_filter_reshaped)
+        instr.log('valid veg index stack shape: ', valid_stack.values.shape)
+        return valid_stack
+
     pixels_to_filter_mask = np.repeat(pix_to_filter_reshaped, only_veg_index.shape[1], axis=1)
     valid_veg = np.where(pixels_to_filter_mask, only_veg_index, np.nan)
 
@@ -245,5 +568,5 @@ def get_valid_image_stack(pix_to_filter_reshaped, only_years, only_veg_index):
     only_years = only_years.reshape(shp[0], shp[1], 1)
 
     valid_veg_withyears = np.concatenate((only_years, valid_veg), axis=2)
-    print('valid veg index with years shape: ', valid_veg_withyears.shape)
+    instr.log('valid veg index with years shape: ', valid_veg_withyears.shape)
     return valid_veg_withyears
@@ -0,0 +1,300 @@
+# ======================
+# Stage-level instrumentation of the post-processing chain
+# Records wall time, CPU time, peak allocated memory, pixels processed per second and array sizes of every stage,
+# exports them as a json run report, and optionally dumps cProfile stats and tracemalloc snapshots.
+# Disabled by default: a disabled stage costs one global lookup
+# ======================
+
+import os
+import json
+import time
+import inspect
+import functools
+import contextlib
+import cProfile
+import tracemalloc
+import numpy as np
+
+_run = None
+_verbose = False
+
+class Stage:
+    '''
+    One instrumented stage of a run (use the stage context manager rather than creating it directly)
+
+    Attributes:
+        name (string): stage name
+        depth (int): nesting depth (0 for top-level stages)
+        pixels (int): number of pixels processed by the stage (None if unknown)
+        arrays (dict): shape, dtype and megabytes of the arrays recorded for the stage
+        messages (list): progress messages logged during the stage
+    '''
+    def __init__(self, name, depth, pixels=None):
+        self.name = name
+        self.depth = depth
+        self.pixels = pixels
+        self.arrays = {}
+        self.messages = []
+        self.wall_s = None
+        self.cpu_s = None
+        self.peak_mb = None
+        self._peak_abs = 0
+
+    def record_array(self, name, array):
+        '''
+        Records the shape, dtype and size of an array (or PixelStack) produced or consumed by the stage
+        '''
+        values = getattr(array, 'values', array)
+        if isinstance(values, np.ndarray):
+            self.arrays[name] = {'shape': list(values.shape), 'dtype': str(values.dtype), 'mb': values.nbytes / 1024**2}
+
+    def set_pixels(self, pixels):
+        self.pixels = int(pixels)
+
+    def to_dict(self):
+        stage = {'name': self.name, 'depth': self.depth, 'wall_s': self.wall_s, 'cpu_s': self.cpu_s,
+                 'peak_mb': self.peak_mb, 'pixels': self.pixels, 'pixels_per_s': None,
+                 'arrays': self.arrays, 'messages': self.messages}
+        if self.pixels is not None and self.wall_s:
+            stage['pixels_per_s'] = self.pixels / self.wall_s
+        return stage
+
+class _NoStage:
+    '''
+    Stand-in returned by stage() while instrumentation is disabled
+    '''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def record_array(self, name, array):
+        pass
+
+    def set_pixels(self, pixels):
+        pass
+
+_NO_STAGE = _NoStage()
+
+class _Run:
+    def __init__(self, trace_memory, profile, snapshots, dump_dir):
+        self.trace_memory = trace_memory
+        self.profile = profile
+        self.snapshots = snapshots
+        self.dump_dir = dump_dir
+        self.stages = []
+        self.active = []
+        self.started = time.time()
+        if dump_dir is not None:
+            os.makedirs(dump_dir, exist_ok=True)
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+class _StageContext:
+    def __init__(self, run, name, pixels):
+        self.run = run
+        self.stage = Stage(name, len(run.active), pixels)
+        self.profiler = None
+
+    def __enter__(self):
+        run = self.run
+        run.stages.append(self.stage)
+        if run.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            # keep the peak of the enclosing stage before resetting it for this one
+            if run.active:
+                run.active[-1]._peak_abs = max(run.active[-1]._peak_abs, peak)
+            tracemalloc.reset_peak()
+            self.start_memory = current
+            self.stage._peak_abs = current
+        if run.profile and self.stage.depth == 0:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        run.active.append(self.stage)
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        return self.stage
+
+    def __exit__(self, *exc):
+        run = self.run
+        stage = self.stage
+        stage.wall_s = time.perf_counter() - self.start_wall
+        stage.cpu_s = time.process_time() - self.start_cpu
+        run.active.pop()
+        if self.profiler is not None:
+            self.profiler.disable()
+            if run.dump_dir is not None:
+                self.profiler.dump_stats(os.path.join(run.dump_dir, _dump_name(run, stage) + '.prof'))
+        if run.trace_memory:
+            stage._peak_abs = max(stage._peak_abs, tracemalloc.get_traced_memory()[1])
+            stage.peak_mb = (stage._peak_abs - self.start_memory) / 1024**2
+            if run.active:
+                run.active[-1]._peak_abs = max(run.active[-1]._peak_abs, stage._peak_abs)
+            if run.snapshots and run.dump_dir is not None and stage.depth == 0:
+                tracemalloc.take_snapshot().dump(os.path.join(run.dump_dir, _dump_name(run, stage) + '.snapshot'))
+        return False
+
+def _dump_name(run, stage):
+    return str(run.stages.index(stage)).zfill(3) + '_' + stage.name
+
+# ======================
+# Public interface
+# ======================
+def enable(trace_memory=True, profile=False, snapshots=False, dump_dir=None):
+    '''
+    Starts recording a run: every stage entered from now on is added to the run report
+
+    Args:
+        trace_memory (bool): if True, record the peak allocated memory of every stage (tracemalloc; slows numpy code down a little)
+        profile (bool): if True, profile every top-level stage with cProfile (dumped to dump_dir as <n>_<stage>.prof)
+        snapshots (bool): if True, dump a tracemalloc snapshot at the end of every top-level stage to dump_dir
+        dump_dir (string): folder for the cProfile and tracemalloc dumps
+    '''
+    global _run
+    _run = _Run(trace_memory, profile, snapshots, dump_dir)
+
+def disable():
+    '''
+    Stops recording and returns the report of the run (None if no run was recorded)
+    '''
+    global _run
+    if _run is None:
+        return None
+    run_report = report()
+    if _run.trace_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _run = None
+    return run_report
+
+def is_enabled():
+    return _run is not None
+
+def set_verbose(verbose):
+    '''
+    Turns the printing of progress messages (see log) on or off; off by default, since blocked and
+    parallel runs log once per block
+    '''
+    global _verbose
+    _verbose = verbose
+
+def stage(name, pixels=None):
+    '''
+    Context manager around one pipeline stage, e.g.
+
+        with instrumentation.stage('trend_fit', pixels=n) as s:
+            fit_result = ...
+            s.record_array('fit_result', fit_result)
+
+    Does nothing while instrumentation is disabled
+    '''
+    if _run is None:
+        return _NO_STAGE
+    return _StageContext(_run, name, pixels)
+
+@contextlib.contextmanager
+def trace_peak():
+    '''
+    Context manager measuring the peak memory allocated within it with tracemalloc, e.g.
+
+        with instrumentation.trace_peak() as traced:
+            ...
+        peak_mb = traced['peak_mb']
+
+    If memory is already traced (e.g. by an enabled run), tracing is not stopped: the peak is reset and measured
+    from the current traced memory, and the enclosing stage keeps its own peak (as in the stage context manager)
+    '''
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    else:
+        current, peak = tracemalloc.get_traced_memory()
+        if _run is not None and _run.active:
+            _run.active[-1]._peak_abs = max(_run.active[-1]._peak_abs, peak)
+        tracemalloc.reset_peak()
+    start_memory = tracemalloc.get_traced_memory()[0]
+    traced = {'peak_mb': None}
+    try:
+        yield traced
+    finally:
+        peak = tracemalloc.get_traced_memory()[1]
+        traced['peak_mb'] = (peak - start_memory) / 1024**2
+        if started:
+            tracemalloc.stop()
+        elif _run is not None and _run.active:
+            _run.active[-1]._peak_abs = max(_run.active[-1]._peak_abs, peak)
+
+def instrumented(name, pixels=None):
+    '''
+    Decorator running a function as a stage; array outputs are recorded automatically
+
+    Args:
+        name (string): stage name
+        pixels (tuple): (source, axes) to count the processed pixels: source is the position (or name) of the
+                        argument, whether it is passed by position or by keyword, or 'output' (first output for tuples),
+                        and the pixels are the product of its first axes dimensions (PixelStacks use num_pixels).
+                        None if the pixels are not counted
+    '''
+    def decorator(func):
+        signature = inspect.signature(func)
+        parameter_names = list(signature.parameters)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _run is None:
+                return func(*args, **kwargs)
+            with _StageContext(_run, name, None) as current:
+                if pixels is not None and pixels[0] != 'output':
+                    bound = signature.bind(*args, **kwargs)
+                    bound.apply_defaults()
+                    source = parameter_names[pixels[0]] if isinstance(pixels[0], int) else pixels[0]
+                    current.set_pixels(count_pixels(bound.arguments[source], pixels[1]))
+                output = func(*args, **kwargs)
+                outputs = output if isinstance(output, tuple) else (output,)
+                if pixels is not None and pixels[0] == 'output':
+                    current.set_pixels(count_pixels(outputs[0], pixels[1]))
+                for i, value in enumerate(outputs):
+                    current.record_array('output_' + str(i), value)
+            return output
+        return wrapper
+    return decorator
+
+def count_pixels(array, axes=1):
+    '''
+    Number of pixels of an array whose first axes dimensions are pixels (or of a PixelStack)
+    '''
+    if hasattr(array, 'num_pixels'):
+        return array.num_pixels
+    return int(np.prod(array.shape[:axes]))
+
+def log(*values):
+    '''
+    Progress message: printed if set_verbose(True), and kept with the current stage of the run report
+    '''
+    if _verbose:
+        print(*values)
+    if _run is not None and _run.active:
+        _run.active[-1].messages.append(' '.join(str(value) for value in values))
+
+def report():
+    '''
+    Run report of the stages recorded so far
+
+    Returns:
+        run_report (dict): 'started' (unix time), 'stages' (one dict per stage, in the order they were entered)
+                        and 'total_wall_s' (sum over the top-level stages)
+    '''
+    if _run is None:
+        return None
+    stages = [stage.to_dict() for stage in _run.stages]
+    total = sum(stage['wall_s'] or 0 for stage in stages if stage['depth'] == 0)
+    return {'started': _run.started, 'stages': stages, 'total_wall_s': total}
+
+def save_report(path, run_report=None):
+    '''
+    Writes a run report (by default the current one) as json
+    '''
+    if run_report is None:
+        run_report = report()
+    with open(path, 'w') as f:
+        json.dump(run_report, f, indent=1)
@@ -0,0 +1,276 @@
+# ======================
+# Lazy, memoized version of the notebook chain
+# ingest -> trend_fit -> get_dVI -> abs_regrowth -> rel_regrowth -> numyears_from_trend
+# declared as a dependency graph. Requesting a metric only computes the stages it depends on.
+# Every result is memoized under a hash of the input files and of the parameters of the stage and of all
+# its dependencies, so changing a threshold only recomputes the stages downstream of it.
+# Least recently used results are evicted (or spilled to disk) when the cache exceeds its memory limit
+# ======================
+
+import os
+import json
+import pickle
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import ingest_and_clean as ic
+import trend_fitting as tf
+import recovery_metrics as rm
+import preliminary_values as pv
+import cube_cache
+import instrumentation as instr
+from pixel_stack import PRE_ERUPTION_YEARS, ERUPTION_YEAR
+
+DEFAULT_PARAMS = {'valid_num': 20,
+                  'disturbance_factor': 0.2,
+                  'pre_years': PRE_ERUPTION_YEARS,
+                  'erup_year': ERUPTION_YEAR,
+                  'method': 'batch',
+                  'num_years': 5,
+                  'recovery_percent': 0.8}
+
+# ======================
+# Stage graph: name -> (dependencies, parameters used, function of (params, *dependency values))
+# ======================
+STAGES = {
+    'image_stack': ([], [], lambda p, files, veg_index: ic.create_image_stack(files, veg_index)),
+    'full_stack': (['image_stack'], [], lambda p, image_stack: ic.add_missing_years(image_stack[0], image_stack[1])),
+    'valid_mask': (['full_stack'], ['valid_num'], lambda p, full_stack: ic.clean_data(full_stack, p['valid_num'])),
+    'withyears': (['image_stack', 'full_stack'], [],
+                  lambda p, image_stack, full_stack: ic.reshape_image_stack(full_stack, image_stack[1])),
+    'disturbed': (['image_stack', 'withyears'], ['pre_years', 'erup_year', 'disturbance_factor'],
+                  lambda p, image_stack, withyears: ic.get_disturbed_pixel_array(withyears, image_stack[1], p['pre_years'], p['erup_year'],
+                                                                                 p['disturbance_factor'])),
+    'valid_filter': (['valid_mask', 'disturbed'], [],
+                     lambda p, valid_mask, disturbed: ic.get_valid_pixel_filter(valid_mask, disturbed[0])),
+    'valid_veg': (['valid_filter', 'disturbed'], [],
+                  lambda p, valid_filter, disturbed: ic.get_valid_image_stack(valid_filter, disturbed[1], disturbed[2])),
+    'fit': (['valid_veg'], ['method', 'erup_year'], lambda p, valid_veg: tf.trend_fit(valid_veg, p['method'], p['erup_year'])),
+    'dVI': (['valid_veg'], ['pre_years', 'erup_year'], lambda p, valid_veg: pv.get_dVI(valid_veg, p['pre_years'], p['erup_year'])),
+    'slope': (['fit'], [], lambda p, fit: rm.get_slope(fit)),
+    'abs_regrowth': (['fit'], ['num_years'], lambda p, fit: rm.abs_regrowth(fit, p['num_years'])),
+    'rel_regrowth': (['fit', 'abs_regrowth', 'dVI'], [], lambda p, fit, abs_regrowth, dVI: rm.rel_regrowth(fit, abs_regrowth, dVI)),
+    'years_to_recovery': (['valid_veg', 'fit'], ['recovery_percent', 'pre_years'],
+                          lambda p, valid_veg, fit: rm.numyears_from_trend(valid_veg, fit, p['recovery_percent'], p['pre_years'])),
+}
+
+def get_nbytes(value):
+    '''
+    Memory held by the numpy arrays of a stage result (arrays, or tuples/lists of them);
+    arrays sharing a buffer (e.g. views of the same stack) are counted once
+    '''
+    buffers = {}
+    _add_buffers(value, buffers)
+    return sum(buffers.values())
+
+def _root_array(array):
+    '''
+    Array owning the buffer of array (array itself if it is not a view)
+    '''
+    while isinstance(array.base, np.ndarray):
+        array = array.base
+    return array
+
+def _add_buffers(value, buffers):
+    '''
+    Adds the bytes of every buffer held by a stage result to buffers (id of the owning array -> bytes)
+    '''
+    if isinstance(value, np.ndarray):
+        root = _root_array(value)
+        buffers[id(root)] = root.nbytes
+    elif isinstance(value, (tuple, list)):
+        for item in value:
+            _add_buffers(item, buffers)
+
+def _pack(value, roots):
+    '''
+    Spillable form of a stage result: every array is replaced by its place in the buffer of its owning array,
+    and only the owning arrays (appended to roots) are pickled, once
+    '''
+    if isinstance(value, np.ndarray):
+        root = _root_array(value)
+        if not (root.flags.c_contiguous or root.flags.f_contiguous):
+            return ('array', value)
+        index = next((i for i, other in enumerate(roots) if other is root), None)
+        if index is None:
+            roots.append(root)
+            index = len(roots) - 1
+        offset = value.__array_interface__['data'][0] - root.__array_interface__['data'][0]
+        return ('view', index, offset, value.shape, value.strides, value.dtype.str)
+    if isinstance(value, (tuple, list)):
+        return (type(value).__name__, [_pack(item, roots) for item in value])
+    return ('value', value)
+
+def _unpack(packed, roots):
+    '''
+    Stage result from its spillable form (see _pack); views share the buffers of the loaded arrays again
+    '''
+    kind = packed[0]
+    if kind == 'view':
+        index, offset, shape, strides, dtype = packed[1:]
+        return np.ndarray(shape, dtype, buffer=roots[index], offset=offset, strides=strides)
+    if kind in ('tuple', 'list'):
+        items = [_unpack(item, roots) for item in packed[1]]
+        return tuple(items) if kind == 'tuple' else items
+    return packed[1]
+
+class LazyPipeline:
+    '''
+    Lazy, memoized post-processing chain for one stack of vegetation index geotiffs
+
+    Args:
+        file_list (list): list of file paths to geotiffs of vegetation indices
+        veg_index (string): either 'NDVI', 'SAVI', 'NBR'
+        memory_limit_mb (int): memory the cached stage results may hold; least recently used results are evicted beyond it
+        spill_dir (string): if given, evicted results are written to this folder and read back when needed again
+        **params: stage parameters (see DEFAULT_PARAMS)
+
+    Example:
+        pipe = LazyPipeline(nbr_files, 'NBR')
+        years_80 = pipe.get('years_to_recovery')                          # ingest, fit, years to 80% recovery
+        years_20 = pipe.get('years_to_recovery', recovery_percent=0.2)    # only numyears_from_trend is rerun
+    '''
+    def __init__(self, file_list, veg_index, memory_limit_mb=1024, spill_dir=None, **params):
+        good_veg_index = ['NBR', 'NDVI', 'SAVI']
+        if veg_index not in good_veg_index:
+            raise ValueError("Inappropriate vegetation index chosen!")
+        self.file_list = file_list
+        self.veg_index = veg_index
+        self.memory_limit = memory_limit_mb * 1024**2
+        self.spill_dir = spill_dir
+        self.params = dict(DEFAULT_PARAMS)
+        self.set_params(**params)
+        self.cache = OrderedDict()
+        self.spilled = {}
+        self.stats = {'hits': 0, 'misses': 0, 'spills': 0, 'loads': 0, 'evictions': 0}
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def set_params(self, **params):
+        '''
+        Changes stage parameters; cached results that do not depend on them stay valid
+        '''
+        for name in params:
+            if name not in DEFAULT_PARAMS:
+                raise ValueError("Unknown pipeline parameter " + name + "!")
+        self.params.update(params)
+
+    def get(self, name, **params):
+        '''
+        Result of a stage, computing only the (not yet cached) stages it depends on
+
+        Args:
+            name (string): stage name (see STAGES)
+            **params: parameter overrides for this request only
+
+        Returns:
+            value: result of the stage function
+        '''
+        if name not in STAGES:
+            raise ValueError("Unknown pipeline stage " + name + "!")
+        request_params = dict(self.params)
+        for param in params:
+            if param not in DEFAULT_PARAMS:
+                raise ValueError("Unknown pipeline parameter " + param + "!")
+        request_params.update(params)
+        return self._get(name, request_params, {})
+
+    def compute(self, *names, **params):
+        '''
+        Results of several stages, as a dict
+        '''
+        return {name: self.get(name, **params) for name in names}
+
+    def key(self, name, **params):
+        '''
+        Content hash of a stage result: input files (path, mtime, size), vegetation index,
+        the stage's parameters and the keys of its dependencies
+        '''
+        request_params = dict(self.params)
+        request_params.update(params)
+        return self._key(name, request_params, {})
+
+    def _key(self, name, params, keys):
+        if name in keys:
+            return keys[name]
+        deps, param_names, func = STAGES[name]
+        description = {'stage': name, 'params': {param: params[param] for param in param_names}}
+        if deps:
+            description['deps'] = [self._key(dep, params, keys) for dep in deps]
+        else:
+            description['files'] = cube_cache.get_fingerprint(self.file_list)
+            description['veg_index'] = self.veg_index
+        keys[name] = hashlib.sha1(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+        return keys[name]
+
+    def _get(self, name, params, keys):
+        key = self._key(name, params, keys)
+        if key in self.cache:
+            self.stats['hits'] += 1
+            self.cache.move_to_end(key)
+            return self.cache[key][0]
+        if key in self.spilled:
+            self.stats['loads'] += 1
+            with open(self.spilled[key], 'rb') as f:
+                packed, roots = pickle.load(f)
+            value = _unpack(packed, roots)
+            self._store(key, value)
+            return value
+
+        self.stats['misses'] += 1
+        deps, param_names, func = STAGES[name]
+        if deps:
+            dep_values = [self._get(dep, params, keys) for dep in deps]
+        else:
+            dep_values = [self.file_list, self.veg_index]
+        with instr.stage('lazy_' + name):
+            value = func(params, *dep_values)
+        self._store(key, value)
+        return value
+
+    def _store(self, key, value):
+        '''
+        Caches a result, then evicts least recently used results until the cache fits in the memory limit
+        (the newest result is always kept)
+        '''
+        self.cache[key] = (value, get_nbytes(value))
+        while self.memory_used() > self.memory_limit and len(self.cache) > 1:
+            old_key, (old_value, nbytes) = self.cache.popitem(last=False)
+            self.stats['evictions'] += 1
+            if self.spill_dir is not None and old_key not in self.spilled:
+                path = os.path.join(self.spill_dir, old_key + '.pkl')
+                roots = []
+                packed = _pack(old_value, roots)
+                with open(path, 'wb') as f:
+                    pickle.dump((packed, roots), f, protocol=pickle.HIGHEST_PROTOCOL)
+                self.spilled[old_key] = path
+                self.stats['spills'] += 1
+
+    def memory_used(self):
+        '''
+        Bytes held by the cached results; buffers shared by several results (e.g. views of withyears) are counted once
+        '''
+        buffers = {}
+        for value, nbytes in self.cache.values():
+            _add_buffers(value, buffers)
+        return sum(buffers.values())
+
+    def clear(self):
+        '''
+        Drops every cached and spilled result
+        '''
+        self.cache.clear()
+        for path in self.spilled.values():
+            if os.path.exists(path):
+                os.remove(path)
+        self.spilled.clear()
+
+    def cache_info(self):
+        '''
+        Cache statistics: hits, misses, spills, loads (from disk), evictions, cached results and memory used (MB)
+        '''
+        info = dict(self.stats)
+        info['cached'] = len(self.cache)
+        info['spilled'] = len(self.spilled)
+        info['memory_mb'] = self.memory_used() / 1024**2
+        return info
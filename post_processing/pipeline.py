@@ -0,0 +1,250 @@
+# ======================
+# Runs the full post-processing chain (clean -> mask -> fit -> metrics)
+# Either on an already cleaned image stack, or block by block from the geotiffs under a memory budget
+# ======================
+
+import numpy as np
+import ic_wrapper as wp
+import ingest_and_clean as ic
+import trend_fitting as tf
+import recovery_metrics as rm
+import preliminary_values as pv
+import instrumentation as instr
+from pixel_stack import PixelStack, PRE_ERUPTION_YEARS, ERUPTION_YEAR
+
+# ======================
+# Function to derive all recovery metrics from a cleaned image stack
+# ======================
+@instr.instrumented('run_metrics_chain', pixels=(0, 1))
+def run_metrics_chain(valid_veg_withyears, recovery_percents=(0.2, 0.8), num_years=5, pre_years=PRE_ERUPTION_YEARS,
+                      erup_year=ERUPTION_YEAR):
+    '''
+    Fits the linear-log trend and derives every recovery metric for a cleaned image stack
+
+    Args:
+        valid_veg_withyears (numpy array or PixelStack): complete image stack from wrapper_clean_ingest.
+                            For a compacted PixelStack, metrics are only computed for the active pixels (see scatter_metrics)
+        recovery_percents (tuple): recovery percentages (0 to 1) to get the number of years to recovery for
+        num_years (int): number of years post-disturbance regrowth for the regrowth metrics
+        pre_years (tuple): the two pre-eruption years
+        erup_year (int): eruption year (start of the trend fit)
+
+    Returns:
+        metrics (dict): 1D numpy array per metric, one value per pixel.
+                        Keys: 'qa' (fit QA), 'dVI', 'slope', 'abs_regrowth', 'rel_regrowth', and 'years_to_<percent>' for each recovery percentage
+    '''
+    fit_result = tf.trend_fit(valid_veg_withyears, erup_year=erup_year)
+    dVI = pv.get_dVI(valid_veg_withyears, pre_years, erup_year)
+
+    # one pass over the fits for every metric
+    metric_records = rm.compute_metrics(valid_veg_withyears, fit_result, dVI, recovery_percents, num_years, pre_years, erup_year)
+    return metrics_to_dict(metric_records, fit_result)
+
+def metrics_to_dict(metric_records, fit_result):
+    '''
+    Splits the metric records of recovery_metrics.compute_metrics into one 1D array per metric
+
+    Args:
+        metric_records (numpy structured array): one record per pixel
+        fit_result (numpy array): trend fitting results the metrics were computed from
+
+    Returns:
+        metrics (dict): 1D numpy array per metric (see run_metrics_chain)
+    '''
+    metrics = {}
+    for name in metric_records.dtype.names:
+        metrics[name] = metric_records[name]
+
+    # fit QA as 1 (passed) / 0 (failed), np.nan where no trend could be fitted
+    metrics['qa'] = np.where(np.isnan(fit_result[:, 0]), np.nan, metric_records['qa'])
+    return metrics
+
+def scatter_metrics(metrics, stack, height, width):
+    '''
+    Scatters the metrics of a (possibly compacted) stack back to the full raster shape
+
+    Args:
+        metrics (dict): 1D numpy array per metric, as returned by run_metrics_chain
+        stack (numpy array or PixelStack): stack the metrics were computed from
+        height (int): raster height
+        width (int): raster width
+
+    Returns:
+        raster_metrics (dict): 2D numpy array (height, width) per metric
+    '''
+    raster_metrics = {}
+    for name, values in metrics.items():
+        if isinstance(stack, PixelStack):
+            values = stack.scatter(values)
+        raster_metrics[name] = values.reshape(height, width)
+    return raster_metrics
+
+# ======================
+# Windowed (memory-bounded) version of the full chain
+# ======================
+def iter_windowed(file_list, veg_index, max_memory_mb=512, recovery_percents=(0.2, 0.8), num_years=5, cache_dir=None):
+    '''
+    Generator that pushes one spatial block at a time through the whole clean -> mask -> fit -> metrics chain.
+    Only the valid, disturbed pixels of each block are fitted and scored
+
+    Args:
+        file_list (list): list of file paths to geotiffs of vegetation indices
+        veg_index (string): either 'NDVI', 'SAVI', 'NBR'
+        max_memory_mb (int): memory budget for one block in megabytes
+        recovery_percents (tuple): recovery percentages (0 to 1) to get the number of years to recovery for
+        num_years (int): number of years post-disturbance regrowth for the regrowth metrics
+        cache_dir (string): optional folder of the on-disk image stack cache (see cube_cache); blocks are then
+                            sliced from the cached memmap, so the cache is used without loading the whole cube
+
+    Yields:
+        window (rasterio Window): window of the block in the raster
+        block_metrics (dict): 2D numpy array (window height, window width) per metric
+    '''
+    for window, active_stack in wp.wrapper_clean_ingest_windowed(file_list, veg_index, max_memory_mb, sparse=True,
+                                                                 cache_dir=cache_dir):
+        metrics = run_metrics_chain(active_stack, recovery_percents, num_years)
+        yield window, scatter_metrics(metrics, active_stack, window.height, window.width)
+
+def run_block(file_list, year_list, window, recovery_percents=(0.2, 0.8), num_years=5):
+    '''
+    Reads one window of the geotiffs and runs it through the whole chain
+
+    Args:
+        file_list (list): list of file paths to geotiffs of vegetation indices
+        year_list (list): list of years in image stack (potentially missing some years)
+        window (rasterio Window): window to process
+        recovery_percents (tuple): recovery percentages (0 to 1) to get the number of years to recovery for
+        num_years (int): number of years post-disturbance regrowth for the regrowth metrics
+
+    Returns:
+        block_metrics (dict): 2D numpy array (window height, window width) per metric
+    '''
+    image_block = ic.read_image_block(file_list, window)
+    active_stack = wp.clean_ingest_stack(image_block, year_list, sparse=True)
+    metrics = run_metrics_chain(active_stack, recovery_percents, num_years)
+    return scatter_metrics(metrics, active_stack, window.height, window.width)
+
+def run_windowed(file_list, veg_index, max_memory_mb=512, recovery_percents=(0.2, 0.8), num_years=5, cache_dir=None):
+    '''
+    Runs the whole chain block by block and assembles full-size 2D metric arrays.
+    Only the (small) metric rasters are held for the full scene, never the full image stack.
+
+    Args:
+        see iter_windowed
+
+    Returns:
+        metrics (dict): 2D numpy array (height, width) per metric
+        meta (dict): meta data for raster file
+        bounds: bounds for raster file
+    '''
+    year_list, meta, bounds = ic.get_stack_info(file_list, veg_index)
+    block_iter = iter_windowed(file_list, veg_index, max_memory_mb, recovery_percents, num_years, cache_dir)
+    metrics = assemble_blocks(block_iter, meta['height'], meta['width'])
+    return metrics, meta, bounds
+
+def assemble_blocks(block_iter, height, width):
+    '''
+    Stitches per-block metric arrays back into full-size 2D metric arrays
+
+    Args:
+        block_iter (iterable): (window, block_metrics) pairs, as yielded by iter_windowed
+        height (int): raster height
+        width (int): raster width
+
+    Returns:
+        metrics (dict): 2D numpy array (height, width) per metric
+    '''
+    metrics = {}
+    for window, block_metrics in block_iter:
+        for name, values in block_metrics.items():
+            if name not in metrics:
+                metrics[name] = np.full([height, width], np.nan)
+            metrics[name][window.toslices()] = values
+    return metrics
+
+# ======================
+# Multi-index joint processing (e.g., NBR, NDVI and SAVI together)
+# ======================
+def iter_multi_index(file_lists, max_memory_mb=512, recovery_percents=(0.2, 0.8), num_years=5,
+                     pre_years=PRE_ERUPTION_YEARS, erup_year=ERUPTION_YEAR):
+    '''
+    Generator that processes several vegetation indices of the same scene together, one spatial block at a time.
+    The year axis, gap structure, block windows and log-year design are built once; every block of every index
+    is read from one thread pool, and the trends of all indices are fitted in one batched solve.
+    Each index keeps its own validity and disturbance masks, so results equal separate runs per index
+
+    Args:
+        file_lists (dict): list of file paths to geotiffs per vegetation index ('NDVI', 'SAVI', 'NBR')
+        max_memory_mb (int): memory budget for one block (all indices together) in megabytes
+        recovery_percents (tuple): recovery percentages (0 to 1) to get the number of years to recovery for
+        num_years (int): number of years post-disturbance regrowth for the regrowth metrics
+        pre_years (tuple): the two pre-eruption years
+        erup_year (int): eruption year
+
+    Yields:
+        window (rasterio Window): window of the block in the raster
+        block_metrics (dict): per vegetation index, 2D numpy array (window height, window width) per metric
+    '''
+    good_veg_index = ['NBR', 'NDVI', 'SAVI']
+    veg_indices = list(file_lists)
+    sorted_files = {}
+    year_lists = []
+    for veg_index in veg_indices:
+        if veg_index not in good_veg_index:
+            raise ValueError("Inappropriate vegetation index chosen!")
+        sorted_files[veg_index], index_years = ic.sort_by_year(file_lists[veg_index], veg_index)
+        year_lists.append(index_years)
+    if any(index_years != year_lists[0] for index_years in year_lists):
+        raise ValueError("Vegetation index stacks do not cover the same years!")
+
+    all_files = [file for veg_index in veg_indices for file in sorted_files[veg_index]]
+    year_list, meta, bounds = ic.get_stack_info(sorted_files[veg_indices[0]], veg_indices[0])
+    depth = len(year_list)
+
+    # shared log-year design of the post-eruption years
+    x = tf.log_year_axis(year_list[-1] - erup_year + 1)
+
+    windows = ic.get_block_windows(meta['height'], meta['width'], year_list, max_memory_mb / len(veg_indices))
+    for window in windows:
+        image_block = ic.read_stack(all_files, window)
+        stacks = {}
+        for k, veg_index in enumerate(veg_indices):
+            valid_stack = ic.fused_clean_ingest(image_block[:, :, k*depth:(k + 1)*depth], year_list,
+                                                pre_years=pre_years, erup_year=erup_year)
+            stacks[veg_index] = valid_stack.compact(valid_stack.valid)
+
+        # one batched solve for the active pixels of every index
+        post_erup_values = np.concatenate([stacks[veg_index].since(erup_year) for veg_index in veg_indices])
+        fit_result = tf._ols_from_sums(*tf._regression_sums(post_erup_values, x))
+        splits = np.cumsum([stacks[veg_index].num_pixels for veg_index in veg_indices])[:-1]
+
+        block_metrics = {}
+        for veg_index, index_fit in zip(veg_indices, np.split(fit_result, splits)):
+            stack = stacks[veg_index]
+            dVI = pv.get_dVI(stack, pre_years, erup_year)
+            metric_records = rm.compute_metrics(stack, index_fit, dVI, recovery_percents, num_years, pre_years, erup_year)
+            metrics = metrics_to_dict(metric_records, index_fit)
+            block_metrics[veg_index] = scatter_metrics(metrics, stack, window.height, window.width)
+        yield window, block_metrics
+
+def run_multi_index(file_lists, max_memory_mb=512, recovery_percents=(0.2, 0.8), num_years=5,
+                    pre_years=PRE_ERUPTION_YEARS, erup_year=ERUPTION_YEAR):
+    '''
+    Runs several vegetation indices through the whole chain together (see iter_multi_index)
+    and assembles full-size 2D metric arrays per index
+
+    Returns:
+        metrics (dict): per vegetation index, 2D numpy array (height, width) per metric
+        meta (dict): meta data for raster file
+        bounds: bounds for raster file
+    '''
+    veg_index = list(file_lists)[0]
+    year_list, meta, bounds = ic.get_stack_info(file_lists[veg_index], veg_index)
+    metrics = {veg_index: {} for veg_index in file_lists}
+    for window, block_metrics in iter_multi_index(file_lists, max_memory_mb, recovery_percents, num_years, pre_years, erup_year):
+        for veg_index, index_metrics in block_metrics.items():
+            for name, values in index_metrics.items():
+                if name not in metrics[veg_index]:
+                    metrics[veg_index][name] = np.full([meta['height'], meta['width']], np.nan)
+                metrics[veg_index][name][window.toslices()] = values
+    return metrics, meta, bounds
@@ -0,0 +1,142 @@
+# ======================
+# Pixel-major (time-contiguous) layout of the annual rasters
+# The yearly geotiffs are stored year by year, so in the (height, width, years) image stack every pixel's time series
+# is strided. The transform stage rechunks the rasters block by block (bounded memory) into the gap-filled cube of
+# cube_cache, whose C order puts every pixel's years next to each other; as a (pixels, years) array it is read
+# chunk by chunk, sequentially, by the cleaning, fitting and metric kernels
+# ======================
+
+import os
+import time
+import shutil
+import numpy as np
+import ingest_and_clean as ic
+import ic_wrapper as wp
+import pipeline
+import cube_cache
+import instrumentation as instr
+from pixel_stack import PixelStack, PRE_ERUPTION_YEARS, ERUPTION_YEAR
+
+def open_pixel_major(file_list, veg_index, cache_dir, max_memory_mb=512):
+    '''
+    Transforms the geotiffs to the pixel-major layout (only the first time, or when the files change) and opens it
+
+    Args:
+        file_list (list): list of file paths to geotiffs of vegetation indices
+        veg_index (string): either 'NDVI', 'SAVI', 'NBR'
+        cache_dir (string): folder of the on-disk layout (see cube_cache)
+        max_memory_mb (int): memory budget in megabytes for the blocks read during the transform
+
+    Returns:
+        pixels (numpy memmap): read-only (pixels, years) array; row i holds the gap-filled series of flat pixel i
+        yearly_years (list): full list of years
+        meta (dict): meta data for raster file
+        bounds: bounds for raster file
+    '''
+    cube, yearly_years, meta, bounds = cube_cache.open_cached_stack(file_list, veg_index, cache_dir, max_memory_mb)
+    # the cube is C-contiguous, so this is a view
+    pixels = cube.reshape(-1, cube.shape[2])
+    return pixels, yearly_years, meta, bounds
+
+def iter_pixel_chunks(pixels, yearly_years, chunk_pixels=131072, valid_num=20, disturbance_factor=0.2,
+                      pre_years=PRE_ERUPTION_YEARS, erup_year=ERUPTION_YEAR):
+    '''
+    Generator reading the pixel-major layout sequentially, one contiguous chunk of pixels at a time,
+    and yielding the valid, disturbed pixels of each chunk (same masks as ingest_and_clean.fused_clean_ingest)
+
+    Args:
+        pixels (numpy array): (pixels, years) gap-filled array (see open_pixel_major)
+        yearly_years (list): full list of years
+        chunk_pixels (int): number of pixels read at a time
+        valid_num (int): pixels with valid_num or more nans are invalid
+        disturbance_factor (float): disturbance threshold (see ingest_and_clean.get_disturbed_pixel_array)
+        pre_years (tuple): the two pre-eruption years
+        erup_year (int): eruption year
+
+    Yields:
+        start (int): flat index of the first pixel of the chunk
+        stack (PixelStack): compacted stack of the chunk's active pixels (index relative to start)
+    '''
+    years = np.asarray(yearly_years)
+    pre_first, pre_second, erup = ic.get_year_columns(yearly_years, [pre_years[0], pre_years[1], erup_year])
+    for start in range(0, pixels.shape[0], chunk_pixels):
+        chunk = np.asarray(pixels[start:start + chunk_pixels])
+        nan_per_pixel = np.count_nonzero(np.isnan(chunk), axis=1)
+        chunk_valid = ic.get_chunk_valid(chunk, nan_per_pixel, pre_first, pre_second, erup, valid_num, disturbance_factor)
+        active = np.flatnonzero(chunk_valid)
+        yield start, PixelStack(chunk[active], years, np.ones(active.shape[0], dtype=bool), index=active,
+                                full_pixels=chunk.shape[0])
+
+def run_pixel_major(file_list, veg_index, cache_dir, chunk_pixels=131072, recovery_percents=(0.2, 0.8), num_years=5,
+                    max_memory_mb=512, valid_num=20, disturbance_factor=0.2, pre_years=PRE_ERUPTION_YEARS,
+                    erup_year=ERUPTION_YEAR):
+    '''
+    Runs clean -> mask -> fit -> metrics on the pixel-major layout, chunk by chunk
+
+    Args:
+        file_list (list): list of file paths to geotiffs of vegetation indices
+        veg_index (string): either 'NDVI', 'SAVI', 'NBR'
+        cache_dir (string): folder of the on-disk layout
+        chunk_pixels (int): number of pixels processed at a time
+        recovery_percents (tuple): recovery percentages (0 to 1) to get the number of years to recovery for
+        num_years (int): number of years post-disturbance regrowth for the regrowth metrics
+        max_memory_mb (int): memory budget in megabytes for the blocks read during the transform
+        valid_num (int): pixels with valid_num or more nans are invalid
+        disturbance_factor (float): disturbance threshold (see ingest_and_clean.get_disturbed_pixel_array)
+        pre_years (tuple): the two pre-eruption years
+        erup_year (int): eruption year
+
+    Returns:
+        metrics (dict): 2D numpy array (height, width) per metric
+        meta (dict): meta data for raster file
+        bounds: bounds for raster file
+    '''
+    pixels, yearly_years, meta, bounds = open_pixel_major(file_list, veg_index, cache_dir, max_memory_mb)
+    metrics = {}
+    with instr.stage('pixel_major_metrics', pixels=pixels.shape[0]):
+        for start, stack in iter_pixel_chunks(pixels, yearly_years, chunk_pixels, valid_num, disturbance_factor,
+                                              pre_years, erup_year):
+            chunk_metrics = pipeline.run_metrics_chain(stack, recovery_percents, num_years, pre_years, erup_year)
+            for name, values in chunk_metrics.items():
+                if name not in metrics:
+                    metrics[name] = np.full(pixels.shape[0], np.nan)
+                metrics[name][start:start + stack.full_pixels] = stack.scatter(values)
+    metrics = {name: values.reshape(meta['height'], meta['width']) for name, values in metrics.items()}
+    return metrics, meta, bounds
+
+# ======================
+# Benchmark of the pixel-major layout against the (height, width, years) path
+# ======================
+def benchmark_layouts(file_list, veg_index, cache_dir, chunk_pixels=131072, recovery_percents=(0.2, 0.8), num_years=5):
+    '''
+    Times the full chain on the (height, width, years) image stack (create_image_stack -> fused cleaning -> metrics)
+    against the transform to the pixel-major layout and the chain on that layout, and checks the metrics are equal.
+    An existing layout of the files in cache_dir is removed first, so that the transform is timed
+
+    Returns:
+        timings (dict): seconds for 'hwt' (the current path), 'transform' (building the layout),
+                        'pixel_major' (metrics from the existing layout); and 'equal' (bool)
+    '''
+    timings = {}
+    start = time.perf_counter()
+    image_stack, year_list, stack_depth, meta, bounds = ic.create_image_stack(file_list, veg_index)
+    stack = wp.clean_ingest_stack(image_stack, year_list, sparse=True, fused=True)
+    hwt_metrics = pipeline.scatter_metrics(pipeline.run_metrics_chain(stack, recovery_percents, num_years), stack,
+                                           meta['height'], meta['width'])
+    timings['hwt'] = time.perf_counter() - start
+    del image_stack, stack
+
+    cache_path = cube_cache.get_cache_path(file_list, veg_index, cache_dir)
+    if os.path.exists(cache_path):
+        shutil.rmtree(cache_path)
+    start = time.perf_counter()
+    open_pixel_major(file_list, veg_index, cache_dir)
+    timings['transform'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pixel_major_metrics = run_pixel_major(file_list, veg_index, cache_dir, chunk_pixels, recovery_percents, num_years)[0]
+    timings['pixel_major'] = time.perf_counter() - start
+
+    timings['equal'] = all(np.array_equal(hwt_metrics[name], pixel_major_metrics[name], equal_nan=True) for name in hwt_metrics)
+    instr.log('hwt path (s): ', timings['hwt'], ' transform (s): ', timings['transform'], ' pixel-major path (s): ', timings['pixel_major'])
+    return timings
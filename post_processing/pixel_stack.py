@@ -0,0 +1,154 @@
+# ======================
+# Compact pixel stack: flattened yearly vegetation index values with one shared year axis
+# Replaces the (pixels, years, 2) years-plus-values array, which repeats the same years for every pixel
+# ======================
+
+import numpy as np
+import instrumentation as instr
+
+# Pre-eruption years (best data quality) and eruption year at Unzen volcano
+PRE_ERUPTION_YEARS = (1985, 1986)
+ERUPTION_YEAR = 1995
+
+class PixelStack:
+    '''
+    Flattened image stack of yearly vegetation index values
+
+    Attributes:
+        values (numpy array): 2D array (pixels, years) of vegetation index values; invalid pixels are np.nan
+        years (numpy array): 1D array of the years along axis 1 of values (shared by every pixel)
+        valid (numpy array): 1D bool array; True if the pixel is valid (see ingest_and_clean.get_valid_pixel_filter).
+                            None if the pixels have not been masked yet
+        height (int): raster height (None if the pixels do not come from a raster)
+        width (int): raster width (None if the pixels do not come from a raster)
+        meta (dict): meta data for raster file
+        bounds: bounds for raster file
+        index (numpy array): for a compacted stack (see compact), flat raster index of each row of values;
+                            None if values holds every pixel of the raster in order
+        full_pixels (int): number of pixels of the full (uncompacted) stack
+    '''
+    def __init__(self, values, years, valid=None, height=None, width=None, meta=None, bounds=None, index=None, full_pixels=None):
+        self.values = values
+        self.years = np.asarray(years)
+        self.valid = valid
+        if meta is not None and height is None:
+            height, width = meta['height'], meta['width']
+        self.height = height
+        self.width = width
+        self.meta = meta
+        self.bounds = bounds
+        self.index = index
+        if full_pixels is None:
+            full_pixels = values.shape[0]
+        self.full_pixels = full_pixels
+
+    @classmethod
+    def from_withyears(cls, valid_veg_withyears):
+        '''
+        Creates a PixelStack from a (pixels, years, 2) years-plus-values array (values are a view, not a copy)
+        '''
+        years = valid_veg_withyears[0, :, 0].astype(int)
+        return cls(valid_veg_withyears[:, :, 1], years)
+
+    @property
+    def num_pixels(self):
+        return self.values.shape[0]
+
+    @property
+    def num_years(self):
+        return self.values.shape[1]
+
+    def year_index(self, year):
+        '''
+        Column index of a year in values
+        '''
+        index = np.flatnonzero(self.years == year)
+        if index.shape[0] == 0:
+            raise ValueError("Year " + str(year) + " is not in the image stack!")
+        return int(index[0])
+
+    def column(self, year):
+        '''
+        Vegetation index values of every pixel for one year
+        '''
+        return self.values[:, self.year_index(year)]
+
+    def since(self, year):
+        '''
+        Vegetation index values of every pixel from a year (included) onwards
+        '''
+        return self.values[:, self.year_index(year):]
+
+    def apply_mask(self, mask):
+        '''
+        Returns a new PixelStack where the pixels outside the mask are set to np.nan
+
+        Args:
+            mask (numpy array): bool array of shape (pixels,) or (pixels, 1); True if pixel is kept
+        '''
+        mask = mask.reshape(-1)
+        values = np.where(mask[:, np.newaxis], self.values, np.nan)
+        return PixelStack(values, self.years, mask, self.height, self.width, self.meta, self.bounds, self.index, self.full_pixels)
+
+    def compact(self, mask):
+        '''
+        Returns a new, dense PixelStack holding only the active pixels (inside the mask).
+        Fits and metrics run on the active pixels only; use scatter to put results back in place
+
+        Args:
+            mask (numpy array): bool array of shape (pixels,) or (pixels, 1); True if pixel is active
+        '''
+        active = np.flatnonzero(mask.reshape(-1))
+        index = active if self.index is None else self.index[active]
+        values = self.values[active]
+        valid = np.ones(active.shape[0], dtype=bool)
+        instr.log('active pixels: ', active.shape[0], ' of ', self.full_pixels)
+        return PixelStack(values, self.years, valid, self.height, self.width, self.meta, self.bounds, index, self.full_pixels)
+
+    def scatter(self, pixel_values, fill=np.nan):
+        '''
+        Scatters per-pixel results of a compacted stack back to every pixel of the full stack;
+        pixels that are not active are set to fill
+        '''
+        if self.index is None:
+            return pixel_values
+        full_values = np.full((self.full_pixels,) + pixel_values.shape[1:], fill)
+        full_values[self.index] = pixel_values
+        return full_values
+
+    def to_raster(self, pixel_values):
+        '''
+        Reshapes a per-pixel 1D array (e.g., a recovery metric) back to the raster shape (height, width)
+        '''
+        return self.scatter(pixel_values).reshape(self.height, self.width)
+
+    def to_withyears(self):
+        '''
+        Returns the (pixels, years, 2) years-plus-values array used by the original functions
+        '''
+        years = np.broadcast_to(self.years.astype(float), self.values.shape)
+        return np.stack([years, self.values], axis=2)
+
+def as_pixel_stack(stack):
+    '''
+    Returns stack as a PixelStack; stack is either a PixelStack or a (pixels, years, 2) years-plus-values array
+    '''
+    if isinstance(stack, PixelStack):
+        return stack
+    return PixelStack.from_withyears(stack)
+
+def pre_eruption_average(stack, pre_years=PRE_ERUPTION_YEARS):
+    '''
+    Average of the vegetation index values of the two pre-eruption years;
+    falls back to the first pre-eruption year if the average is np.nan
+
+    Args:
+        stack (PixelStack): pixel stack
+        pre_years (tuple): the two pre-eruption years
+
+    Returns:
+        veg_pre (numpy array): pre-eruption vegetation index value for each pixel
+    '''
+    veg_first = stack.column(pre_years[0])
+    veg_second = stack.column(pre_years[1])
+    return np.where(np.isnan((veg_first + veg_second) / 2), veg_first, (veg_first + veg_second) / 2)
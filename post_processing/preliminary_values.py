@@ -3,29 +3,31 @@
 # ======================
 
 import numpy as np
+from pixel_stack import as_pixel_stack, pre_eruption_average, PRE_ERUPTION_YEARS, ERUPTION_YEAR
+import instrumentation as instr
 
-def get_dVI(valid_vegstack_withyears): 
+@instr.instrumented('get_dVI', pixels=(0, 1))
+def get_dVI(valid_vegstack_withyears, pre_years=PRE_ERUPTION_YEARS, erup_year=ERUPTION_YEAR): 
     '''
     This function creates the differenced vegetation index value (dVI), where dVI 
     is the absolute vegetation index difference pre- and post- eruption
 
     Args: 
-        valid_vegstack_withyears (numpy array): complete image stack
+        valid_vegstack_withyears (numpy array or PixelStack): complete image stack
+        pre_years (tuple): the two pre-eruption years
+        erup_year (int): eruption year
 
     Returns: 
         dVI (numpy array): differenced vegetation index value for pre- and post-eruption years 
     '''
-    # remove the years
-    valid_vegstack = valid_vegstack_withyears[:, :, 1]
+    valid_vegstack = as_pixel_stack(valid_vegstack_withyears)
 
     # Get the average of pre-eruption VI values. 1985 and 1986 were chosen 
     # due to best data quality
-    vi85 = valid_vegstack[:, 1] # 1985
-    vi86 = valid_vegstack[:, 2] # 1986
-    vi_pre = np.where(np.isnan((vi85 + vi86) / 2), vi85, (vi85 + vi86) / 2)
+    vi_pre = pre_eruption_average(valid_vegstack, pre_years)
 
     # get post-eruption VI values: 1995
-    vi_post = valid_vegstack[:, 11]
+    vi_post = valid_vegstack.column(erup_year)
 
     dVI = vi_pre - vi_post
     return dVI
\ No newline at end of file
@@ -0,0 +1,204 @@
+# ======================
+# Sampled preview of the recovery-metric distributions
+# Draws a stratified random sample of pixels, reads only those pixels from the geotiffs, runs the full
+# clean -> mask -> fit -> metrics chain on them and reports metric distributions with bootstrap confidence intervals.
+# Meant for tuning the analysis choices (disturbance factor, valid_num, post-eruption start year, ...) in seconds
+# ======================
+
+import numpy as np
+import matplotlib.pyplot as plt
+import ingest_and_clean as ic
+import trend_fitting as tf
+import recovery_metrics as rm
+import preliminary_values as pv
+import pipeline
+from pixel_stack import PRE_ERUPTION_YEARS, ERUPTION_YEAR
+
+def stratified_sample(height, width, sample_size=5000, n_strata=8, seed=0):
+    '''
+    Stratified random sample of pixels: the raster is split into n_strata x n_strata spatial strata and each stratum
+    gets a share of the sample proportional to its number of pixels (so the sample is self-weighting)
+
+    Args:
+        height (int): raster height
+        width (int): raster width
+        sample_size (int): total number of pixels to sample
+        n_strata (int): number of strata along each axis
+        seed (int): random seed
+
+    Returns:
+        rows (numpy array): row of each sampled pixel
+        cols (numpy array): column of each sampled pixel
+        strata (numpy array): stratum of each sampled pixel
+    '''
+    rng = np.random.default_rng(seed)
+    row_edges = np.linspace(0, height, n_strata + 1).astype(int)
+    col_edges = np.linspace(0, width, n_strata + 1).astype(int)
+    sample_size = min(sample_size, height * width)
+    rows, cols, strata = [], [], []
+    for i in range(n_strata):
+        for j in range(n_strata):
+            stratum_height = row_edges[i + 1] - row_edges[i]
+            stratum_width = col_edges[j + 1] - col_edges[j]
+            stratum_pixels = stratum_height * stratum_width
+            n = min(int(round(sample_size * stratum_pixels / (height * width))), stratum_pixels)
+            if n == 0:
+                continue
+            flat = rng.choice(stratum_pixels, n, replace=False)
+            rows.append(row_edges[i] + flat // stratum_width)
+            cols.append(col_edges[j] + flat % stratum_width)
+            strata.append(np.full(n, i * n_strata + j))
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(strata)
+
+def check_chain_years(year_list, pre_years=PRE_ERUPTION_YEARS, erup_year=ERUPTION_YEAR, fit_start_year=None):
+    '''
+    Checks that the pre-eruption years, the eruption year and the first year of the trend fit are in the stack
+    of year_list (raises ValueError otherwise), before any pixel is read or ingested
+    '''
+    if fit_start_year is None:
+        fit_start_year = erup_year
+    ic.get_year_columns(year_list, [pre_years[0], pre_years[1], erup_year, fit_start_year])
+
+def run_sample_chain(pixel_values, year_list, valid_num=20, disturbance_factor=0.2, pre_years=PRE_ERUPTION_YEARS,
+                     erup_year=ERUPTION_YEAR, fit_start_year=None, method='batch', recovery_percents=(0.2, 0.8), num_years=5,
+                     max_pval=0.05, min_r2=0.7, max_years=30):
+    '''
+    Runs the full chain on sampled pixels with every analysis choice as a parameter
+
+    Args:
+        pixel_values (numpy array): (pixels, depth) values of the sampled pixels (see ingest_and_clean.read_pixels)
+        year_list (list): list of years of the geotiffs (potentially missing some years)
+        valid_num (int): pixels with valid_num or more nans are invalid
+        disturbance_factor (float): pixels are disturbed if VIpre - VIerup > disturbance_factor * VIpre
+        pre_years (tuple): the two pre-eruption years
+        erup_year (int): eruption year (disturbance test and dVI)
+        fit_start_year (int): first year of the trend fit (the post-eruption start column); defaults to erup_year
+        method (string): trend model (see trend_fitting.TREND_MODELS)
+        recovery_percents (tuple): recovery percentages (0 to 1) to get the number of years to recovery for
+        num_years (int): number of years post-disturbance regrowth for the regrowth metrics
+        max_pval (float): p value threshold of the QA filter
+        min_r2 (float): r2 threshold of the QA filter
+        max_years (int): years to recovery of max_years or more are considered invalid
+
+    Returns:
+        metrics (dict): 1D numpy array per metric, one value per sampled pixel (np.nan for pixels that are not valid and disturbed)
+    '''
+    check_chain_years(year_list, pre_years, erup_year, fit_start_year)
+    if fit_start_year is None:
+        fit_start_year = erup_year
+    image_block = pixel_values.reshape(pixel_values.shape[0], 1, pixel_values.shape[1])
+    valid_stack = ic.fused_clean_ingest(image_block, year_list, valid_num, disturbance_factor, pre_years, erup_year)
+    stack = valid_stack.compact(valid_stack.valid)
+
+    fit_result = tf.trend_fit(stack, method, fit_start_year)
+    dVI = pv.get_dVI(stack, pre_years, erup_year)
+    metric_records = rm.compute_metrics(stack, fit_result, dVI, recovery_percents, num_years, pre_years, erup_year,
+                                        max_pval, min_r2, max_years)
+    metrics = pipeline.metrics_to_dict(metric_records, fit_result)
+    return {name: stack.scatter(values) for name, values in metrics.items()}
+
+def stratified_bootstrap(strata, n_boot=1000, seed=0):
+    '''
+    Bootstrap resamples of the sample indices, resampling with replacement within each stratum
+
+    Returns:
+        resamples (numpy array): (n_boot, sample size) array of indices into the sample
+    '''
+    rng = np.random.default_rng(seed)
+    parts = []
+    for stratum in np.unique(strata):
+        members = np.flatnonzero(strata == stratum)
+        parts.append(members[rng.integers(0, members.shape[0], (n_boot, members.shape[0]))])
+    return np.concatenate(parts, axis=1)
+
+def summarize(values, resamples, confidence=0.95, bins=20):
+    '''
+    Distribution summary of one metric over the sample, with bootstrap confidence intervals
+
+    Args:
+        values (numpy array): metric of each sampled pixel (np.nan where not defined)
+        resamples (numpy array): bootstrap resamples (see stratified_bootstrap)
+        confidence (float): confidence level of the intervals
+        bins (int): number of histogram bins
+
+    Returns:
+        summary (dict): 'n' (pixels with a value), 'mean', 'median', 'p10', 'p90', '<statistic>_ci' (low, high)
+                        for each of them, and 'hist' (counts, bin edges)
+    '''
+    finite = values[np.isfinite(values)]
+    summary = {'n': int(finite.shape[0])}
+    if finite.shape[0] == 0:
+        return summary
+    boot = values[resamples]
+    alpha = (1 - confidence) / 2
+    with np.errstate(invalid='ignore'):
+        statistics = {'mean': (np.mean(finite), np.nanmean(boot, axis=1)),
+                      'median': (np.median(finite), np.nanmedian(boot, axis=1)),
+                      'p10': (np.percentile(finite, 10), np.nanpercentile(boot, 10, axis=1)),
+                      'p90': (np.percentile(finite, 90), np.nanpercentile(boot, 90, axis=1))}
+    for name, (estimate, boot_estimates) in statistics.items():
+        summary[name] = float(estimate)
+        summary[name + '_ci'] = tuple(np.nanquantile(boot_estimates, [alpha, 1 - alpha]).tolist())
+    summary['hist'] = np.histogram(finite, bins)
+    return summary
+
+def preview(file_list, veg_index, sample_size=5000, n_strata=8, n_boot=1000, confidence=0.95, seed=0, **chain_params):
+    '''
+    Sampled preview of the recovery-metric distributions of a scene
+
+    Args:
+        file_list (list): list of file paths to geotiffs of vegetation indices
+        veg_index (string): either 'NDVI', 'SAVI', 'NBR'
+        sample_size (int): number of pixels to sample
+        n_strata (int): number of spatial strata along each axis
+        n_boot (int): number of bootstrap resamples
+        confidence (float): confidence level of the intervals
+        seed (int): random seed of the sample and of the bootstrap
+        **chain_params: analysis choices passed to run_sample_chain (valid_num, disturbance_factor, fit_start_year, ...)
+
+    Returns:
+        result (dict): 'sample' (sampled pixel count), 'active_fraction' and 'active_fraction_ci' (share of valid,
+                        disturbed pixels), 'qa_fraction' and 'qa_fraction_ci' (share of active pixels passing QA),
+                        and 'metrics' (summary per metric, see summarize)
+    '''
+    good_veg_index = ['NBR', 'NDVI', 'SAVI']
+    if veg_index not in good_veg_index:
+        raise ValueError("Inappropriate vegetation index chosen!")
+
+    year_list, meta, bounds = ic.get_stack_info(file_list, veg_index)
+    check_chain_years(year_list, **{name: chain_params[name] for name in ('pre_years', 'erup_year', 'fit_start_year')
+                                    if name in chain_params})
+    rows, cols, strata = stratified_sample(meta['height'], meta['width'], sample_size, n_strata, seed)
+    pixel_values = ic.read_pixels(file_list, rows, cols)
+    metrics = run_sample_chain(pixel_values, year_list, **chain_params)
+
+    resamples = stratified_bootstrap(strata, n_boot, seed)
+    alpha = (1 - confidence) / 2
+    active = np.isfinite(metrics['dVI']).astype(float)
+    qa = np.where(active > 0, metrics['qa'] == 1, np.nan)
+    result = {'sample': int(rows.shape[0]),
+              'active_fraction': float(active.mean()),
+              'active_fraction_ci': tuple(np.quantile(active[resamples].mean(axis=1), [alpha, 1 - alpha]).tolist())}
+    with np.errstate(invalid='ignore'):
+        result['qa_fraction'] = float(np.nanmean(qa)) if active.any() else np.nan
+        result['qa_fraction_ci'] = tuple(np.nanquantile(np.nanmean(qa[resamples], axis=1), [alpha, 1 - alpha]).tolist())
+    result['metrics'] = {name: summarize(values, resamples, confidence) for name, values in metrics.items() if name != 'qa'}
+    return result
+
+def plot_preview(result, out_file=None):
+    '''
+    Histograms of every metric of a preview, with the median and its confidence interval
+    '''
+    names = [name for name, summary in result['metrics'].items() if summary['n'] > 0]
+    fig, axes = plt.subplots(1, len(names), figsize=(4 * len(names), 3.5), squeeze=False)
+    for ax, name in zip(axes[0], names):
+        summary = result['metrics'][name]
+        counts, edges = summary['hist']
+        ax.stairs(counts, edges, fill=True)
+        ax.axvline(summary['median'], color='k')
+        ax.axvspan(*summary['median_ci'], color='k', alpha=0.2)
+        ax.set_title(name + ' (n=' + str(summary['n']) + ')')
+    fig.tight_layout()
+    if out_file is not None:
+        fig.savefig(out_file)
+    return fig
@@ -5,11 +5,15 @@
 # 2. Obtain slope of trend curve (DeSchutter et al., 2015)
 # 3. Obtain absolute measure of post-disturbance regrowth after 5 years (Kennedy et al., 2012)
 # 4. Obtain relative measure of post-disturbance regrowth after 5 years (Kennedy et al., 2012)
+# compute_metrics derives all of the above in one vectorized pass with a shared QA mask
 # ======================
 
 import numpy as np
+from pixel_stack import as_pixel_stack, pre_eruption_average, PRE_ERUPTION_YEARS, ERUPTION_YEAR
+import instrumentation as instr
 
-def numyears_from_trend(valid_veg_withyears, ind_fit_result, recovery_percent): 
+@instr.instrumented('numyears_from_trend', pixels=(0, 1))
+def numyears_from_trend(valid_veg_withyears, ind_fit_result, recovery_percent, pre_years=PRE_ERUPTION_YEARS): 
     '''
     Obtains the number of years needed to reach a certain recovery percentage,
     as modeled from the trend fitted curve. 
@@ -17,20 +21,16 @@ def numyears_from_trend(valid_veg_withyears, ind_fit_result, recovery_percent):
 
     Args: 
         ind_fit_result (numpy_array): n-dim array of trend fitting results
-        valid_veg_withyears (numpy array): complete image stack
+        valid_veg_withyears (numpy array or PixelStack): complete image stack
         recovery_percent (float): from 0 to 1 to represent percentage recovery. e.g., 0.8 for 80% recovery
+        pre_years (tuple): the two pre-eruption years
     Returns: 
         final_filtered (numpy_array): number of years for each pixel
     '''
     
     # get pre-eruption veg ind values at the desired percentage
-    shp = valid_veg_withyears.shape
-    valid_veg_withoutyears = valid_veg_withyears[:, :, 1]
-    years = valid_veg_withyears[:, :, 0]
-
-    veg_1985 = valid_veg_withoutyears[:, 1]
-    veg_1986 = valid_veg_withoutyears[:, 2]
-    veg_pre_avg = np.where(np.isnan((veg_1985 + veg_1986)/2), veg_1985, (veg_1985 + veg_1986)/2)
+    valid_veg_stack = as_pixel_stack(valid_veg_withyears)
+    veg_pre_avg = pre_eruption_average(valid_veg_stack, pre_years)
     veg_pre_avg_recovered = recovery_percent*veg_pre_avg # y value
     
     # get slope and constant for log equation (y = alog(x) + b)
@@ -58,6 +58,7 @@ def numyears_from_trend(valid_veg_withyears, ind_fit_result, recovery_percent):
     return final_filtered
 
 # slope (beta)
+@instr.instrumented('get_slope', pixels=(0, 1))
 def get_slope(ind_fit_result):
     """
     Gets the slope (beta) of linear-log regression curve, after filtering for p < 0.05 and r2 > 0.7
@@ -84,6 +85,7 @@ def get_slope(ind_fit_result):
     return final_slope
 
 # get absolute measure of post-disturbance regrowth after 5 years
+@instr.instrumented('abs_regrowth', pixels=(0, 1))
 def abs_regrowth(ind_fit_result, num_years=5): 
     """
     Gets the absolute measure of post-disturbance regrowth from the linear-log regression curve (Kennedy et al., 2012)
@@ -116,6 +118,7 @@ def abs_regrowth(ind_fit_result, num_years=5):
     return filtered_abs_regrowth
     
 # get relative measure of post-disturbance regrowth
+@instr.instrumented('rel_regrowth', pixels=(0, 1))
 def rel_regrowth(ind_fit_result, abs_regrowth, dVI): 
     """
     Gets the relative measure of post-disturbance regrowth from the linear-log regression curve (Kennedy et al., 2012)
@@ -142,4 +145,95 @@ def rel_regrowth(ind_fit_result, abs_regrowth, dVI):
     
     RI = abs_regrowth / filtered_dIND
     
-    return RI
\ No newline at end of file
+    return RI
+
+# ======================
+# One-pass recovery metrics engine
+# ======================
+def get_qa_mask(ind_fit_result, max_pval=0.05, min_r2=0.7): 
+    """
+    QA mask of the trend fits: True where p < max_pval and r2 >= min_r2
+
+    Args: 
+        ind_fit_result (numpy_array): n-dim array of trend fitting results
+        max_pval (float): p value threshold
+        min_r2 (float): r2 threshold
+    Returns: 
+        qa (numpy array): bool array, one value per pixel
+    """
+    with np.errstate(invalid='ignore'): 
+        return (ind_fit_result[:, 2] < max_pval) & (ind_fit_result[:, 3] >= min_r2)
+
+def years_key(recovery_percent): 
+    """
+    Name of the years-to-recovery metric for a recovery percentage (e.g., 0.8 -> 'years_to_80')
+    """
+    return 'years_to_' + str(int(round(recovery_percent * 100)))
+
+@instr.instrumented('compute_metrics', pixels=(0, 1))
+def compute_metrics(valid_veg_withyears, ind_fit_result, dVI=None, recovery_percents=(0.2, 0.8), num_years=5, 
+                    pre_years=PRE_ERUPTION_YEARS, erup_year=ERUPTION_YEAR, max_pval=0.05, min_r2=0.7, max_years=30): 
+    """
+    Computes every recovery metric in one pass, with the QA filtering (p < 0.05 and r2 >= 0.7) done once
+
+    Args: 
+        valid_veg_withyears (numpy array or PixelStack): complete image stack
+        ind_fit_result (numpy_array): n-dim array of trend fitting results
+        dVI (numpy array): magnitude of change caused by the eruption; computed from the stack if None
+        recovery_percents (tuple): recovery percentages (0 to 1) to get the number of years to recovery for
+        num_years (int): number of years post-disturbance regrowth. Default is 5
+        pre_years (tuple): the two pre-eruption years
+        erup_year (int): eruption year
+        max_pval (float): p value threshold of the QA filter
+        min_r2 (float): r2 threshold of the QA filter
+        max_years (int): years to recovery of max_years or more are considered invalid
+    Returns: 
+        metrics (numpy structured array): one record per pixel (see metrics_from_fit)
+    """
+    valid_veg_stack = as_pixel_stack(valid_veg_withyears)
+    veg_pre_avg = pre_eruption_average(valid_veg_stack, pre_years)
+    if dVI is None: 
+        dVI = veg_pre_avg - valid_veg_stack.column(erup_year)
+    return metrics_from_fit(ind_fit_result, veg_pre_avg, dVI, recovery_percents, num_years, max_pval, min_r2, max_years)
+
+def metrics_from_fit(ind_fit_result, veg_pre_avg, dVI, recovery_percents=(0.2, 0.8), num_years=5, 
+                     max_pval=0.05, min_r2=0.7, max_years=30): 
+    """
+    Recovery metrics engine working only from the trend fits and the per-pixel pre-eruption values. 
+    Same values as get_slope, abs_regrowth, rel_regrowth and numyears_from_trend (including the 
+    notebook's filter of years <= 0), with every metric np.nan where the fit fails QA
+
+    Args: 
+        ind_fit_result (numpy_array): n-dim array of trend fitting results
+        veg_pre_avg (numpy array): pre-eruption vegetation index value for each pixel
+        dVI (numpy array): magnitude of change caused by the eruption (e.g., dNBR; dNDVI)
+        see compute_metrics for the other arguments
+    Returns: 
+        metrics (numpy structured array): one record per pixel with fields 'qa', 'dVI', 'slope', 
+                                        'abs_regrowth', 'rel_regrowth' and 'years_to_<percent>' per recovery percentage
+    """
+    slope = ind_fit_result[:, 0]
+    const = ind_fit_result[:, 1]
+    qa = get_qa_mask(ind_fit_result, max_pval, min_r2)
+
+    fields = [('qa', bool), ('dVI', float), ('slope', float), ('abs_regrowth', float), ('rel_regrowth', float)]
+    fields += [(years_key(recovery_percent), float) for recovery_percent in recovery_percents]
+    metrics = np.empty(ind_fit_result.shape[0], dtype=fields)
+
+    metrics['qa'] = qa
+    metrics['dVI'] = dVI
+    metrics['slope'] = np.where(qa, slope, np.nan)
+    # linear-log equation (y = alog(x) + b)
+    abs_diff = (const + slope*np.log10(num_years)) - (const + slope*np.log10(1))
+    metrics['abs_regrowth'] = np.where(qa, abs_diff, np.nan)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'): 
+        metrics['rel_regrowth'] = metrics['abs_regrowth'] / np.where(qa, dVI, np.nan)
+
+        # years to recovery for every recovery percentage at once: (pixels, percentages)
+        recovered = np.outer(veg_pre_avg, recovery_percents)
+        year = np.rint(10**((recovered - const[:, np.newaxis]) / slope[:, np.newaxis]))
+        good_year = (year > 0) & (year < max_years) & qa[:, np.newaxis]
+        year = np.where(good_year, year, np.nan)
+    for i, recovery_percent in enumerate(recovery_percents): 
+        metrics[years_key(recovery_percent)] = year[:, i]
+    return metrics
@@ -0,0 +1,303 @@
+# ======================
+# Indexed on-disk store of per-pixel results: yearly vegetation index series, trend fits, dVI and recovery metrics
+# The raster is split into square tiles; each tile is one compressed .npz file holding only its valid,
+# disturbed pixels (with their flat raster index), and a json index holds the tiles, years, meta and bounds.
+# Queries for a pixel, a bounding box or a mask only read the tiles they touch
+# ======================
+
+import os
+import json
+from collections import OrderedDict
+import numpy as np
+import rasterio
+from rasterio.coords import BoundingBox
+from rasterio.windows import Window
+import ingest_and_clean as ic
+import ic_wrapper as wp
+import trend_fitting as tf
+import recovery_metrics as rm
+import preliminary_values as pv
+import pipeline
+import cube_cache
+import tiled_executor as te
+from pixel_stack import as_pixel_stack, PixelStack
+
+INDEX_FILE = 'index.json'
+# raw trend fits (the 'slope' recovery metric is the QA-filtered slope)
+FIT_FIELDS = ['fit_slope', 'fit_const', 'fit_pval', 'fit_r2']
+
+# ======================
+# Writing
+# ======================
+def build_result_store(file_list, veg_index, store_dir, tile_size=64, recovery_percents=(0.2, 0.8), num_years=5):
+    '''
+    Runs the full chain one strip of tiles at a time from the geotiffs and writes every tile's results to the store,
+    so that only one strip is in memory at a time
+
+    Args:
+        file_list (list): list of file paths to geotiffs of vegetation indices
+        veg_index (string): either 'NDVI', 'SAVI', 'NBR'
+        store_dir (string): folder of the store
+        tile_size (int): tile height and width in pixels
+        recovery_percents (tuple): recovery percentages (0 to 1) to get the number of years to recovery for
+        num_years (int): number of years post-disturbance regrowth for the regrowth metrics
+
+    Returns:
+        store (ResultStore): the new store
+    '''
+    good_veg_index = ['NBR', 'NDVI', 'SAVI']
+    if veg_index not in good_veg_index:
+        raise ValueError("Inappropriate vegetation index chosen!")
+
+    year_list, meta, bounds = ic.get_stack_info(file_list, veg_index)
+    writer = _StoreWriter(store_dir, veg_index, meta, bounds, tile_size)
+    for row_off in range(0, meta['height'], tile_size):
+        strip = Window(0, row_off, meta['width'], min(tile_size, meta['height'] - row_off))
+        image_block = ic.read_image_block(file_list, strip)
+        stack = wp.clean_ingest_stack(image_block, year_list, sparse=True, fused=True)
+        fit_result = tf.trend_fit(stack)
+        dVI = pv.get_dVI(stack)
+        metrics = pipeline.metrics_to_dict(rm.compute_metrics(stack, fit_result, dVI, recovery_percents, num_years), fit_result)
+
+        # flat index of the strip's active pixels in the full raster
+        index = stack.index + row_off * meta['width']
+        tiles = [tile for tile in te.get_tiles(meta['height'], meta['width'], tile_size) if tile.row_off == row_off]
+        writer.write_tiles(tiles, index, stack.years, stack.values, fit_result, dVI, metrics)
+    return writer.close()
+
+def save_results(store_dir, valid_veg_withyears, trend_attr, dVI, metrics, veg_index, meta, bounds, tile_size=64):
+    '''
+    Writes the results of an in-memory run (e.g., the notebook arrays) to the store
+
+    Args:
+        store_dir (string): folder of the store
+        valid_veg_withyears (numpy array or PixelStack): cleaned stack of every raster pixel (or a compacted PixelStack)
+        trend_attr (numpy array): trend fitting results (slope, const, pval, r2), one row per pixel of the stack
+        dVI (numpy array): differenced vegetation index, one value per pixel of the stack
+        metrics (dict): 1D numpy array per recovery metric, one value per pixel of the stack
+        veg_index (string): either 'NDVI', 'SAVI', 'NBR'
+        meta (dict): meta data for raster file
+        bounds: bounds for raster file
+        tile_size (int): tile height and width in pixels
+
+    Returns:
+        store (ResultStore): the new store
+    '''
+    stack = as_pixel_stack(valid_veg_withyears)
+    if isinstance(valid_veg_withyears, PixelStack) and stack.index is not None:
+        index = stack.index
+        values = stack.values
+    else:
+        # only pixels with at least one valid year are stored
+        index = np.flatnonzero(np.isfinite(stack.values).any(axis=1))
+        values = stack.values[index]
+        trend_attr, dVI = trend_attr[index], dVI[index]
+        metrics = {name: metric[index] for name, metric in metrics.items()}
+
+    writer = _StoreWriter(store_dir, veg_index, meta, bounds, tile_size)
+    writer.write_tiles(te.get_tiles(meta['height'], meta['width'], tile_size), index, stack.years, values, trend_attr, dVI, metrics)
+    return writer.close()
+
+class _StoreWriter:
+    '''
+    Writes tiles one at a time, then the index (written last so that an interrupted write is never read as a store)
+    '''
+    def __init__(self, store_dir, veg_index, meta, bounds, tile_size):
+        os.makedirs(store_dir, exist_ok=True)
+        index_path = os.path.join(store_dir, INDEX_FILE)
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        self.store_dir = store_dir
+        self.index = {'veg_index': veg_index, 'height': meta['height'], 'width': meta['width'], 'tile_size': tile_size,
+                      'meta': cube_cache.encode_meta(meta), 'bounds': list(bounds), 'years': None, 'metrics': None,
+                      'tiles': {}}
+
+    def write_tiles(self, tiles, index, years, values, fit_result, dVI, metrics):
+        '''
+        Splits per-pixel results (with their flat raster index) among the given tiles and writes each tile
+        '''
+        tile_size = self.index['tile_size']
+        num_tile_cols = -(-self.index['width'] // tile_size)
+        rows, cols = np.divmod(index, self.index['width'])
+        # pixels sorted by tile once (stable, so each tile keeps the raster order), instead of one mask per tile
+        tile_ids = (rows // tile_size) * num_tile_cols + cols // tile_size
+        order = np.argsort(tile_ids, kind='stable')
+        sorted_ids = tile_ids[order]
+        for tile in tiles:
+            tile_id = (tile.row_off // tile_size) * num_tile_cols + tile.col_off // tile_size
+            in_tile = order[np.searchsorted(sorted_ids, tile_id, 'left'):np.searchsorted(sorted_ids, tile_id, 'right')]
+            self.write_tile(tile, index[in_tile], years, values[in_tile], fit_result[in_tile], dVI[in_tile],
+                            {name: metric[in_tile] for name, metric in metrics.items()})
+
+    def write_tile(self, tile, index, years, values, fit_result, dVI, metrics):
+        tile_key = str(tile.row_off // self.index['tile_size']) + '_' + str(tile.col_off // self.index['tile_size'])
+        self.index['years'] = [int(year) for year in years]
+        self.index['metrics'] = list(metrics)
+        arrays = {'index': np.asarray(index, dtype=np.int64), 'values': values, 'fit': fit_result, 'dVI': dVI}
+        arrays.update({'metric_' + name: metric for name, metric in metrics.items()})
+        file = 'tile_' + tile_key + '.npz'
+        np.savez_compressed(os.path.join(self.store_dir, file), **arrays)
+        self.index['tiles'][tile_key] = {'file': file, 'count': int(arrays['index'].shape[0])}
+
+    def close(self):
+        with open(os.path.join(self.store_dir, INDEX_FILE), 'w') as f:
+            json.dump(self.index, f)
+        return ResultStore(self.store_dir)
+
+# ======================
+# Querying
+# ======================
+class ResultStore:
+    '''
+    Read-only access to a result store
+
+    Args:
+        store_dir (string): folder of the store
+        max_tiles (int): number of decompressed tiles kept in memory for repeated queries
+
+    Attributes:
+        years (numpy array): years of the stored series
+        metrics (list): names of the stored recovery metrics
+        meta (dict): meta data for raster file
+        bounds: bounds for raster file
+    '''
+    def __init__(self, store_dir, max_tiles=16):
+        index_path = os.path.join(store_dir, INDEX_FILE)
+        if not os.path.exists(index_path):
+            raise ValueError("No result store in " + store_dir + "!")
+        with open(index_path) as f:
+            self.index = json.load(f)
+        self.store_dir = store_dir
+        self.max_tiles = max_tiles
+        self.height = self.index['height']
+        self.width = self.index['width']
+        self.tile_size = self.index['tile_size']
+        self.years = np.asarray(self.index['years'])
+        self.metrics = self.index['metrics'] or []
+        self.meta = cube_cache.decode_meta(self.index['meta'])
+        self.bounds = BoundingBox(*self.index['bounds'])
+        self._tiles = OrderedDict()
+
+    # row/col <-> flat pixel index <-> map coordinates
+    def to_flat(self, row, col):
+        return np.asarray(row) * self.width + np.asarray(col)
+
+    def to_rowcol(self, flat_index):
+        return np.divmod(np.asarray(flat_index), self.width)
+
+    def xy_to_rowcol(self, x, y):
+        row, col = rasterio.transform.rowcol(self.meta['transform'], x, y)
+        return int(row), int(col)
+
+    def _tile(self, tile_key):
+        '''
+        Decompressed arrays of one tile (None if the tile has no stored pixels), with a small LRU cache
+        '''
+        if tile_key in self._tiles:
+            self._tiles.move_to_end(tile_key)
+            return self._tiles[tile_key]
+        entry = self.index['tiles'].get(tile_key)
+        if entry is None or entry['count'] == 0:
+            return None
+        with np.load(os.path.join(self.store_dir, entry['file'])) as f:
+            tile = {name: f[name] for name in f.files}
+        self._tiles[tile_key] = tile
+        if len(self._tiles) > self.max_tiles:
+            self._tiles.popitem(last=False)
+        return tile
+
+    def _select(self, tile_selection):
+        '''
+        Gathers the stored pixels selected in each tile into one result
+
+        Args:
+            tile_selection (list): (tile key, function of the tile's flat index array returning a bool selection)
+        '''
+        parts = []
+        for tile_key, select in tile_selection:
+            tile = self._tile(tile_key)
+            if tile is None:
+                continue
+            keep = select(tile['index'])
+            if keep.any():
+                parts.append({name: values[keep] for name, values in tile.items()})
+        if not parts:
+            parts = [{'index': np.empty(0, dtype=np.int64), 'values': np.empty([0, self.years.shape[0]]),
+                      'fit': np.empty([0, 4]), 'dVI': np.empty(0)}]
+            parts[0].update({'metric_' + name: np.empty(0) for name in self.metrics})
+        return self._result({name: np.concatenate([part[name] for part in parts]) for name in parts[0]})
+
+    def _result(self, arrays):
+        rows, cols = self.to_rowcol(arrays['index'])
+        result = {'index': arrays['index'], 'row': rows, 'col': cols, 'years': self.years,
+                  'values': arrays['values'], 'dVI': arrays['dVI']}
+        for i, field in enumerate(FIT_FIELDS):
+            result[field] = arrays['fit'][:, i]
+        for name in self.metrics:
+            result[name] = arrays['metric_' + name]
+        return result
+
+    def query_pixel(self, row, col):
+        '''
+        Series, fit and metrics of one pixel
+
+        Returns:
+            result (dict): 'years', 'values' (1D series), 'dVI', fit fields ('fit_slope', 'fit_const', 'fit_pval', 'fit_r2') and
+                        every metric as scalars; None if the pixel is not stored (not valid or not disturbed)
+        '''
+        if not (0 <= row < self.height and 0 <= col < self.width):
+            raise ValueError("Pixel is outside the raster!")
+        flat = int(self.to_flat(row, col))
+        tile_key = str(row // self.tile_size) + '_' + str(col // self.tile_size)
+        result = self._select([(tile_key, lambda index: index == flat)])
+        if result['index'].shape[0] == 0:
+            return None
+        pixel = {name: values[0] for name, values in result.items() if name != 'years'}
+        pixel['years'] = self.years
+        return pixel
+
+    def query_xy(self, x, y):
+        '''
+        Same as query_pixel, for map coordinates in the raster's crs
+        '''
+        return self.query_pixel(*self.xy_to_rowcol(x, y))
+
+    def query_window(self, row_start, row_stop, col_start, col_stop):
+        '''
+        Every stored pixel inside a window of rows and columns (stops excluded)
+
+        Returns:
+            result (dict): 1D arrays ('index', 'row', 'col', 'dVI', fit fields and metrics) and the 2D 'values'
+                        (pixels, years) of the stored pixels, plus 'years'
+        '''
+        row_start, col_start = max(row_start, 0), max(col_start, 0)
+        row_stop, col_stop = min(row_stop, self.height), min(col_stop, self.width)
+
+        def select(index):
+            rows, cols = self.to_rowcol(index)
+            return (rows >= row_start) & (rows < row_stop) & (cols >= col_start) & (cols < col_stop)
+
+        tile_selection = []
+        for tile_row in range(row_start // self.tile_size, (row_stop - 1) // self.tile_size + 1):
+            for tile_col in range(col_start // self.tile_size, (col_stop - 1) // self.tile_size + 1):
+                tile_selection.append((str(tile_row) + '_' + str(tile_col), select))
+        return self._select(tile_selection)
+
+    def query_bbox(self, left, bottom, right, top):
+        '''
+        Every stored pixel inside a bounding box in the raster's crs (see query_window)
+        '''
+        window = rasterio.windows.from_bounds(left, bottom, right, top, self.meta['transform'])
+        window = window.round_offsets().round_lengths()
+        return self.query_window(window.row_off, window.row_off + window.height, window.col_off, window.col_off + window.width)
+
+    def query_mask(self, mask):
+        '''
+        Every stored pixel inside a (height, width) bool mask (see query_window)
+        '''
+        if mask.shape != (self.height, self.width):
+            raise ValueError("Mask does not have the raster shape!")
+        flat_mask = mask.reshape(-1)
+        tile_rows, tile_cols = np.nonzero(mask)
+        tile_keys = set(zip((tile_rows // self.tile_size).tolist(), (tile_cols // self.tile_size).tolist()))
+        return self._select([(str(r) + '_' + str(c), lambda index: flat_mask[index]) for r, c in sorted(tile_keys)])
@@ -0,0 +1,155 @@
+# ======================
+# Catalog of volcanoes / disturbance events
+# One entry per site with its area of interest (lon/lat polygon, same coordinates as ee.Geometry.Polygon),
+# the point used to filter the Landsat collections, the pre-event and event years, the folder of its yearly
+# vegetation index geotiffs, its analysis parameters and its resource limits in the batch scheduler.
+# Catalogs are stored as json: {"sites": [{...}, ...]}
+# ======================
+
+import os
+import glob
+import json
+import math
+import rasterio.windows
+from rasterio.windows import Window, from_bounds
+from rasterio.warp import transform_geom
+from rasterio.features import geometry_mask, bounds as geometry_bounds
+from pixel_stack import PRE_ERUPTION_YEARS, ERUPTION_YEAR
+
+REQUIRED_FIELDS = ['name', 'aoi', 'pre_years', 'erup_year', 'data_dir']
+
+# optional fields of a site and their defaults
+SITE_DEFAULTS = {'filter_point': None,
+                 'veg_indices': ['NBR'],
+                 'valid_num': 20,
+                 'disturbance_factor': 0.2,
+                 'recovery_percents': [0.2, 0.8],
+                 'num_years': 5,
+                 'max_memory_mb': 512,   # memory budget of one block of the site
+                 'max_workers': 2}       # blocks of the site processed at the same time
+
+# Unzen (the original study site); data_dir has to be set to the folder of its exported geotiffs
+UNZEN = {'name': 'Unzen',
+         'aoi': [[[130.27218028041096, 32.795519592838865],
+                  [130.27218028041096, 32.73027203877756],
+                  [130.36522074671956, 32.73027203877756],
+                  [130.36522074671956, 32.795519592838865]]],
+         'filter_point': [130.30344410868855, 32.761231395552514],
+         'pre_years': list(PRE_ERUPTION_YEARS),
+         'erup_year': ERUPTION_YEAR}
+
+# sites get_site looks up when no catalog is given
+BUILTIN_SITES = [UNZEN]
+
+def validate_site(site, base_dir=None):
+    '''
+    Checks a catalog entry and fills in the defaults of the optional fields
+
+    Args:
+        site (dict): catalog entry
+        base_dir (string): folder relative data_dir paths are resolved against (the catalog's folder)
+
+    Returns:
+        site (dict): complete catalog entry
+    '''
+    for field in REQUIRED_FIELDS:
+        if field not in site:
+            raise ValueError("Site " + str(site.get('name')) + " has no " + field + "!")
+    complete = dict(SITE_DEFAULTS)
+    complete.update(site)
+
+    good_veg_index = ['NBR', 'NDVI', 'SAVI']
+    if any(veg_index not in good_veg_index for veg_index in complete['veg_indices']):
+        raise ValueError("Inappropriate vegetation index chosen for site " + complete['name'] + "!")
+    if len(complete['pre_years']) != 2 or max(complete['pre_years']) >= complete['erup_year']:
+        raise ValueError("Inappropriate pre-event years chosen for site " + complete['name'] + "!")
+    if complete['max_workers'] < 1 or complete['max_memory_mb'] <= 0:
+        raise ValueError("Inappropriate resource limits chosen for site " + complete['name'] + "!")
+    complete['pre_years'] = tuple(complete['pre_years'])
+    complete['recovery_percents'] = tuple(complete['recovery_percents'])
+    if base_dir is not None:
+        complete['data_dir'] = os.path.join(base_dir, complete['data_dir'])
+    return complete
+
+def load_catalog(catalog_file):
+    '''
+    Reads a json site catalog; data_dir paths are relative to the catalog's folder
+
+    Returns:
+        sites (list): complete catalog entries (see validate_site)
+    '''
+    with open(catalog_file) as f:
+        catalog = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(catalog_file))
+    sites = [validate_site(site, base_dir) for site in catalog['sites']]
+    names = [site['name'] for site in sites]
+    if len(set(names)) != len(names):
+        raise ValueError("Site names of the catalog are not unique!")
+    return sites
+
+def save_catalog(sites, catalog_file):
+    '''
+    Writes a json site catalog
+    '''
+    with open(catalog_file, 'w') as f:
+        json.dump({'sites': sites}, f, indent=2)
+
+def get_site(name, sites=None):
+    '''
+    Catalog entry of a site by name (case-insensitive), e.g. get_site('unzen') for the built-in Unzen entry
+
+    Args:
+        name (string): site name
+        sites (list): catalog entries to search; None searches BUILTIN_SITES
+    '''
+    if sites is None:
+        sites = BUILTIN_SITES
+    for site in sites:
+        if site['name'].lower() == name.lower():
+            return site
+    raise ValueError("Site " + name + " is not in the catalog!")
+
+def get_site_files(site, veg_index):
+    '''
+    Yearly geotiffs of one vegetation index of a site (files named like <...>{year}0601_{veg_index}.tif)
+    '''
+    files = glob.glob(os.path.join(site['data_dir'], '*_' + veg_index + '.tif'))
+    if not files:
+        raise ValueError("No " + veg_index + " geotiffs for site " + site['name'] + " in " + site['data_dir'] + "!")
+    return files
+
+def get_aoi_geometry(aoi, crs):
+    '''
+    AOI polygon (lon/lat rings) as a GeoJSON geometry in the raster's coordinate reference system
+    '''
+    rings = [list(ring) if ring[0] == ring[-1] else list(ring) + [ring[0]] for ring in aoi]
+    geometry = {'type': 'Polygon', 'coordinates': rings}
+    if crs is None:
+        raise ValueError("Rasters have no coordinate reference system to place the AOI in!")
+    return transform_geom('EPSG:4326', crs, geometry)
+
+def get_aoi_window(aoi, meta):
+    '''
+    Raster window of the bounding box of the AOI (clipped to the raster) and the mask of the AOI polygon in it
+
+    Args:
+        aoi (list): polygon rings of lon/lat coordinates
+        meta (dict): meta data for raster file
+
+    Returns:
+        window (rasterio Window): window of the AOI in the raster
+        aoi_mask (numpy array): 2D bool array (window height, window width); True inside the AOI polygon
+    '''
+    geometry = get_aoi_geometry(aoi, meta['crs'])
+    window = from_bounds(*geometry_bounds(geometry), transform=meta['transform'])
+    # whole pixels touched by the bounding box, clipped to the raster
+    col_start = max(0, math.floor(window.col_off))
+    row_start = max(0, math.floor(window.row_off))
+    col_stop = min(meta['width'], math.ceil(window.col_off + window.width))
+    row_stop = min(meta['height'], math.ceil(window.row_off + window.height))
+    if col_stop <= col_start or row_stop <= row_start:
+        raise ValueError("AOI does not overlap the rasters!")
+    window = Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+    window_transform = rasterio.windows.transform(window, meta['transform'])
+    aoi_mask = geometry_mask([geometry], out_shape=(window.height, window.width), transform=window_transform, invert=True)
+    return window, aoi_mask
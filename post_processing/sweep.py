@@ -0,0 +1,315 @@
+# ======================
+# Parameter sweep over the cleaning, QA and recovery thresholds
+# (valid_num of clean_data, the disturbance factor of get_disturbed_pixel_array, p and r2 of the QA filter,
+# and max_years of the years to recovery).
+# The trend fit of a pixel does not depend on any of these thresholds, so the candidate pixels (valid for the
+# largest valid_num, disturbed for the smallest disturbance factor) are fitted once, and every combination of
+# the parameter grids is evaluated in one vectorized pass over the candidates, with the masks broadcast over a
+# parameter-combination axis. Returns a tidy table: one row per (combination, metric)
+# ======================
+
+import os
+import json
+import hashlib
+import numpy as np
+import ingest_and_clean as ic
+import trend_fitting as tf
+import recovery_metrics as rm
+import preliminary_values as pv
+import cube_cache
+import instrumentation as instr
+from pixel_stack import PixelStack, pre_eruption_average, PRE_ERUPTION_YEARS, ERUPTION_YEAR
+
+PARAM_NAMES = ['valid_num', 'disturbance_factor', 'max_pval', 'min_r2', 'max_years']
+STAT_NAMES = ['n', 'mean', 'std', 'p10', 'median', 'p90']
+
+def build_candidates(file_list, veg_index, max_valid_num=20, min_disturbance_factor=0.2, pre_years=PRE_ERUPTION_YEARS,
+                     erup_year=ERUPTION_YEAR, method='batch', recovery_percents=(0.2, 0.8), num_years=5, max_memory_mb=512,
+                     cache_dir=None):
+    '''
+    Reads the geotiffs block by block and fits the trend of every candidate pixel once. A pixel is a candidate if
+    it is valid for max_valid_num and disturbed for min_disturbance_factor, i.e. if it is active for at least one
+    combination of a sweep with valid_num <= max_valid_num and disturbance_factor >= min_disturbance_factor
+
+    Args:
+        file_list (list): list of file paths to geotiffs of vegetation indices
+        veg_index (string): either 'NDVI', 'SAVI', 'NBR'
+        max_valid_num (int): largest valid_num of the sweeps
+        min_disturbance_factor (float): smallest disturbance factor of the sweeps
+        pre_years (tuple): the two pre-eruption years
+        erup_year (int): eruption year
+        method (string): trend model (see trend_fitting.TREND_MODELS)
+        recovery_percents (tuple): recovery percentages (0 to 1) to get the number of years to recovery for
+        num_years (int): number of years post-disturbance regrowth for the regrowth metrics
+        max_memory_mb (int): memory budget for one block in megabytes
+        cache_dir (string): if given, the candidates are saved to (and later loaded from) this folder,
+                            keyed by the input files and the arguments
+
+    Returns:
+        candidates (dict): 1D numpy array per candidate quantity ('nan_count', 'veg_pre', 'veg_erup', 'pval', 'r2'
+                           and the unfiltered metrics), 'nan_hist' (nan count histogram of all pixels)
+                           and 'info' (the arguments)
+    '''
+    good_veg_index = ['NBR', 'NDVI', 'SAVI']
+    if veg_index not in good_veg_index:
+        raise ValueError("Inappropriate vegetation index chosen!")
+
+    info = {'veg_index': veg_index,
+            'max_valid_num': int(max_valid_num),
+            'min_disturbance_factor': float(min_disturbance_factor),
+            'pre_years': list(pre_years),
+            'erup_year': int(erup_year),
+            'method': method,
+            'recovery_percents': [float(recovery_percent) for recovery_percent in recovery_percents],
+            'num_years': int(num_years)}
+    if cache_dir is not None:
+        key = hashlib.sha1(json.dumps({'files': cube_cache.get_fingerprint(file_list), 'info': info},
+                                      sort_keys=True).encode()).hexdigest()
+        cache_path = os.path.join(cache_dir, 'candidates_' + key + '.npz')
+        if os.path.exists(cache_path):
+            instr.log('Loading cached sweep candidates: ', cache_path)
+            with np.load(cache_path) as f:
+                candidates = {name: f[name] for name in f.files}
+            candidates['info'] = info
+            return candidates
+
+    year_list, meta, bounds = ic.get_stack_info(file_list, veg_index)
+    yearly_years = np.arange(year_list[0], year_list[-1] + 1)
+    year_cols = np.asarray(year_list) - year_list[0]
+    pre_first, pre_second, erup = ic.get_year_columns(year_list, [pre_years[0], pre_years[1], erup_year])
+
+    blocks = []
+    nan_hist = np.zeros(yearly_years.shape[0] + 1, dtype=np.int64)
+    with instr.stage('sweep_candidates', pixels=meta['height'] * meta['width']):
+        for window in ic.get_block_windows(meta['height'], meta['width'], year_list, max_memory_mb):
+            image_block = ic.read_image_block(file_list, window)
+            values = np.full([window.height * window.width, yearly_years.shape[0]], np.nan)
+            values[:, year_cols] = image_block.reshape(-1, image_block.shape[2])
+            nan_per_pixel = np.count_nonzero(np.isnan(values), axis=1)
+            nan_hist += np.bincount(nan_per_pixel, minlength=nan_hist.shape[0])
+
+            active = np.flatnonzero(ic.get_chunk_valid(values, nan_per_pixel, pre_first, pre_second, erup,
+                                                       max_valid_num, min_disturbance_factor))
+            stack = PixelStack(values[active], yearly_years, np.ones(active.shape[0], dtype=bool))
+            fit_result = tf.trend_fit(stack, method, erup_year)
+            veg_pre = pre_eruption_average(stack, pre_years)
+            metric_records = rm.metrics_from_fit(fit_result, veg_pre, pv.get_dVI(stack, pre_years, erup_year),
+                                                 recovery_percents, num_years, max_pval=np.inf, min_r2=-np.inf,
+                                                 max_years=np.inf)
+            block = {'nan_count': nan_per_pixel[active],
+                     'veg_pre': veg_pre,
+                     'veg_erup': stack.column(erup_year),
+                     'pval': fit_result[:, 2],
+                     'r2': fit_result[:, 3]}
+            for name in metric_records.dtype.names:
+                if name != 'qa':
+                    block[name] = metric_records[name]
+            blocks.append(block)
+
+    candidates = {name: np.concatenate([block[name] for block in blocks]) for name in blocks[0]}
+    candidates['nan_hist'] = nan_hist
+    instr.log('Sweep candidate pixels: ', candidates['nan_count'].shape[0])
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = cache_path[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmp_path, **candidates)
+        os.replace(tmp_path, cache_path)
+    candidates['info'] = info
+    return candidates
+
+def get_bin_edges(values, metric, bins, max_years):
+    '''
+    Histogram bin edges of a metric for the sweep quantiles: one bin per year for the years to recovery,
+    equal-count bins of the candidate values for the other metrics
+    '''
+    if metric.startswith('years_to_'):
+        return np.arange(0.5, max(max_years), 1.)
+    finite = values[np.isfinite(values)]
+    if finite.shape[0] == 0:
+        return np.array([0., 1.])
+    edges = np.unique(np.quantile(finite, np.linspace(0, 1, bins + 1)))
+    if edges.shape[0] == 1:
+        edges = np.array([edges[0], edges[0] + 1.])
+    return edges
+
+def hist_quantile(hist, edges, q, interpolate=True):
+    '''
+    Quantile q of each row of a (combinations, bins) histogram, interpolated linearly within the bin
+    (or the bin center, for integer-valued metrics with one bin per value)
+
+    Returns:
+        quantiles (numpy array): one value per row (np.nan for empty rows)
+    '''
+    cumulative = np.cumsum(hist, axis=1)
+    total = cumulative[:, -1]
+    target = q * total
+    k = np.minimum(np.argmax(cumulative >= target[:, np.newaxis], axis=1), hist.shape[1] - 1)
+    rows = np.arange(hist.shape[0])
+    if interpolate:
+        below = cumulative[rows, k] - hist[rows, k]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            frac = np.clip((target - below) / hist[rows, k], 0, 1)
+    else:
+        frac = 0.5
+    quantiles = edges[k] + frac * (edges[k + 1] - edges[k])
+    return np.where(total > 0, quantiles, np.nan)
+
+def get_mask_groups(masks):
+    '''
+    Groups pixels by their pattern of (pixels, grid values) threshold masks. The mask rows of each parameter
+    are packed into integer codes (so at most 62 values per grid)
+
+    Args:
+        masks (list): 2D bool arrays (pixels, grid values), one per parameter
+
+    Returns:
+        group_masks (list): 2D bool arrays (groups, grid values), the masks of each group
+        group (numpy array): group of each pixel
+    '''
+    group = np.zeros(masks[0].shape[0], dtype=np.int64)
+    patterns = []
+    for mask in masks:
+        if mask.shape[1] > 62:
+            raise ValueError("Inappropriate sweep grid chosen! At most 62 values per parameter")
+        bits = 1 << np.arange(mask.shape[1], dtype=np.int64)
+        pattern, code = np.unique(mask @ bits, return_inverse=True)
+        patterns.append((pattern, bits))
+        group = group * pattern.shape[0] + code.reshape(-1)
+    group_codes, group = np.unique(group, return_inverse=True)
+
+    group_masks = []
+    for pattern, bits in reversed(patterns):
+        code = group_codes % pattern.shape[0]
+        group_codes = group_codes // pattern.shape[0]
+        group_masks.insert(0, (pattern[code][:, np.newaxis] & bits) > 0)
+    return group_masks, group.reshape(-1)
+
+def sweep(candidates, valid_nums=(20,), disturbance_factors=(0.2,), max_pvals=(0.05,), min_r2s=(0.7,), max_years=(30,),
+          bins=256):
+    '''
+    Evaluates every combination of the parameter grids in one vectorized pass over the fitted candidate pixels.
+    The candidates are grouped by their pattern of threshold masks, the counts, sums and histograms of every metric
+    are aggregated per group, and each combination's statistics are the sum over the groups it includes
+    (a (groups, combinations) matrix product)
+
+    Args:
+        candidates (dict): fitted candidate pixels (see build_candidates)
+        valid_nums (tuple): valid_num values (pixels with valid_num or more nans are invalid)
+        disturbance_factors (tuple): disturbance factors (disturbed if VIpre - VIerup > disturbance_factor * VIpre)
+        max_pvals (tuple): p value thresholds of the QA filter
+        min_r2s (tuple): r2 thresholds of the QA filter
+        max_years (tuple): years to recovery of max_years or more are considered invalid
+        bins (int): number of histogram bins of the continuous metrics; the quantiles (p10, median, p90) are
+                    interpolated within these bins (exact to the year for the years to recovery)
+
+    Returns:
+        table (numpy structured array): one record per (combination, metric) with the parameters, the pixel counts
+                                        'n_valid', 'n_active' (valid and disturbed) and 'n_qa' (active and passing QA)
+                                        of the combination, and 'n' (pixels with a value), 'mean', 'std',
+                                        'p10', 'median', 'p90' of the metric
+    '''
+    info = candidates['info']
+    grids = [np.asarray(grid) for grid in (valid_nums, disturbance_factors, max_pvals, min_r2s, max_years)]
+    if grids[0].max() > info['max_valid_num'] or grids[1].min() < info['min_disturbance_factor']:
+        raise ValueError("Inappropriate sweep grid chosen! Candidates were built for valid_num <= " +
+                         str(info['max_valid_num']) + " and disturbance factor >= " + str(info['min_disturbance_factor']))
+
+    # flat parameter-combination axis: index of each combination in every grid
+    combo_index = [index.reshape(-1) for index in np.meshgrid(*[np.arange(grid.shape[0]) for grid in grids], indexing='ij')]
+    num_combos = combo_index[0].shape[0]
+    vi, fi, pi, ri, mi = combo_index
+
+    with instr.stage('sweep', pixels=candidates['nan_count'].shape[0]):
+        # (pixels, grid values) masks of each threshold
+        veg_pre = candidates['veg_pre'][:, np.newaxis]
+        with np.errstate(invalid='ignore'):
+            masks = [candidates['nan_count'][:, np.newaxis] < grids[0],
+                     (veg_pre - candidates['veg_erup'][:, np.newaxis]) > veg_pre * grids[1],
+                     candidates['pval'][:, np.newaxis] < grids[2],
+                     candidates['r2'][:, np.newaxis] >= grids[3]]
+        (valid, disturbed, pval_ok, r2_ok), group = get_mask_groups(masks)
+        num_groups = valid.shape[0]
+        # (groups, combinations) masks
+        active = valid[:, vi] & disturbed[:, fi]
+        qa = active & pval_ok[:, pi] & r2_ok[:, ri]
+        group_count = np.bincount(group, minlength=num_groups).astype(float)
+        n_active = (group_count @ active).astype(np.int64)
+        n_qa = (group_count @ qa).astype(np.int64)
+
+        metric_names = [name for name in candidates if name not in ('nan_count', 'veg_pre', 'veg_erup', 'pval', 'r2', 'nan_hist', 'info')]
+        stats = {}
+        for name in metric_names:
+            values = candidates[name]
+            # dVI is reported for every active pixel, the other metrics only where the fit passes QA
+            include = active if name == 'dVI' else qa
+            metric_group = group
+            if name.startswith('years_to_'):
+                with np.errstate(invalid='ignore'):
+                    (years_ok,), years_group = get_mask_groups([values[:, np.newaxis] < grids[4]])
+                metric_group = group * years_ok.shape[0] + years_group
+                include = np.repeat(include, years_ok.shape[0], axis=0) & np.tile(years_ok[:, mi], (num_groups, 1))
+            num_metric_groups = include.shape[0]
+
+            edges = get_bin_edges(values, name, bins, grids[4])
+            num_bins = edges.shape[0] - 1
+            # pixels with a value, in a group included by at least one combination
+            used = np.isfinite(values) & include.any(axis=1)[metric_group]
+            finite_values = values[used]
+            finite_group = metric_group[used]
+            value_bins = np.clip(np.searchsorted(edges, finite_values, side='right') - 1, 0, num_bins - 1)
+            group_hist = np.bincount(finite_group * num_bins + value_bins,
+                                     minlength=num_metric_groups * num_bins).reshape(num_metric_groups, num_bins)
+            group_sums = np.stack([np.bincount(finite_group, weights=finite_values, minlength=num_metric_groups),
+                                   np.bincount(finite_group, weights=finite_values * finite_values, minlength=num_metric_groups)])
+
+            include = include.astype(float)
+            hist = np.rint(include.T @ group_hist).astype(np.int64)
+            sums = group_sums @ include
+            stats[name] = (hist, sums, edges)
+
+    # pixels with fewer than valid_num nans, over the whole raster
+    n_valid = np.concatenate([[0], np.cumsum(candidates['nan_hist'])])[np.minimum(grids[0], candidates['nan_hist'].shape[0])]
+
+    fields = [(name, grid.dtype if name in ('valid_num', 'max_years') else float) for name, grid in zip(PARAM_NAMES, grids)]
+    fields += [('metric', 'U32'), ('n_valid', np.int64), ('n_active', np.int64), ('n_qa', np.int64), ('n', np.int64)]
+    fields += [(name, float) for name in STAT_NAMES[1:]]
+    table = np.empty(num_combos * len(metric_names), dtype=fields)
+    for m, name in enumerate(metric_names):
+        hist, sums, edges = stats[name]
+        rows = slice(m, None, len(metric_names))
+        for param, grid, index in zip(PARAM_NAMES, grids, combo_index):
+            table[param][rows] = grid[index]
+        table['metric'][rows] = name
+        table['n_valid'][rows] = n_valid[vi]
+        table['n_active'][rows] = n_active
+        table['n_qa'][rows] = n_qa
+        n = hist.sum(axis=1)
+        table['n'][rows] = n
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = sums[0] / n
+            table['mean'][rows] = mean
+            table['std'][rows] = np.sqrt(np.maximum(sums[1] / n - mean * mean, 0))
+        for stat, q in (('p10', 0.1), ('median', 0.5), ('p90', 0.9)):
+            table[stat][rows] = hist_quantile(hist, edges, q, not name.startswith('years_to_'))
+    instr.log('Swept parameter combinations: ', num_combos, ', mask groups: ', num_groups)
+    return table
+
+def run_sweep(file_list, veg_index, valid_nums=(20,), disturbance_factors=(0.2,), max_pvals=(0.05,), min_r2s=(0.7,),
+              max_years=(30,), cache_dir=None, bins=256, **candidate_params):
+    '''
+    Builds (or loads from cache_dir) the candidate pixels for the grids and sweeps them (see build_candidates and sweep)
+
+    Example:
+        table = run_sweep(nbr_files, 'NBR', valid_nums=(15, 20, 25), disturbance_factors=(0.1, 0.2, 0.3),
+                          max_pvals=(0.01, 0.05, 0.1), min_r2s=(0.5, 0.6, 0.7, 0.8), max_years=(20, 30, 40))
+        median_years = table[table['metric'] == 'years_to_80'][['disturbance_factor', 'min_r2', 'median']]
+    '''
+    candidates = build_candidates(file_list, veg_index, max(valid_nums), min(disturbance_factors), cache_dir=cache_dir,
+                                  **candidate_params)
+    return sweep(candidates, valid_nums, disturbance_factors, max_pvals, min_r2s, max_years, bins)
+
+def save_sweep(table, out_file):
+    '''
+    Writes a sweep table to a csv file, one row per (combination, metric)
+    '''
+    np.savetxt(out_file, table, fmt='%s', delimiter=',', header=','.join(table.dtype.names), comments='')
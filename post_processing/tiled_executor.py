@@ -0,0 +1,88 @@
+# ======================
+# Multi-process tiled executor for the post-processing chain
+# Splits the raster into spatial tiles, runs clean -> mask -> fit -> metrics on each tile
+# in a process pool, and stitches the per-tile results back into full-size metric arrays
+# ======================
+
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from rasterio.windows import Window
+import ingest_and_clean as ic
+import pipeline as pl
+
+def get_tiles(height, width, tile_size=512):
+    '''
+    Splits the raster into square tiles (edge tiles are clipped to the raster)
+
+    Args:
+        height (int): raster height
+        width (int): raster width
+        tile_size (int): tile height and width in pixels
+
+    Returns:
+        tiles (list): list of rasterio Windows covering the raster
+    '''
+    tiles = []
+    for row_off in range(0, height, tile_size):
+        for col_off in range(0, width, tile_size):
+            tiles.append(Window(col_off, row_off, min(tile_size, width - col_off), min(tile_size, height - row_off)))
+    return tiles
+
+def _process_tile(file_list, year_list, tile, recovery_percents, num_years):
+    '''
+    Worker function: runs the full chain on one tile (module level so it can be pickled)
+    '''
+    return tile, pl.run_block(file_list, year_list, tile, recovery_percents, num_years)
+
+def iter_tiled(file_list, veg_index, n_workers=None, tile_size=512, recovery_percents=(0.2, 0.8), num_years=5):
+    '''
+    Generator that runs the full chain on every tile in a process pool and yields tiles as they finish
+
+    Args:
+        file_list (list): list of file paths to geotiffs of vegetation indices
+        veg_index (string): either 'NDVI', 'SAVI', 'NBR'
+        n_workers (int): number of worker processes; defaults to the number of cores. 1 runs serially in this process
+        tile_size (int): tile height and width in pixels
+        recovery_percents (tuple): recovery percentages (0 to 1) to get the number of years to recovery for
+        num_years (int): number of years post-disturbance regrowth for the regrowth metrics
+
+    Yields:
+        tile (rasterio Window): window of the tile in the raster
+        tile_metrics (dict): 2D numpy array (tile height, tile width) per metric
+    '''
+    good_veg_index = ['NBR', 'NDVI', 'SAVI']
+    if veg_index not in good_veg_index:
+        raise ValueError("Inappropriate vegetation index chosen!")
+
+    year_list, meta, bounds = ic.get_stack_info(file_list, veg_index)
+    tiles = get_tiles(meta['height'], meta['width'], tile_size)
+    if n_workers is None:
+        n_workers = os.cpu_count()
+
+    if n_workers == 1:
+        for tile in tiles:
+            yield _process_tile(file_list, year_list, tile, recovery_percents, num_years)
+        return
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(_process_tile, file_list, year_list, tile, recovery_percents, num_years) for tile in tiles]
+        for future in as_completed(futures):
+            yield future.result()
+
+def run_tiled(file_list, veg_index, n_workers=None, tile_size=512, recovery_percents=(0.2, 0.8), num_years=5):
+    '''
+    Runs the full chain tile by tile in a process pool and stitches the results into full-size metric arrays.
+    Every step of the chain is per pixel, so the result is identical to a serial run.
+
+    Args:
+        see iter_tiled
+
+    Returns:
+        metrics (dict): 2D numpy array (height, width) per metric
+        meta (dict): meta data for raster file
+        bounds: bounds for raster file
+    '''
+    year_list, meta, bounds = ic.get_stack_info(file_list, veg_index)
+    tile_iter = iter_tiled(file_list, veg_index, n_workers, tile_size, recovery_percents, num_years)
+    metrics = pl.assemble_blocks(tile_iter, meta['height'], meta['width'])
+    return metrics, meta, bounds
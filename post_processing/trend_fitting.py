@@ -3,23 +3,132 @@
 # refactoring code for: do linear fitting (log) using statsmodel.api 
 # # https://www.statology.org/sklearn-linear-regression-summary/
 
+import warnings
 import statsmodels.api as sm
 import numpy as np
+from scipy import stats
+from pixel_stack import as_pixel_stack, ERUPTION_YEAR
+import instrumentation as instr
 
-def trend_fit(valid_vegstack_withyears): 
+@instr.instrumented('trend_fit', pixels=(0, 1))
+def trend_fit(valid_vegstack_withyears, method='batch', erup_year=ERUPTION_YEAR): 
     """
     This function performs pixel-wise linear-log regression to obtain components of the regression curve
     Args: 
-        valid_vegstack (numpy array): complete image stack
+        valid_vegstack (numpy array or PixelStack): complete image stack
+        method (string): name of a trend model in TREND_MODELS: 'batch' to fit all pixels at once with the vectorized 
+                        OLS engine (default), 'statsmodels' to fit pixel by pixel with statsmodels (reference mode for parity checks), 
+                        or one of the robust models 'theil_sen' and 'huber'. Every model in TREND_MODELS is a linear-log model, 
+                        so its slope and const can be used by recovery_metrics (see exponential_trend_fit for the exponential model)
+        erup_year (int): eruption year; the trend is fitted from this year onwards
     Returns: 
         trend_attr (n-dim numpy array): n-dim array of regression curve components (slope, const, pval, r2)
     """
+    if method not in TREND_MODELS: 
+        raise ValueError("Inappropriate trend fitting method chosen!")
+
     # Get just vegetation indices
-    valid_vegstack = valid_vegstack_withyears[:, :, 1]
+    valid_vegstack = as_pixel_stack(valid_vegstack_withyears)
 
-    post_erup_stack = valid_vegstack[:, 11:] # used to be from 9; 11 is more accurate
-    print(post_erup_stack.shape[0])
-    
+    post_erup_stack = valid_vegstack.since(erup_year) # from 1995 (column 11 at Unzen); used to be from 9; 11 is more accurate
+    instr.log('post-eruption pixels, years: ', post_erup_stack.shape[0], post_erup_stack.shape[1])
+
+    return TREND_MODELS[method](post_erup_stack)
+
+# ======================
+# Vectorized linear-log regression over all pixels at once
+# ======================
+def log_year_axis(num_years): 
+    """
+    Predictor used for the linear-log regression: log10 of the number of years since the eruption, 
+    where the eruption year itself (0) is kept at 0
+
+    Args: 
+        num_years (int): number of post-eruption years (including the eruption year)
+    Returns: 
+        x (numpy array): 1D array of log-years
+    """
+    x = np.arange(num_years, dtype=float)
+    x[1:] = np.log10(x[1:])
+    return x
+
+def batch_trend_fit(post_erup_stack, chunk_size=250000): 
+    """
+    Performs NaN-aware linear-log OLS for every pixel at once from closed-form sufficient statistics. 
+    Each pixel only uses its own finite years, so the number of valid years can differ per pixel. 
+    Pixels are processed in chunks to bound the size of temporary arrays.
+
+    Args: 
+        post_erup_stack (numpy array): 2D array (pixels, years) of post-eruption vegetation index values
+        chunk_size (int): number of pixels solved at a time
+    Returns: 
+        trend_attr (numpy array): (pixels, 4) array of slope, const, pval, r2
+    """
+    num_pix, num_years = post_erup_stack.shape
+    x = log_year_axis(num_years)
+    trend_attr = np.full([num_pix, 4], np.nan)
+
+    for start in range(0, num_pix, chunk_size): 
+        y = post_erup_stack[start:start + chunk_size]
+        trend_attr[start:start + chunk_size] = _ols_from_sums(*_regression_sums(y, x))
+    return trend_attr
+
+def _regression_sums(y, x): 
+    '''
+    Sufficient statistics (n, sum x, sum x^2, sum y, sum y^2, sum xy) of each row of y against x, skipping NaNs
+    '''
+    # row-wise reductions (rather than matrix products) so each pixel's sums do not depend on
+    # how many pixels are solved together, i.e., tiled and serial runs give identical results
+    valid = np.isfinite(y)
+    y0 = np.where(valid, y, 0.)
+    x_valid = np.where(valid, x, 0.)
+    n = valid.sum(axis=1).astype(float)
+    sx = x_valid.sum(axis=1)
+    sxx = (x_valid * x_valid).sum(axis=1)
+    sy = y0.sum(axis=1)
+    syy = (y0 * y0).sum(axis=1)
+    sxy = (x_valid * y0).sum(axis=1)
+    return n, sx, sxx, sy, syy, sxy
+
+def _ols_from_sums(n, sx, sxx, sy, syy, sxy): 
+    '''
+    Solves simple OLS (y = slope*x + const) from per-pixel sufficient statistics
+
+    Returns: 
+        trend_attr (numpy array): (pixels, 4) array of slope, const, pval, r2; 
+                                NaN where there are too few valid years to estimate a value
+    '''
+    trend_attr = np.full([n.shape[0], 4], np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'): 
+        # centered sums of squares and cross products
+        s_xx = sxx - sx * sx / n
+        s_xy = sxy - sx * sy / n
+        s_yy = syy - sy * sy / n
+
+        fit = (n >= 2) & (s_xx > 0)
+        slope = np.where(fit, s_xy / s_xx, np.nan)
+        const = np.where(fit, (sy - slope * sx) / n, np.nan)
+
+        # residual sum of squares; clipped at 0 for round-off on perfect fits
+        ssr = np.maximum(s_yy - slope * s_xy, 0)
+        df_resid = n - 2
+        tvalue = slope / np.sqrt(ssr / df_resid / s_xx)
+        pval = np.where(fit & (df_resid > 0), 2 * stats.t.sf(np.abs(tvalue), np.maximum(df_resid, 1)), np.nan)
+        r2 = np.where(fit & (s_yy > 0), 1 - ssr / s_yy, np.nan)
+
+    trend_attr[:, 0] = slope
+    trend_attr[:, 1] = const
+    trend_attr[:, 2] = pval
+    trend_attr[:, 3] = r2
+    return trend_attr
+
+# ======================
+# Reference per-pixel statsmodels fitting
+# ======================
+def _trend_fit_statsmodels(post_erup_stack): 
+    '''
+    Original pixel-by-pixel statsmodels OLS loop, kept as a reference for parity checks of batch_trend_fit
+    '''
     # initialize np array to store slope, p, and r2 values (in that order)
     
     trend_attr = np.full([post_erup_stack.shape[0], 4], np.nan)
@@ -67,3 +176,217 @@ def trend_fit(valid_vegstack_withyears):
      # return array of slope and pval?? 
     return trend_attr
 
+# ======================
+# Vectorized robust trend models
+# Same (pixels, 4) slope, const, pval, r2 output as batch_trend_fit, for all pixels at once
+# ======================
+def theil_sen_fit(post_erup_stack, chunk_size=20000): 
+    """
+    Theil-Sen linear-log fit: slope is the median of the slopes between every pair of valid years (untied in x), 
+    const the median of y - slope*x. The p value is the two-sided Mann-Kendall test of the trend 
+    (normal approximation with continuity correction; the variance of S is corrected for the ties in x, 
+    i.e. the eruption year and the year after, and in y) and r2 is 1 - SSR/SST of the Theil-Sen line
+
+    Args: 
+        post_erup_stack (numpy array): 2D array (pixels, years) of post-eruption vegetation index values
+        chunk_size (int): number of pixels solved at a time (a chunk holds years*(years-1)/2 pairs per pixel)
+    Returns: 
+        trend_attr (numpy array): (pixels, 4) array of slope, const, pval, r2
+    """
+    num_pix, num_years = post_erup_stack.shape
+    x = log_year_axis(num_years)
+    first, second = np.triu_indices(num_years, k=1)
+    # the eruption year and the year after share x = 0; pairs tied in x have no slope
+    untied = x[second] > x[first]
+    first, second = first[untied], second[untied]
+    dx = x[second] - x[first]
+    # groups of years with the same x, for the tie correction
+    x_groups = (np.unique(x, return_inverse=True)[1][:, np.newaxis] == np.arange(num_years)).astype(float)
+    trend_attr = np.full([num_pix, 4], np.nan)
+
+    for start in range(0, num_pix, chunk_size): 
+        y = post_erup_stack[start:start + chunk_size]
+        dy = y[:, second] - y[:, first]
+        with warnings.catch_warnings(), np.errstate(invalid='ignore'): 
+            # pixels with fewer than 2 valid years stay np.nan
+            warnings.simplefilter('ignore', RuntimeWarning)
+            slope = np.nanmedian(dy / dx, axis=1)
+            const = np.nanmedian(y - slope[:, np.newaxis] * x, axis=1)
+
+            # Mann-Kendall S statistic over the valid pairs
+            valid = np.isfinite(y)
+            n = valid.sum(axis=1)
+            S = np.nansum(np.sign(dy), axis=1)
+            var_S = _kendall_variance(n, valid.astype(float) @ x_groups, _tie_counts(y))
+            z = (S - np.sign(S)) / np.sqrt(var_S)
+            pval = np.where(n >= 3, 2 * stats.norm.sf(np.abs(z)), np.nan)
+
+            r2 = np.where(np.isfinite(slope), _r2(y, slope[:, np.newaxis] * x + const[:, np.newaxis]), np.nan)
+        trend_attr[start:start + chunk_size] = np.column_stack([slope, const, pval, r2])
+    return trend_attr
+
+def _tie_counts(y): 
+    '''
+    Sizes of the groups of equal finite values of each row of y, as a (rows, columns) array padded with zeros
+    '''
+    sorted_y = np.sort(y, axis=1)
+    # a new group starts wherever the sorted value changes (np.nan never equals itself, so each nan is its own group)
+    new_group = np.ones(sorted_y.shape, dtype=bool)
+    new_group[:, 1:] = sorted_y[:, 1:] != sorted_y[:, :-1]
+    group = np.cumsum(new_group, axis=1) - 1 + np.arange(y.shape[0])[:, np.newaxis] * y.shape[1]
+    counts = np.bincount(group.ravel(), weights=np.isfinite(sorted_y).ravel(), minlength=y.size)
+    return counts.reshape(y.shape)
+
+def _kendall_variance(n, x_ties, y_ties): 
+    '''
+    Variance of the Mann-Kendall (Kendall) S statistic with ties in x and in y (Kendall, 1970; as in scipy.stats.kendalltau)
+
+    Args: 
+        n (numpy array): number of valid years of each pixel
+        x_ties (numpy array): (pixels, groups) sizes of the groups of valid years with the same x
+        y_ties (numpy array): (pixels, groups) sizes of the groups of equal values
+    '''
+    def tie_sums(t): 
+        return ((t * (t - 1)).sum(axis=1), (t * (t - 1) * (t - 2)).sum(axis=1), (t * (t - 1) * (2 * t + 5)).sum(axis=1))
+    x_pairs, x_triples, x_terms = tie_sums(x_ties)
+    y_pairs, y_triples, y_terms = tie_sums(y_ties)
+    return ((n * (n - 1) * (2 * n + 5) - x_terms - y_terms) / 18 
+            + x_triples * y_triples / (9 * n * (n - 1) * (n - 2)) 
+            + x_pairs * y_pairs / (2 * n * (n - 1)))
+
+def huber_fit(post_erup_stack, k=1.345, max_iter=20, tol=1e-8, chunk_size=250000): 
+    """
+    Huber M-estimate of the linear-log fit by iteratively reweighted least squares, for every pixel at once. 
+    Residuals beyond k robust standard deviations (MAD / 0.6745) are downweighted. 
+    p and r2 are those of the final weighted least squares fit; the weights are rescaled to sum to the number 
+    of valid years, so that the p value has the residual degrees of freedom of the valid years (n - 2), not sum(w) - 2
+
+    Args: 
+        post_erup_stack (numpy array): 2D array (pixels, years) of post-eruption vegetation index values
+        k (float): Huber tuning constant (1.345 gives 95% efficiency for normal errors)
+        max_iter (int): maximum number of reweighting iterations
+        tol (float): stop when no slope or const changes by more than tol
+        chunk_size (int): number of pixels solved at a time
+    Returns: 
+        trend_attr (numpy array): (pixels, 4) array of slope, const, pval, r2
+    """
+    num_pix, num_years = post_erup_stack.shape
+    x = log_year_axis(num_years)
+    trend_attr = np.full([num_pix, 4], np.nan)
+
+    for start in range(0, num_pix, chunk_size): 
+        y = post_erup_stack[start:start + chunk_size]
+        weights = np.isfinite(y).astype(float)
+        fit = _ols_from_sums(*_regression_sums(y, x))
+        for i in range(max_iter): 
+            residuals = y - (fit[:, [0]] * x + fit[:, [1]])
+            with warnings.catch_warnings(), np.errstate(divide='ignore', invalid='ignore'): 
+                warnings.simplefilter('ignore', RuntimeWarning)
+                scale = np.nanmedian(np.abs(residuals), axis=1, keepdims=True) / 0.6745
+                abs_z = np.abs(residuals) / scale
+                # perfect fits (scale 0) keep full weights
+                weights = np.where(np.isfinite(abs_z), np.minimum(1, k / np.maximum(abs_z, 1e-12)), 1.)
+            weights = np.where(np.isfinite(y), weights, 0.)
+            # rescaling the weights does not change slope, const or r2, only the degrees of freedom of p
+            with np.errstate(divide='ignore', invalid='ignore'): 
+                weights = weights * (np.isfinite(y).sum(axis=1, keepdims=True) / weights.sum(axis=1, keepdims=True))
+            weights = np.where(np.isfinite(weights), weights, 0.)
+            new_fit = _ols_from_sums(*_weighted_regression_sums(y, x, weights))
+            change = np.nanmax(np.abs(new_fit[:, :2] - fit[:, :2]), initial=0)
+            fit = new_fit
+            if change <= tol: 
+                break
+        trend_attr[start:start + chunk_size] = fit
+    return trend_attr
+
+def exponential_fit(post_erup_stack, rates=np.logspace(-2, 0.5, 40), return_rate=False, chunk_size=250000): 
+    """
+    Exponential recovery model y = const + slope * (1 - exp(-rate * t)), with t the years since the eruption. 
+    For a fixed rate the model is linear, so every pixel is solved in closed form for every rate of the grid 
+    and keeps the rate with the highest r2. Here slope is the recovery amplitude (the asymptotic gain over const), 
+    not the linear-log slope; the linear-log formulas of recovery_metrics only apply to the linear-log models
+
+    Args: 
+        post_erup_stack (numpy array): 2D array (pixels, years) of post-eruption vegetation index values
+        rates (numpy array): candidate recovery rates (per year)
+        return_rate (bool): if True, also return the best rate of every pixel
+        chunk_size (int): number of pixels solved at a time
+    Returns: 
+        trend_attr (numpy array): (pixels, 4) array of slope, const, pval, r2
+        best_rate (numpy array): rate of each pixel (only if return_rate)
+    """
+    num_pix, num_years = post_erup_stack.shape
+    t = np.arange(num_years, dtype=float)
+    trend_attr = np.full([num_pix, 4], np.nan)
+    best_rate = np.full(num_pix, np.nan)
+
+    for start in range(0, num_pix, chunk_size): 
+        y = post_erup_stack[start:start + chunk_size]
+        best = np.full([y.shape[0], 4], np.nan)
+        best_r2 = np.full(y.shape[0], -np.inf)
+        for rate in rates: 
+            fit = _ols_from_sums(*_regression_sums(y, 1 - np.exp(-rate * t)))
+            better = fit[:, 3] > best_r2
+            best[better] = fit[better]
+            best_r2[better] = fit[better, 3]
+            best_rate[start:start + chunk_size][better] = rate
+        trend_attr[start:start + chunk_size] = best
+    if return_rate: 
+        return trend_attr, best_rate
+    return trend_attr
+
+def exponential_trend_fit(valid_vegstack_withyears, erup_year=ERUPTION_YEAR, rates=np.logspace(-2, 0.5, 40), return_rate=False): 
+    """
+    Fits the exponential recovery model (see exponential_fit) from the eruption year onwards. 
+    Kept out of TREND_MODELS: its slope is a recovery amplitude, so its output cannot be passed to recovery_metrics
+
+    Args: 
+        valid_vegstack (numpy array or PixelStack): complete image stack
+        erup_year (int): eruption year; the model is fitted from this year onwards
+        rates (numpy array): candidate recovery rates (per year)
+        return_rate (bool): if True, also return the best rate of every pixel
+    Returns: 
+        trend_attr (numpy array): (pixels, 4) array of amplitude, const, pval, r2
+        best_rate (numpy array): rate of each pixel (only if return_rate)
+    """
+    post_erup_stack = as_pixel_stack(valid_vegstack_withyears).since(erup_year)
+    return exponential_fit(post_erup_stack, rates, return_rate)
+
+def _weighted_regression_sums(y, x, weights): 
+    '''
+    Weighted sufficient statistics (sum w, sum wx, sum wx^2, sum wy, sum wy^2, sum wxy) of each row of y against x
+    '''
+    y0 = np.where(weights > 0, y, 0.)
+    wx = weights * x
+    return (weights.sum(axis=1), wx.sum(axis=1), (wx * x).sum(axis=1), (weights * y0).sum(axis=1), 
+            (weights * y0 * y0).sum(axis=1), (wx * y0).sum(axis=1))
+
+def _r2(y, y_fit): 
+    '''
+    1 - SSR/SST of each row of y (NaNs skipped) for fitted values y_fit
+    '''
+    ssr = np.nansum((y - y_fit)**2, axis=1)
+    sst = np.nansum((y - np.nanmean(y, axis=1, keepdims=True))**2, axis=1)
+    return np.where(sst > 0, 1 - ssr / sst, np.nan)
+
+# ======================
+# Registry of linear-log trend models: every model takes the (pixels, years) post-eruption stack
+# and returns the (pixels, 4) slope, const, pval, r2 array of a fit of y against log_year_axis
+# ======================
+TREND_MODELS = {
+    'batch': batch_trend_fit,
+    'statsmodels': _trend_fit_statsmodels,
+    'theil_sen': theil_sen_fit,
+    'huber': huber_fit,
+}
+
+def register_trend_model(name, model): 
+    """
+    Adds a trend model to the registry, so that trend_fit(stack, method=name) uses it. 
+    The model has to be linear-log (y = slope * log_year_axis + const), since recovery_metrics relies on it
+
+    Args: 
+        name (string): model name
+        model (function): takes the (pixels, years) post-eruption stack and returns the (pixels, 4) slope, const, pval, r2 array
+    """
+    TREND_MODELS[name] = model